@@ -12,8 +12,8 @@ from azureml.core.runconfig import MpiConfiguration
 
 from common import (
     get_or_create_workspace,
-    create_or_update_environment,
-    create_or_update_cluster,
+    provision_cluster_and_environment,
+    k_default_beeond_mnt,
 )
 
 import importlib.util
@@ -66,6 +66,23 @@ def main():
     parser.add_argument(
         "--keep-failed-cluster", dest="terminate_on_failure", action="store_false"
     )
+    parser.add_argument(
+        "--topology-aware",
+        action="store_true",
+        help="Order the BeeOND nodefile by measured IB latency and bandwidth",
+    )
+    parser.add_argument(
+        "--preflight",
+        choices=["abort", "off"],
+        default="abort",
+        help="Abort if any node fails the health pre-flight checks",
+    )
+    parser.add_argument(
+        "--warm-pool",
+        action="store_true",
+        help="Reuse the provisioned nodes of an earlier submission if still running "
+        "(nodes idle longer than the idle timeout are still released)",
+    )
 
     parser.add_argument("--sharedfiles", action="store_false", dest="multifile")
 
@@ -78,30 +95,30 @@ def main():
         sharedconfig.location,
     )
 
+    docker_args = ["-v", "{}:{}".format(k_default_beeond_mnt, sharedconfig.beeond_map)]
+
+    # Build the AzureML Environment while the cluster is provisioned
     try:
-        clusterconnector = create_or_update_cluster(
+        clusterconnector, environment, _ = provision_cluster_and_environment(
             workspace,
             sharedconfig.cluster_name,
             args.num_nodes,
             sharedconfig.ssh_key,
             sharedconfig.vm_type,
             terminate_on_failure=args.terminate_on_failure,
+            environment_name=sharedconfig.environment_name,
+            docker_image=sharedconfig.docker_image,
+            docker_args=docker_args,
             use_beeond=True,
+            beeond_mnt=k_default_beeond_mnt,
+            topology_aware=args.topology_aware,
+            preflight=args.preflight == "abort",
+            warm_pool=args.warm_pool,
         )
     except RuntimeError:
         cprint("Fatal Error - exiting", "red", attrs=["bold"])
         sys.exit(-1)
 
-    docker_args = [
-        "-v",
-        "{}:{}".format(clusterconnector.beeond_mnt, sharedconfig.beeond_map),
-    ]
-
-    # Get and update the AzureML Environment object
-    environment = create_or_update_environment(
-        workspace, sharedconfig.environment_name, sharedconfig.docker_image, docker_args
-    )
-
     # Get/Create an experiment object
     experiment = Experiment(workspace=workspace, name=sharedconfig.experiment_name)
 
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""Phased BeeOND provisioning with per-node timing reports
+"""
+
+import json
+import os
+
+from time import monotonic
+
+from termcolor import colored, cprint
+
+k_already_running = 111
+k_phase_skipped = 112
+
+# Phases of provisioning/provision_beeond.sh in order, with the nodes they run on
+k_phases = [
+    ("check", "all"),
+    ("prereqs", "all"),
+    ("repo", "all"),
+    ("install", "all"),
+    ("configure", "all"),
+    ("build", "master"),
+    ("distribute", "master"),
+    ("install_module", "all"),
+    ("start", "master"),
+]
+
+
+class BeeONDProvisioner:
+    def __init__(self, connector, beeond_mnt, cache_dir=None, on_output=None):
+        """Runs the BeeOND provisioning phases in lockstep across a cluster
+
+        Each phase runs on all nodes (or the master) through the ClusterConnector
+        before the next starts. Phases already completed on a node are skipped by the
+        provisioning script, so reruns on the same nodes only redo what is missing.
+
+        The client kernel module is built once on the master node and cached in
+        cache_dir (by default ~/beeond-cache on the master, keyed by kernel version).
+        Unless cache_dir is a location shared by all nodes, the cached module is
+        broadcast from the master to the other nodes over IB.
+
+        Usage:
+        >>> prov = BeeONDProvisioner(cc, "/mnt/scratch")
+        >>> prov.run()
+        >>> prov.print_report()
+        """
+        self.connector = connector
+        self.beeond_mnt = beeond_mnt
+        self.cache_dir = cache_dir
+        self.on_output = on_output
+        self.timings = {}
+
+    def _command(self, phase):
+        command = "sudo bash ./provision_beeond.sh {} {}".format(self.beeond_mnt, phase)
+        if self.cache_dir is not None:
+            command += " {}".format(self.cache_dir)
+        return command
+
+    def _record(self, phase, results, duration):
+        self.timings[phase] = {
+            "duration": duration,
+            "nodes": {
+                "{}:{}".format(r.host, r.port): {
+                    "duration": r.duration,
+                    "exit_code": r.exit_code,
+                    "skipped": r.exit_code == k_phase_skipped,
+                }
+                for r in results
+            },
+        }
+
+    def _run_phase(self, phase, where):
+
+        print("Provisioning phase: {}".format(colored(phase, "green")))
+        start = monotonic()
+        with self.connector.phase(phase):
+            if phase == "distribute":
+                results = self._distribute()
+            elif where == "master":
+                results = [
+                    self.connector.run_on_master_node(
+                        self._command(phase), on_output=self.on_output, check=False
+                    )
+                ]
+            else:
+                results = self.connector.run_on_all_nodes(
+                    self._command(phase), on_output=self.on_output, check=False
+                )
+        self._record(phase, results, monotonic() - start)
+        return results
+
+    def _distribute(self):
+        """Send the cached client module from the master to all other nodes"""
+
+        if self.cache_dir is not None or len(self.connector._hosts) < 2:
+            return []
+
+        # Nothing to send if every node already installed the module
+        done = self.connector.run_on_all_nodes(
+            "test -f /var/lib/beeond-provision/install_module.done", check=False
+        )
+        if all(r.ok for r in done):
+            return []
+
+        self.connector.copy_to_master_node(
+            "provisioning/tree_broadcast.sh", "./tree_broadcast.sh"
+        )
+        return [
+            self.connector.run_on_master_node(
+                "sudo bash ./tree_broadcast.sh "
+                "$HOME/beeond-cache/beegfs-client-modules-$(uname -r).tar.gz "
+                "{}".format(self.connector.admin_username),
+                on_output=self.on_output,
+                check=False,
+            )
+        ]
+
+    def run(self):
+        """Provision BeeOND, returning False if it was already running on all nodes"""
+
+        self.timings = {}
+        for phase, where in k_phases:
+            results = self._run_phase(phase, where)
+            rcodes = [r.exit_code for r in results]
+
+            # Try to explicitly catch the "BeeOND correctly set up" state
+            if phase == "check" and any(r == k_already_running for r in rcodes):
+                if all(r == k_already_running for r in rcodes):
+                    cprint("BeeOND already running.", "green")
+                    return False
+                cprint(
+                    "Cluster not sane! BeeOND running on only some nodes. "
+                    "Delete cluster or scale to zero then try again.",
+                    "red",
+                )
+                raise RuntimeError("Cluster state is not sane. Aborting.")
+
+            if any(r not in (0, k_phase_skipped) for r in rcodes):
+                raise RuntimeError(
+                    "Provisioning phase {} failed: {}".format(
+                        phase, self.connector._failed_results_emessage(results)
+                    )
+                )
+
+        return True
+
+    def print_report(self):
+        """Print the time of each phase, its slowest node and skipped nodes"""
+
+        cprint("BeeOND provisioning times:", "green", attrs=["bold"])
+        total = 0.0
+        for phase, timing in self.timings.items():
+            total += timing["duration"]
+            nodes = timing["nodes"]
+            line = "  {:<16} {:8.1f}s".format(phase, timing["duration"])
+            if nodes:
+                slowest = max(nodes, key=lambda n: nodes[n]["duration"])
+                n_skipped = sum(n["skipped"] for n in nodes.values())
+                line += "  slowest {} ({:.1f}s)".format(
+                    slowest, nodes[slowest]["duration"]
+                )
+                if n_skipped:
+                    line += ", skipped on {} of {} nodes".format(n_skipped, len(nodes))
+            print(line)
+        print("  {:<16} {:8.1f}s".format("total", total))
+
+    def save_report(self, path):
+        """Write the per-phase, per-node timings as JSON"""
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wt") as fh:
+            json.dump(self.timings, fh, indent=2)
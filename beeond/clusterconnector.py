@@ -3,12 +3,17 @@
 """Utility classes for connecting to and managing AmlCluster nodes
 """
 
+import hashlib
+import json
 import logging
 import os
 
+from collections import deque
+from contextlib import contextmanager
+
 from termcolor import colored, cprint
 
-from time import sleep
+from time import sleep, monotonic
 
 from azureml.core.compute import AmlCompute
 from azureml.exceptions import ComputeTargetException
@@ -18,10 +23,55 @@ from tempfile import NamedTemporaryFile
 from datetime import datetime
 
 from pssh.config import HostConfig
-from pssh.clients import ParallelSSHClient, SSHClient
-from pssh.utils import enable_host_logger
+from pssh.clients import SSHClient
 
+import gevent
 from gevent import joinall
+from gevent.pool import Pool
+
+from beeondprovision import BeeONDProvisioner
+from clusterlog import open_cluster_log
+from preflight import PreflightCheck
+from topology import measure_topology, plan_placement, print_placement_report
+
+# Files at least this large are broadcast over IB by copy_to_all_nodes
+k_broadcast_min_bytes = 32 * 1024 * 1024
+
+
+class HostResult:
+    def __init__(self, host, port):
+        """Outcome of a remote command on one host
+
+        Holds the exit code (None if the command timed out or could not be run), the
+        wall time in seconds and the last lines of stdout and stderr.
+        """
+        self.host = host
+        self.port = port
+        self.exit_code = None
+        self.duration = None
+        self.timed_out = False
+        self.error = None
+        self.stdout = []
+        self.stderr = []
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+    def __repr__(self):
+        return "HostResult({}:{}, exit_code={}, duration={:.1f}s{})".format(
+            self.host,
+            self.port,
+            self.exit_code,
+            self.duration or 0.0,
+            ", timed out" if self.timed_out else "",
+        )
+
+
+def print_host_line(host, port, stream, line):
+    """Output callback echoing remote output prefixed with the host"""
+    color = "red" if stream == "stderr" else "cyan"
+    print("{} {}".format(colored("[{}:{}]".format(host, port), color), line))
 
 
 class ClusterConnector:
@@ -32,6 +82,11 @@ class ClusterConnector:
         ssh_key,
         vm_type,
         admin_username="clusteradmin",
+        inventory_ttl=60,
+        backend=None,
+        log_max_bytes=50 * 1024 * 1024,
+        log_backups=5,
+        cancel_event=None,
     ):
         """Thin wrapper class around azureml.core.compute.AmlCluster
 
@@ -43,6 +98,20 @@ class ClusterConnector:
         >>> cc.initialize(min_nodes=0, max_nodes=4, idle_timeout_secs=30)
         >>> cluster = cc.cluster
         >>> [print(node['name']) for node in cc.cluster.list_nodes()]
+
+        The node list is cached for inventory_ttl seconds; use refresh_nodes() to
+        force a refresh after changing the cluster.
+
+        backend replaces AzureML and SSH with another implementation of the cluster
+        and host clients, such as fakecluster.FakeClusterBackend for offline testing.
+
+        Remote commands, their output and results are logged as JSON lines tagged
+        with host, port, command id and phase to logfile, which is rotated every
+        log_max_bytes keeping log_backups old files (see clusterlog.py to query it).
+
+        Once cancel_event (a threading.Event) is set, the next remote command or
+        initialisation stage raises a RuntimeError, so that provisioning running in
+        another thread can be aborted.
         """
 
         self.cluster_name = cluster_name
@@ -50,33 +119,85 @@ class ClusterConnector:
         self.ssh_key = ssh_key
         self.vm_type = vm_type
         self.admin_username = admin_username
+        self.backend = backend
 
-        enable_host_logger()
-        hlog = logging.getLogger("pssh.host_logger")
         tstr = datetime.now().isoformat(timespec="minutes")
-        [
-            hlog.removeHandler(h)
-            for h in hlog.handlers
-            if isinstance(h, logging.StreamHandler)
-        ]
-        os.makedirs("clusterlogs", exist_ok=True)
-        self.logfile = "clusterlogs/{}_{}.log".format(self.workspace.name, tstr)
-        hlog.addHandler(logging.FileHandler(self.logfile))
+        self.logfile = "clusterlogs/{}_{}.jsonl".format(self.workspace.name, tstr)
+        self.log = open_cluster_log(self.logfile, log_max_bytes, log_backups)
+        self._phases = []
+        self._command_count = 0
 
         self.cluster = None
         self._master_scp = None
-        self._master_ssh = None
-        self._all_ssh = None
+        self._hosts = []
+        self._host_ssh = {}
+        self._p2p_ready = False
+
+        self.inventory_ttl = inventory_ttl
+        self._nodes = None
+        self._nodes_time = None
+        self.joined_nodes = []
+        self.departed_nodes = []
+
+        # (start, end) monotonic times of the initialisation stages
+        self.stage_times = {}
+        self.cancel_event = cancel_event
+
+    @property
+    def current_phase(self):
+        return "/".join(self._phases) or None
+
+    @contextmanager
+    def phase(self, name):
+        """Tag the log records of everything run in this context with a phase
+
+        Phases nest, e.g. "beeond/build".
+        """
+        self._phases.append(name)
+        try:
+            yield
+        finally:
+            self._phases.pop()
+
+    def _check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise RuntimeError("Cluster provisioning cancelled")
+
+    @contextmanager
+    def _stage(self, name):
+        self._check_cancelled()
+        start = monotonic()
+        try:
+            with self.phase(name):
+                yield
+        finally:
+            self.stage_times[name] = (start, monotonic())
+            self._log("stage", stage=name, duration=round(monotonic() - start, 3))
+
+    def _log(self, event, message="", level=logging.INFO, **fields):
+        fields = dict(event=event, phase=self.current_phase, **fields)
+        self.log.log(level, message, extra={"fields": fields})
 
     def initialise(self, min_nodes=0, max_nodes=0, idle_timeout_secs=1800):
         """Initialise underlying AmlCompute cluster instance"""
-        self._create_or_update_cluster(min_nodes, max_nodes, idle_timeout_secs)
-
-    def _check_logs_emessage(self, host, port):
-        msg = "Remote command failed on {}:{}. For details see {}".format(
-            host, port, self.logfile
+        with self._stage("allocate"):
+            self._create_or_update_cluster(min_nodes, max_nodes, idle_timeout_secs)
+
+    def _failed_results_emessage(self, results):
+        failed = [r for r in results if not r.ok]
+        first = failed[0]
+        msg = "Remote command failed on {} of {} nodes, first {}:{} ({})".format(
+            len(failed),
+            len(results),
+            first.host,
+            first.port,
+            "timed out" if first.timed_out else "exit code {}".format(first.exit_code),
+        )
+        if first.stderr:
+            msg += "\n" + "\n".join(first.stderr)
+        return msg + "\nFor details run\n  python clusterlog.py {} --failed".format(
+            self.logfile
         )
-        return msg
 
     def terminate(self):
 
@@ -93,16 +214,65 @@ class ClusterConnector:
         except ComputeTargetException as err:
             raise RuntimeError("Failed to terminate cluster nodes ({})".format(err))
 
-        if len(self.cluster.list_nodes()):
+        if len(self.refresh_nodes()):
             raise RuntimeError("Failed to terminate cluster nodes (nodes still running)")
 
+        # Nothing left to reuse
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
     @property
-    def cluster_nodes(self):
+    def state_file(self):
+        """Record of the provisioned cluster state for warm-pool reuse"""
+        return "clusterstate/{}_{}.json".format(self.workspace.name, self.cluster_name)
+
+    @staticmethod
+    def _node_key(node):
+        return node.get("nodeId") or (node["publicIpAddress"], node["port"])
+
+    def refresh_nodes(self):
+        """Fetch the node list from AzureML, recording joined and departed nodes"""
+
         self.cluster.refresh_state()
-        return sorted(self.cluster.list_nodes(), key=lambda n: n["port"])
+        nodes = sorted(self.cluster.list_nodes(), key=lambda n: n["port"])
+
+        if self._nodes is not None:
+            old = {self._node_key(n): n for n in self._nodes}
+            new = {self._node_key(n): n for n in nodes}
+            self.joined_nodes = [n for k, n in new.items() if k not in old]
+            self.departed_nodes = [n for k, n in old.items() if k not in new]
+            for node in self.joined_nodes:
+                cprint(
+                    "Node joined: {}:{}".format(node["publicIpAddress"], node["port"]),
+                    "yellow",
+                )
+            for node in self.departed_nodes:
+                cprint(
+                    "Node departed: {}:{}".format(node["publicIpAddress"], node["port"]),
+                    "yellow",
+                )
+
+        self._nodes = nodes
+        self._nodes_time = monotonic()
+        return nodes
+
+    @property
+    def cluster_nodes(self):
+        if self._nodes is None or monotonic() - self._nodes_time > self.inventory_ttl:
+            return self.refresh_nodes()
+        return self._nodes
 
     def _create_or_update_cluster(self, min_nodes, max_nodes, idle_timeout_secs):
 
+        if self.backend is not None:
+            self.cluster = self.backend.create_or_update_cluster(
+                self.cluster_name, min_nodes, max_nodes, idle_timeout_secs
+            )
+            self.cluster.wait_for_completion()
+            if len(self.refresh_nodes()) < min_nodes:
+                raise RuntimeError("Failed to provision sufficient nodes")
+            return
+
         try:
             self.cluster = AmlCompute(workspace=self.workspace, name=self.cluster_name)
             print(
@@ -134,9 +304,9 @@ class ClusterConnector:
 
         self.cluster.wait_for_completion()
 
-        if len(self.cluster_nodes) < min_nodes:
+        if len(self.refresh_nodes()) < min_nodes:
             sleep(30)
-            if len(self.cluster_nodes) < min_nodes:
+            if len(self.refresh_nodes()) < min_nodes:
                 raise RuntimeError("Failed to provision sufficient nodes")
 
     def _copy_nodefile_to_nodes(self):
@@ -147,63 +317,228 @@ class ClusterConnector:
 
         print("Collecting cluster IB info")
 
-        outputs = self._all_ssh.run_command(
+        results = self.run_on_all_nodes(
             r'ifconfig ib0 | grep -oe "inet[^6][adr: ]*[0-9.]*" | cut -d" " -f2',
-            shell="bash -c",
+            check=False,
         )
-        self._all_ssh.join(outputs)
 
         ibaddrs = []
-        for output in outputs:
-            host = output.host
-            port = output.client.port
-            if output.exit_code != 0:
-                print(list(output.stdout))
-                print(list(output.stderr))
+        self.ibaddr_map = {}
+        for result in results:
+            host = result.host
+            port = result.port
+            if result.exit_code != 0:
+                print(result.stdout)
+                print(result.stderr)
                 raise RuntimeError("Failed to get IB ip for {}:{}".format(host, port))
             try:
-                ibaddr = list(output.stdout)[0].split()[0]
+                ibaddr = result.stdout[0].split()[0]
             except IndexError:
                 raise RuntimeError(
                     "Failed to get IB ip for {}:{} - "
                     "No ib interface found!".format(host, port)
                 )
             print("Mapping {}:{} -> {}".format(host, port, ibaddr))
-            if port == self._master_scp.port:
+            self.ibaddr_map[(host, port)] = ibaddr
+            if (host, port) == self._hosts[0]:
                 cprint("IB Master: {}".format(ibaddr), "green")
                 ibaddrs = [ibaddr] + ibaddrs
             else:
                 ibaddrs.append(ibaddr)
 
+        self._write_nodefile(ibaddrs)
+
+    def _write_nodefile(self, ibaddrs, copy=True):
+
         with NamedTemporaryFile(delete=False, mode="wt") as nfh:
             self.nodefile = nfh.name
             for addr in ibaddrs:
                 nfh.write("{}\n".format(addr))
 
         self.ibaddrs = ibaddrs
-        self.copy_to_all_nodes(self.nodefile, "./nodefile")
+        if copy:
+            self.copy_to_all_nodes(self.nodefile, "./nodefile")
+
+    def optimise_placement(self, message_bytes=None):
+        """Reorder the BeeOND nodefile by measured IB topology
+
+        Measures the pairwise latency and bandwidth between all nodes with a quick
+        ping-pong, then picks the node closest to all others as master (and first
+        in the nodefile, where BeeOND runs its management and metadata services)
+        and orders the rest so that neighbours in the nodefile are close. The
+        nodefile and ibaddrs (passed to jobs as --ibaddrs) are rewritten in the new
+        order and the matrices saved next to the log file.
+
+        This only orders the BeeOND nodes, the tree broadcast and the ibaddrs list.
+        MPI ranks of the AzureML job are still placed by its own hostfile.
+        """
+
+        if len(getattr(self, "ibaddrs", [])) < 3:
+            return
+
+        print("Measuring IB topology")
+        self.copy_to_all_nodes("provisioning/ib_pingpong.sh", "./ib_pingpong.sh")
+        matrix = measure_topology(self)
+
+        kwargs = {} if message_bytes is None else {"message_bytes": message_bytes}
+        before = list(range(len(matrix)))
+        order = plan_placement(matrix, **kwargs)
+        print_placement_report(matrix, before, order, **kwargs)
+        matrix.save(os.path.splitext(self.logfile)[0] + "_topology.json", order)
+
+        hosts = {addr: hp for hp, addr in self.ibaddr_map.items()}
+        self._hosts = [hosts[matrix.ibaddrs[i]] for i in order]
+        self._master_scp = self._host_client(*self._hosts[0])
+        self._write_nodefile([matrix.ibaddrs[i] for i in order])
 
     def _create_cluster_ssh_conns(self):
 
         hostips = [n["publicIpAddress"] for n in self.cluster_nodes]
         hostconfigs = [HostConfig(port=n["port"]) for n in self.cluster_nodes]
 
-        self._all_ssh = ParallelSSHClient(
-            hostips, host_config=hostconfigs, user=self.admin_username
+        self._hosts = [(ip, conf.port) for ip, conf in zip(hostips, hostconfigs)]
+        self._host_ssh = {}
+
+        self._master_scp = self._host_client(*self._hosts[0])
+
+    def _host_client(self, host, port):
+        # Single host clients are created on first use and kept for reuse
+        if (host, port) not in self._host_ssh:
+            if self.backend is not None:
+                client = self.backend.ssh_client(host, port, self.admin_username)
+            else:
+                client = SSHClient(host, port=port, user=self.admin_username)
+            self._host_ssh[(host, port)] = client
+        return self._host_ssh[(host, port)]
+
+    def _run_on_host(
+        self, host, port, command, command_id, on_output, timeout, tail_lines
+    ):
+
+        result = HostResult(host, port)
+        result.stdout = deque(maxlen=tail_lines)
+        result.stderr = deque(maxlen=tail_lines)
+        start = monotonic()
+
+        def consume(lines, stream, tail):
+            for line in lines:
+                tail.append(line)
+                self._log(
+                    "output",
+                    line,
+                    level=logging.DEBUG,
+                    host=host,
+                    port=port,
+                    command_id=command_id,
+                    stream=stream,
+                )
+                if on_output is not None:
+                    on_output(host, port, stream, line)
+
+        try:
+            with gevent.Timeout(timeout):
+                client = self._host_client(host, port)
+                output = client.run_command(command, shell="bash -c")
+                joinall(
+                    [
+                        gevent.spawn(consume, output.stdout, "stdout", result.stdout),
+                        gevent.spawn(consume, output.stderr, "stderr", result.stderr),
+                    ],
+                    raise_error=True,
+                )
+                client.wait_finished(output)
+                result.exit_code = output.exit_code
+        except gevent.Timeout:
+            result.timed_out = True
+        except Exception as err:
+            result.error = err
+            result.stderr.append(str(err))
+
+        result.duration = monotonic() - start
+        result.stdout = list(result.stdout)
+        result.stderr = list(result.stderr)
+        self._log(
+            "result",
+            str(result.error or ""),
+            level=logging.INFO if result.ok else logging.WARNING,
+            host=host,
+            port=port,
+            command_id=command_id,
+            exit_code=result.exit_code,
+            duration=round(result.duration, 3),
+            timed_out=result.timed_out,
         )
+        return result
+
+    def _init_p2p_ssh(self):
+        """Let root on the master node ssh to root on all nodes"""
 
-        self._master_ssh = ParallelSSHClient(
-            hostips[:1], host_config=hostconfigs[:1], user=self.admin_username
+        if self._p2p_ready:
+            return
+
+        with NamedTemporaryFile(delete=False, mode="wt") as nfh:
+            masterkey = nfh.name
+
+        print("Creating P2P ssh keys")
+        self.copy_to_master_node(
+            "provisioning/p2p_ssh_provision.sh", "./p2p_ssh_provision.sh"
         )
+        self.run_on_master_node("bash ./p2p_ssh_provision.sh")
+        self.copy_from_master_node("./masterkey", masterkey)
 
-        self._master_scp = SSHClient(
-            hostips[0], port=hostconfigs[0].port, user=self.admin_username
+        self.copy_to_all_nodes(masterkey, "./masterkey")
+        self.run_on_all_nodes(
+            'sudo grep -qxF "$(cat masterkey)" /root/.ssh/authorized_keys '
+            "|| cat masterkey | sudo tee -a /root/.ssh/authorized_keys > /dev/null"
         )
+        self._p2p_ready = True
 
-    def copy_to_all_nodes(self, source, dest):
+    def run_preflight(self, **kwargs):
+        """Check node health, raising a RuntimeError if any node is unhealthy
 
-        copy_jobs = self._all_ssh.copy_file(source, dest)
-        joinall(copy_jobs, raise_error=True)
+        See preflight.PreflightCheck for the checks and kwargs. The per-node report
+        is printed and saved next to the log file.
+        """
+
+        check = PreflightCheck(self, **kwargs)
+        check.run()
+        check.print_report()
+        check.save_report(os.path.splitext(self.logfile)[0] + "_preflight.json")
+        check.enforce()
+        return check
+
+    def copy_to_all_nodes(self, source, dest, broadcast=None):
+        """Copy a local file to all nodes
+
+        Without broadcast the file is pushed from here to every node. With broadcast
+        it is only copied to the master node and then distributed over the IB network
+        in a binary tree of scp hops between the nodes (log2(N) rounds), so the local
+        uplink carries it only once. By default files of at least
+        k_broadcast_min_bytes are broadcast. Broadcast requires the nodefile (see
+        _copy_nodefile_to_nodes), and falls back to direct copies without it.
+        """
+
+        if broadcast is None:
+            broadcast = os.path.getsize(source) >= k_broadcast_min_bytes
+        self._log("copy", source=source, dest=dest, broadcast=broadcast)
+        if not broadcast or len(getattr(self, "ibaddrs", [])) < 2:
+            copy_jobs = [
+                gevent.spawn(self._host_client(host, port).copy_file, source, dest)
+                for host, port in self._hosts
+            ]
+            joinall(copy_jobs, raise_error=True)
+            return
+
+        self._init_p2p_ssh()
+        self.copy_to_master_node(source, dest)
+        self.copy_to_master_node(
+            "provisioning/tree_broadcast.sh", "./tree_broadcast.sh"
+        )
+        self.run_on_master_node(
+            'sudo bash ./tree_broadcast.sh "$(realpath {})" {}'.format(
+                dest, self.admin_username
+            )
+        )
 
     def copy_to_master_node(self, source, dest):
 
@@ -213,27 +548,53 @@ class ClusterConnector:
 
         self._master_scp.copy_remote_file(source, dest)
 
-    def run_on_all_nodes(self, command):
+    def run_on_all_nodes(
+        self,
+        command,
+        on_output=None,
+        timeout=None,
+        max_concurrency=None,
+        tail_lines=20,
+        check=True,
+    ):
+        """Run a command on all nodes concurrently and return a HostResult per node
+
+        on_output(host, port, stream, line) is called for each line of output as it
+        arrives (e.g. print_host_line), timeout is the limit in seconds per node and
+        max_concurrency bounds the number of nodes running the command at once. With
+        check, a RuntimeError is raised if the command failed on any node.
+        """
+        return self._run_on_hosts(
+            self._hosts, command, on_output, timeout, max_concurrency, tail_lines, check
+        )
 
-        outputs = self._all_ssh.run_command(command, shell="bash -c")
-        self._all_ssh.join(outputs, consume_output=True)
+    def run_on_master_node(self, command, on_output=None, timeout=None, check=True):
+        """Run a command on the master node and return its HostResult"""
+        return self._run_on_hosts(
+            self._hosts[:1], command, on_output, timeout, None, 20, check
+        )[0]
 
-        for output in outputs:
-            if int(output.exit_code) != 0:
-                host = output.host
-                port = output.client.port
-                raise RuntimeError(self._check_logs_emessage(host, port))
+    def _run_on_hosts(
+        self, hosts, command, on_output, timeout, max_concurrency, tail_lines, check
+    ):
 
-    def run_on_master_node(self, command):
+        self._check_cancelled()
+        self._command_count += 1
+        command_id = "c{:04d}".format(self._command_count)
+        self._log("command", command=command, command_id=command_id, hosts=len(hosts))
+
+        pool = Pool(max_concurrency or len(hosts))
+        results = pool.map(
+            lambda hp: self._run_on_host(
+                hp[0], hp[1], command, command_id, on_output, timeout, tail_lines
+            ),
+            hosts,
+        )
 
-        outputs = self._master_ssh.run_command(command, shell="bash -c")
-        self._master_ssh.join(outputs)
+        if check and not all(r.ok for r in results):
+            raise RuntimeError(self._failed_results_emessage(results))
 
-        for output in outputs:
-            if int(output.exit_code) != 0:
-                host = output.host
-                port = output.client.port
-                raise RuntimeError(self._check_logs_emessage(host, port))
+        return results
 
     def attempt_termination(self):
         try:
@@ -257,57 +618,171 @@ class ClusterConnector:
 
 
 class BeeONDClusterConnector(ClusterConnector):
-    def initialise(self, num_nodes, idle_timeout_secs=1800, beeond_mnt="/mnt/scratch"):
+    def initialise(
+        self,
+        num_nodes,
+        idle_timeout_secs=1800,
+        beeond_mnt="/mnt/scratch",
+        beeond_cache=None,
+        topology_aware=False,
+        preflight=False,
+        warm_pool=False,
+    ):
+        """Allocate num_nodes nodes and start BeeOND on them
+
+        With warm_pool the provisioned state (nodes, nodefile, IB map, BeeOND mount)
+        is saved to state_file, and the next initialise reuses the nodes without
+        provisioning if a quick check shows that state is still in place.
+
+        Note that with warm_pool the cluster minimum is reset to zero after
+        provisioning, so nodes idle for idle_timeout_secs are released even while
+        the pool is meant to be warm. Once any node is gone the saved state no
+        longer matches and the next initialise provisions from scratch.
+        """
 
         self._beeond_mnt = beeond_mnt
-        self._create_or_update_cluster(num_nodes, num_nodes, idle_timeout_secs)
-        self._create_cluster_ssh_conns()
-        self._copy_nodefile_to_nodes()
+        self._beeond_cache = beeond_cache
+
+        if warm_pool:
+            with self._stage("warm_pool"):
+                self._create_or_update_cluster(0, num_nodes, idle_timeout_secs)
+                warm = self._restore_state(num_nodes)
+            if warm:
+                if preflight:
+                    with self._stage("preflight"):
+                        self.run_preflight()
+                return
 
-        self._init_beeond()
+        with self._stage("allocate"):
+            self._create_or_update_cluster(num_nodes, num_nodes, idle_timeout_secs)
+        with self._stage("ssh"):
+            self._create_cluster_ssh_conns()
+        with self._stage("nodefile"):
+            self._copy_nodefile_to_nodes()
+        if preflight:
+            with self._stage("preflight"):
+                self.run_preflight()
+        if topology_aware:
+            with self._stage("topology"):
+                self.optimise_placement()
+
+        with self._stage("beeond"):
+            self._init_beeond()
+
+        if warm_pool:
+            self.save_state()
+            self.cluster.update(
+                min_nodes=0,
+                max_nodes=num_nodes,
+                idle_seconds_before_scaledown=idle_timeout_secs,
+            )
 
     @property
     def beeond_mnt(self):
         return self._beeond_mnt
 
-    def _init_beeond(self):
+    @staticmethod
+    def _nodefile_hash(ibaddrs):
+        content = "".join("{}\n".format(addr) for addr in ibaddrs)
+        return hashlib.md5(content.encode()).hexdigest()
+
+    def save_state(self):
+        """Record the provisioned nodes, IB map and BeeOND mount in state_file"""
+
+        state = {
+            "beeond_mnt": self.beeond_mnt,
+            "nodes": sorted(str(self._node_key(n)) for n in self.cluster_nodes),
+            "hosts": self._hosts,
+            "ibaddrs": getattr(self, "ibaddrs", []),
+            "ibaddr_map": [
+                [host, port, addr]
+                for (host, port), addr in getattr(self, "ibaddr_map", {}).items()
+            ],
+            "saved": datetime.now().isoformat(timespec="seconds"),
+        }
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with open(self.state_file, "wt") as fh:
+            json.dump(state, fh, indent=2)
+
+    def _restore_state(self, num_nodes):
+        """Reuse the state saved by save_state if the cluster still matches it
+
+        Costs one node list refresh and one command on all nodes, which checks the
+        IB address, nodefile and BeeOND mount of each node. A single node cluster
+        has no IB map or nodefile, so only its mount is checked.
+        """
 
-        with NamedTemporaryFile(delete=False, mode="wt") as nfh:
-            masterkey = nfh.name
+        def miss(reason):
+            cprint("Warm pool not reusable ({}), provisioning".format(reason), "yellow")
+            return False
 
-        print("Creating P2P ssh keys")
-        self.copy_to_master_node(
-            "provisioning/p2p_ssh_provision.sh", "./p2p_ssh_provision.sh"
+        try:
+            with open(self.state_file, "rt") as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return miss("no saved state")
+
+        if state["beeond_mnt"] != self.beeond_mnt:
+            return miss("different BeeOND mount")
+        nodes = self.refresh_nodes()
+        if len(nodes) != num_nodes:
+            return miss("{} of {} nodes allocated".format(len(nodes), num_nodes))
+        if sorted(str(self._node_key(n)) for n in nodes) != state["nodes"]:
+            return miss("node set changed")
+
+        self._create_cluster_ssh_conns()
+        if sorted(self._hosts) != sorted(tuple(hp) for hp in state["hosts"]):
+            return miss("node addresses changed")
+        self._hosts = [tuple(hp) for hp in state["hosts"]]
+        self._master_scp = self._host_client(*self._hosts[0])
+        ibaddr_map = {(host, port): addr for host, port, addr in state["ibaddr_map"]}
+
+        command = 'mount | grep -q "beegfs_ondemand on {} " && echo mounted'.format(
+            self.beeond_mnt
         )
-        self.run_on_master_node("bash ./p2p_ssh_provision.sh")
-        self.copy_from_master_node("./masterkey", masterkey)
+        if state["ibaddrs"]:
+            command = (
+                r'ifconfig ib0 | grep -oe "inet[^6][adr: ]*[0-9.]*" | cut -d" " -f2; '
+                'md5sum < nodefile | cut -d" " -f1; ' + command
+            )
+        results = self.run_on_all_nodes(command, timeout=60, check=False)
+        nodefile_hash = self._nodefile_hash(state["ibaddrs"])
+        for result in results:
+            stdout = result.stdout
+            if state["ibaddrs"]:
+                expected = [ibaddr_map.get((result.host, result.port)), nodefile_hash]
+                if stdout[:2] != expected:
+                    return miss("IB map or nodefile changed on {}".format(result.host))
+                stdout = stdout[2:]
+            if stdout != ["mounted"]:
+                return miss("BeeOND not mounted on {}".format(result.host))
+
+        if state["ibaddrs"]:
+            self.ibaddr_map = ibaddr_map
+            self._write_nodefile(state["ibaddrs"], copy=False)
+        self._p2p_ready = True
+        cprint(
+            "Reusing warm pool of {} nodes provisioned {}".format(
+                len(nodes), state["saved"]
+            ),
+            "green",
+        )
+        return True
 
-        self.copy_to_all_nodes(masterkey, "./masterkey")
+    def _init_beeond(self):
+
+        self._init_p2p_ssh()
         self.copy_to_all_nodes(
             "provisioning/provision_beeond.sh", "./provision_beeond.sh"
         )
         print("Installing BeeOND")
-        command = "sudo bash ./provision_beeond.sh {}".format(self.beeond_mnt)
-        outputs = self._all_ssh.run_command(command, shell="bash -c")
-        self._all_ssh.join(outputs, consume_output=True)
-
-        # Try to explicitly catch the "BeeOND correctly set up" state
-        rcodes = [output.exit_code for output in outputs]
-        if any(r == 111 for r in rcodes):
-            if all(r == 111 for r in rcodes):
-                cprint("BeeOND already running.", "green")
-                return
-            else:
-                cprint(
-                    "Cluster not sane! BeeOND running on only some nodes. "
-                    "Delete cluster or scale to zero then try again.",
-                    "red",
-                )
-                raise RuntimeError("Cluster state is not sane. Aborting.")
-
-        elif any(r != 0 for r in rcodes):
-            for output in outputs:
-                if output.exit_code != 0:
-                    host = output.host
-                    port = output.client.port
-                    raise RuntimeError(self._check_logs_emessage(host, port))
+        provisioner = BeeONDProvisioner(
+            self, self.beeond_mnt, cache_dir=self._beeond_cache
+        )
+        try:
+            provisioner.run()
+        finally:
+            provisioner.print_report()
+            provisioner.save_report(
+                os.path.splitext(self.logfile)[0] + "_provision.json"
+            )
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+"""Structured cluster logs and a tool to query them
+
+ClusterConnector writes one JSON object per line to clusterlogs/, rotating the
+file by size. Every record has a time, an event and the phase it happened in;
+command records also carry the host, port and command id:
+
+  {"event": "command", "command_id": "c0003", "command": "...", "phase": "beeond"}
+  {"event": "output", "command_id": "c0003", "host": ..., "stream": "stdout", ...}
+  {"event": "result", "command_id": "c0003", "host": ..., "exit_code": 0,
+   "duration": 1.2, "timed_out": false}
+
+Usage:
+  clusterlog.py clusterlogs/ws_2021-05-01T10:00.jsonl --phase beeond/build --failed
+  clusterlog.py clusterlogs/ws_2021-05-01T10:00.jsonl --latency
+"""
+
+import argparse
+import json
+import logging
+import os
+
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from termcolor import colored, cprint
+
+
+class JSONLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+        }
+        entry.update(getattr(record, "fields", {}))
+        message = record.getMessage()
+        if message:
+            entry["message"] = message
+        return json.dumps(entry, default=str)
+
+
+def open_cluster_log(path, max_bytes=50 * 1024 * 1024, backup_count=5):
+    """Return a logger writing JSON lines to path, rotated every max_bytes"""
+
+    logger = logging.getLogger("clusterlog.{}".format(os.path.abspath(path)))
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    if not logger.handlers:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count
+        )
+        handler.setFormatter(JSONLinesFormatter())
+        logger.addHandler(handler)
+    return logger
+
+
+def read_records(path):
+    """Yield the records of a log and its rotated backups, oldest first"""
+
+    backups = []
+    index = 1
+    while os.path.exists("{}.{}".format(path, index)):
+        backups.append("{}.{}".format(path, index))
+        index += 1
+
+    for logfile in list(reversed(backups)) + [path]:
+        with open(logfile, "rt") as fh:
+            for line in fh:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+
+def matches(record, args):
+
+    if args.host is not None and record.get("host") != args.host:
+        return False
+    if args.port is not None and record.get("port") != args.port:
+        return False
+    if args.phase is not None and not (record.get("phase") or "").startswith(
+        args.phase
+    ):
+        return False
+    if args.command_id is not None and record.get("command_id") != args.command_id:
+        return False
+    if args.failed and not (
+        record.get("event") == "result"
+        and (record.get("exit_code") != 0 or record.get("timed_out"))
+    ):
+        return False
+    if args.exit_code is not None and record.get("exit_code") != args.exit_code:
+        return False
+    return True
+
+
+def print_record(record):
+
+    where = ""
+    if "host" in record:
+        where = colored("[{}:{}]".format(record["host"], record["port"]), "cyan") + " "
+    tags = " ".join(
+        "{}={}".format(k, record[k])
+        for k in ("phase", "command_id", "exit_code", "duration", "timed_out")
+        if record.get(k) is not None
+    )
+    text = record.get("message") or record.get("command") or ""
+    print("{} {}{} {} {}".format(record["time"], where, record["event"], tags, text))
+
+
+def print_latencies(records):
+    """Print the distribution of per-host durations of each command"""
+
+    commands = {}
+    results = {}
+    for record in records:
+        if record.get("event") == "command":
+            commands[record["command_id"]] = record
+        elif record.get("event") == "result":
+            results.setdefault(record["command_id"], []).append(record)
+
+    cprint("Per-command latency (s):", "green", attrs=["bold"])
+    print(
+        "  {:<6} {:<20} {:>5} {:>6} {:>8} {:>8} {:>8} {:>8}  {}".format(
+            "id", "phase", "hosts", "failed", "min", "p50", "p90", "max", "slowest"
+        )
+    )
+    for command_id, host_results in results.items():
+        durations = [r["duration"] for r in host_results]
+        slowest = max(host_results, key=lambda r: r["duration"])
+        n_failed = sum(r["exit_code"] != 0 or r["timed_out"] for r in host_results)
+        command = commands.get(command_id, {})
+        failed = "{:>6}".format(n_failed)
+        print(
+            "  {:<6} {:<20} {:>5} {} {:8.2f} {:8.2f} {:8.2f} {:8.2f}  {}:{}".format(
+                command_id,
+                command.get("phase") or "-",
+                len(host_results),
+                colored(failed, "red") if n_failed else failed,
+                min(durations),
+                percentile(durations, 0.5),
+                percentile(durations, 0.9),
+                max(durations),
+                slowest["host"],
+                slowest["port"],
+            )
+        )
+        if "command" in command:
+            print("         {}".format(command["command"][:100]))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Query structured cluster logs")
+    parser.add_argument("logfile", help="Log file (rotated backups are included)")
+    parser.add_argument("--host", help="Only records of this host")
+    parser.add_argument("--port", type=int, help="Only records of this port")
+    parser.add_argument("--phase", help="Only records of this phase (or sub-phases)")
+    parser.add_argument("--command-id", help="Only records of this command")
+    parser.add_argument(
+        "--failed", action="store_true", help="Only failed or timed out results"
+    )
+    parser.add_argument("--exit-code", type=int, help="Only results with exit code")
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="Show per-command latency distributions instead of records",
+    )
+    args = parser.parse_args()
+
+    records = [r for r in read_records(args.logfile) if matches(r, args)]
+    if args.latency:
+        print_latencies(records)
+    else:
+        for record in records:
+            print_record(record)
+
+
+if __name__ == "__main__":
+    main()
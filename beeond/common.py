@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 
+import asyncio
 import os.path
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
 from termcolor import colored, cprint
 
 from azureml.core import Workspace, Environment
@@ -8,6 +13,18 @@ from azureml.exceptions import WorkspaceException
 
 from clusterconnector import BeeONDClusterConnector, ClusterConnector
 
+k_default_beeond_mnt = "/mnt/scratch"
+
+
+@contextmanager
+def _timed_stage(stage_times, name):
+    start = monotonic()
+    try:
+        yield
+    finally:
+        if stage_times is not None:
+            stage_times[name] = (start, monotonic())
+
 
 def get_or_create_workspace(
     subscription, resource_group, workspace_name, location, **kwargs
@@ -73,6 +90,28 @@ def create_or_update_environment(workspace, name, docker_image, docker_args=None
     return environment
 
 
+def build_environment(
+    workspace, name, docker_image, docker_args=None, stage_times=None
+):
+    """Register the environment and build its Docker image ahead of the first run
+
+    Without the build the image is only built when the first run is submitted.
+    stage_times, if given, receives the (start, end) times of each stage.
+    """
+
+    with _timed_stage(stage_times, "register"):
+        environment = create_or_update_environment(
+            workspace, name, docker_image, docker_args
+        )
+
+    with _timed_stage(stage_times, "build"):
+        cprint('Building image for environment "{}"'.format(name), "green")
+        build = environment.build(workspace)
+        build.wait_for_completion(show_output=False)
+
+    return environment
+
+
 def create_or_update_cluster(
     workspace,
     cluster_name,
@@ -81,6 +120,10 @@ def create_or_update_cluster(
     vm_type,
     terminate_on_failure,
     use_beeond=False,
+    beeond_mnt=k_default_beeond_mnt,
+    topology_aware=False,
+    preflight=False,
+    warm_pool=False,
     **kwargs
 ):
 
@@ -88,7 +131,13 @@ def create_or_update_cluster(
     init_args = {"min_nodes": 0, "max_nodes": num_nodes}
     if use_beeond:
         ClusterClass = BeeONDClusterConnector
-        init_args = {"num_nodes": num_nodes}
+        init_args = {
+            "num_nodes": num_nodes,
+            "beeond_mnt": beeond_mnt,
+            "topology_aware": topology_aware,
+            "preflight": preflight,
+            "warm_pool": warm_pool,
+        }
 
     cprint("Provisioning Cluster:", "green", attrs=["bold"])
     try:
@@ -115,3 +164,193 @@ def create_or_update_cluster(
     cprint("Cluster creation complete.", "green", attrs=["bold"])
 
     return clusterconnector
+
+
+class ProvisioningTimeline:
+    def __init__(self):
+        """Start and end times of concurrently run provisioning tasks and their stages"""
+        self.origin = monotonic()
+        self.tasks = {}
+        self.stages = {}
+
+    @property
+    def critical_task(self):
+        return max(self.tasks, key=lambda t: self.tasks[t][1], default=None)
+
+    def _span(self, start, end):
+        return "{:8.1f}s -> {:8.1f}s ({:.1f}s)".format(
+            start - self.origin, end - self.origin, end - start
+        )
+
+    def print_report(self):
+        """Print each task and its stages, marking the task on the critical path"""
+
+        cprint("Provisioning timeline:", "green", attrs=["bold"])
+        critical = self.critical_task
+        ready = self.tasks[critical][1] - self.origin if critical else 0.0
+        for task, (start, end) in self.tasks.items():
+            note = (
+                colored("critical path", "yellow")
+                if task == critical
+                else "slack {:.1f}s".format(ready - (end - self.origin))
+            )
+            print("  {:<14} {}  {}".format(task, self._span(start, end), note))
+            for stage, (s_start, s_end) in self.stages.get(task, {}).items():
+                print("    {:<12} {}".format(stage, self._span(s_start, s_end)))
+
+        sequential = sum(end - start for start, end in self.tasks.values())
+        print(
+            "  Ready after {:.1f}s, sequential provisioning would take {:.1f}s "
+            "(saved {:.1f}s)".format(ready, sequential, sequential - ready)
+        )
+
+
+def _settle(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+async def _run_task(timeline, name, func, *args, **kwargs):
+    # Blocking azureml and ssh calls are run in daemon threads, so that a task
+    # abandoned after the other one failed does not hold up the exit
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def run():
+        try:
+            outcome = (func(*args, **kwargs), None)
+        except Exception as err:
+            outcome = (None, err)
+        try:
+            loop.call_soon_threadsafe(_settle, future, *outcome)
+        except RuntimeError:
+            # The event loop has already finished
+            pass
+
+    start = monotonic()
+    threading.Thread(target=run, name=name, daemon=True).start()
+    try:
+        return await future
+    finally:
+        timeline.tasks[name] = (start, monotonic())
+
+
+def _outcome(task):
+    # Result or exception of a finished task, None if it was abandoned
+    if not task.done():
+        return None
+    return task.exception() or task.result()
+
+
+def provision_cluster_and_environment(
+    workspace,
+    cluster_name,
+    num_nodes,
+    ssh_key,
+    vm_type,
+    terminate_on_failure,
+    environment_name,
+    docker_image,
+    docker_args=None,
+    use_beeond=False,
+    beeond_mnt=k_default_beeond_mnt,
+    topology_aware=False,
+    preflight=False,
+    warm_pool=False,
+    **kwargs
+):
+    """Provision the cluster while building the environment image
+
+    Node allocation, SSH setup and BeeOND provisioning run concurrently with the
+    environment registration and Docker image build, so the time until the job can
+    start is that of the longest task rather than the sum. docker_args must be known
+    up front; BeeOND is mounted at beeond_mnt. With topology_aware the BeeOND
+    nodefile is ordered by measured IB topology (see
+    ClusterConnector.optimise_placement), and
+    with preflight node health checks run before BeeOND starts, aborting the
+    submission if any node is unhealthy.
+    With warm_pool a still provisioned cluster from an earlier submission is reused
+    (see BeeONDClusterConnector.initialise).
+
+    If either task fails the other is not waited for: a failed environment build
+    cancels the cluster provisioning at its next remote command, after which the
+    cluster is torn down as on any provisioning failure, and a failed cluster
+    provisioning abandons the wait for the image build.
+
+    Returns the cluster connector, the environment and the ProvisioningTimeline,
+    whose report is printed once both tasks have finished.
+    """
+
+    timeline = ProvisioningTimeline()
+    environment_stages = timeline.stages.setdefault("environment", {})
+    cancel_event = threading.Event()
+
+    async def provision():
+        cluster = asyncio.ensure_future(
+            _run_task(
+                timeline,
+                "cluster",
+                create_or_update_cluster,
+                workspace,
+                cluster_name,
+                num_nodes,
+                ssh_key,
+                vm_type,
+                terminate_on_failure,
+                use_beeond=use_beeond,
+                beeond_mnt=beeond_mnt,
+                topology_aware=topology_aware,
+                preflight=preflight,
+                warm_pool=warm_pool,
+                cancel_event=cancel_event,
+                **kwargs,
+            )
+        )
+        environment = asyncio.ensure_future(
+            _run_task(
+                timeline,
+                "environment",
+                build_environment,
+                workspace,
+                environment_name,
+                docker_image,
+                docker_args,
+                stage_times=environment_stages,
+            )
+        )
+        await asyncio.wait(
+            [cluster, environment], return_when=asyncio.FIRST_EXCEPTION
+        )
+        if isinstance(_outcome(environment), Exception) and not cluster.done():
+            # Abort at the next remote command; the cluster is then torn down
+            cancel_event.set()
+            await asyncio.wait([cluster])
+        return _outcome(cluster), _outcome(environment)
+
+    clusterconnector, environment = asyncio.run(provision())
+
+    if isinstance(clusterconnector, ClusterConnector):
+        timeline.stages["cluster"] = clusterconnector.stage_times
+    timeline.print_report()
+
+    if isinstance(environment, Exception):
+        cprint("Environment build failed:\n", "red", attrs=["bold"])
+        cprint(environment, "red")
+        # A cancelled cluster provisioning was handled by create_or_update_cluster
+        if isinstance(clusterconnector, Exception):
+            raise environment
+        if terminate_on_failure:
+            cprint("Attempting to terminate cluster nodes:", "red", attrs=["bold"])
+            clusterconnector.attempt_termination()
+        else:
+            clusterconnector.warn_unterminated()
+        raise environment
+    # Cluster failures are already handled by create_or_update_cluster
+    if isinstance(clusterconnector, Exception):
+        raise clusterconnector
+
+    return clusterconnector, environment, timeline
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+
+"""Local fake cluster backend for ClusterConnector
+
+Simulates an AmlCompute cluster of N nodes on this machine so that the
+provisioning and fan-out code paths can be tested and benchmarked offline:
+
+>>> backend = FakeClusterBackend("/tmp/fakecluster", executor=ScriptedExecutor())
+>>> cc = BeeONDClusterConnector(workspace, "fake", sshkey, "fake", backend=backend)
+>>> cc.initialise(num_nodes=64)
+
+Each node has its own home directory under the backend root. Commands are run
+by an executor: by default ScriptedExecutor answers them from rules with
+simulated durations, which is enough to exercise BeeOND provisioning at
+hundreds of nodes. LocalShellExecutor runs them with bash in the node's home
+directory (with stand-ins for sudo and ifconfig); it must be passed explicitly
+and refuses the BeeOND provisioning script, which would change this machine.
+"""
+
+import argparse
+import hashlib
+import math
+import os
+import re
+import shutil
+
+from types import SimpleNamespace
+from time import monotonic
+
+import gevent
+import gevent.subprocess
+from gevent.queue import Queue
+
+from termcolor import cprint
+
+k_base_port = 50000
+
+k_sudo_shim = """#!/bin/bash
+while [[ "$1" == -* ]]; do shift; done
+exec "$@"
+"""
+
+k_ifconfig_shim = """#!/bin/bash
+echo "ib0: flags=4163<UP,BROADCAST,RUNNING,MULTICAST>  mtu 2044"
+echo "        inet ${FAKE_IBADDR}  netmask 255.255.0.0"
+"""
+
+
+class FakeNode:
+    def __init__(self, index, root):
+        """A simulated cluster node with its own home directory"""
+        self.index = index
+        self.port = k_base_port + index
+        self.node_id = "fake-node-{:04d}".format(index)
+        self.ibaddr = "10.0.{}.{}".format(index // 250, index % 250 + 1)
+        self.home = os.path.join(root, "node{:04d}".format(index))
+        # Provisioning state for ScriptedExecutor
+        self.completed = set()
+        os.makedirs(self.home, exist_ok=True)
+
+    def as_dict(self):
+        # Same keys as AmlCompute.list_nodes()
+        return {
+            "nodeId": self.node_id,
+            "port": self.port,
+            "publicIpAddress": "127.0.0.1",
+            "privateIpAddress": self.ibaddr,
+            "nodeState": "idle",
+        }
+
+
+class FakeCompute:
+    def __init__(self, backend, name):
+        """Stands in for azureml.core.compute.AmlCompute"""
+        self.backend = backend
+        self.name = name
+        self._target_nodes = 0
+
+    def update(self, min_nodes=0, max_nodes=0, idle_seconds_before_scaledown=None):
+        # Allocated nodes above the minimum stay until scaled down when idle
+        self._target_nodes = min(max(min_nodes, len(self.backend.nodes)), max_nodes)
+
+    def wait_for_completion(self, show_output=False):
+        gevent.sleep(self.backend.allocation_time)
+        self.backend.scale(self._target_nodes)
+
+    def refresh_state(self):
+        gevent.sleep(self.backend.management_latency)
+
+    def list_nodes(self):
+        return [node.as_dict() for node in self.backend.nodes]
+
+
+class FakeHostOutput:
+    def __init__(self):
+        """Output of a command on a fake node, streamed through queues"""
+        self.stdout_queue = Queue()
+        self.stderr_queue = Queue()
+        self.stdout = iter(self.stdout_queue)
+        self.stderr = iter(self.stderr_queue)
+        self.exit_code = None
+        self.greenlet = None
+
+
+class FakeSSHClient:
+    def __init__(self, backend, node):
+        """Stands in for pssh SSHClient on a fake node"""
+        self.backend = backend
+        self.node = node
+        self.port = node.port
+
+    def run_command(self, command, shell=None):
+        output = FakeHostOutput()
+
+        def run():
+            try:
+                output.exit_code = self.backend.executor.run(
+                    self.backend,
+                    self.node,
+                    command,
+                    output.stdout_queue.put,
+                    output.stderr_queue.put,
+                )
+            finally:
+                output.stdout_queue.put(StopIteration)
+                output.stderr_queue.put(StopIteration)
+
+        output.greenlet = gevent.spawn(run)
+        return output
+
+    def wait_finished(self, output, timeout=None):
+        output.greenlet.join(timeout=timeout)
+
+    def _node_path(self, path):
+        path = path[2:] if path.startswith("~/") else path.lstrip("/")
+        return os.path.join(self.node.home, path)
+
+    def copy_file(self, local_file, remote_file):
+        gevent.sleep(self.backend.copy_latency)
+        shutil.copyfile(local_file, self._node_path(remote_file))
+
+    def copy_remote_file(self, remote_file, local_file):
+        gevent.sleep(self.backend.copy_latency)
+        shutil.copyfile(self._node_path(remote_file), local_file)
+
+
+class LocalShellExecutor:
+    """Runs commands with bash in the home directory of the fake node
+
+    sudo runs the command as the current user and ifconfig reports the node's
+    fake IB address, so that the nodefile collection works unchanged. Commands
+    running provision_beeond.sh (package installs, /etc changes, BeeOND start)
+    fail unless allow_provisioning is set.
+    """
+
+    def __init__(self, allow_provisioning=False):
+        self.allow_provisioning = allow_provisioning
+
+    def run(self, backend, node, command, on_stdout, on_stderr):
+        if "provision_beeond.sh" in command and not self.allow_provisioning:
+            on_stderr("LocalShellExecutor: refusing to run provision_beeond.sh")
+            return 1
+        env = dict(os.environ)
+        env["HOME"] = node.home
+        env["FAKE_IBADDR"] = node.ibaddr
+        env["PATH"] = backend.shim_dir + os.pathsep + env.get("PATH", "")
+        proc = gevent.subprocess.Popen(
+            ["bash", "-c", command],
+            cwd=node.home,
+            env=env,
+            stdout=gevent.subprocess.PIPE,
+            stderr=gevent.subprocess.PIPE,
+            universal_newlines=True,
+        )
+
+        def forward(pipe, callback):
+            for line in pipe:
+                callback(line.rstrip("\n"))
+
+        gevent.joinall(
+            [
+                gevent.spawn(forward, proc.stdout, on_stdout),
+                gevent.spawn(forward, proc.stderr, on_stderr),
+            ]
+        )
+        return proc.wait()
+
+
+class ScriptedExecutor:
+    """Answers commands from rules, simulating their duration
+
+    rules is a list of (regex, handler) pairs. The first rule matching the command
+    is called as handler(backend, node, match, on_stdout) and returns the exit code;
+    unmatched commands succeed immediately. The default rules model the commands
+    used by ClusterConnector and BeeOND provisioning, with phase durations in
+    seconds taken from phase_times.
+
+    IB ping-pongs see nodes in racks of rack_size, with consecutive nodes placed in
+    different racks so that the default node order is a poor placement. Pre-flight
+    checks report default_health, overridden per node index by node_health.
+    """
+
+    default_phase_times = {
+        "check": 0.1,
+        "prereqs": 2.0,
+        "repo": 3.0,
+        "install": 5.0,
+        "configure": 0.2,
+        "build": 30.0,
+        "install_module": 0.5,
+        "start": 10.0,
+    }
+
+    default_health = {
+        "ib_state": 1,
+        "ib_rate_gbps": 100,
+        "ib_bw_MBps": 6000,
+        "disk_MBps": 900,
+        "disk_free_GB": 600,
+        "gpus": 8,
+        "mem_free_GB": 600,
+    }
+
+    def __init__(
+        self, rules=None, phase_times=None, hop_time=1.0, rack_size=16, node_health=None
+    ):
+        self.phase_times = dict(self.default_phase_times, **(phase_times or {}))
+        self.hop_time = hop_time
+        self.rack_size = rack_size
+        self.node_health = node_health or {}
+        self.rules = [(re.compile(r), h) for r, h in (rules or [])] + [
+            (re.compile(r"(md5sum < nodefile)|beegfs_ondemand on"), self._warm_check),
+            (re.compile(r"ifconfig ib0"), self._ifconfig),
+            (re.compile(r"provision_beeond\.sh \S+ (\w+)"), self._provision_phase),
+            (re.compile(r"p2p_ssh_provision\.sh"), self._p2p_keys),
+            (re.compile(r"tree_broadcast\.sh"), self._broadcast),
+            (re.compile(r"ib_pingpong\.sh \S+ \d+ (\d+)"), self._pingpong),
+            (re.compile(r"preflight_checks\.sh"), self._preflight),
+            (re.compile(r"test -f \S+/(\w+)\.done"), self._test_done),
+        ]
+
+    def run(self, backend, node, command, on_stdout, on_stderr):
+        for regex, handler in self.rules:
+            match = regex.search(command)
+            if match:
+                return handler(backend, node, match, on_stdout)
+        return 0
+
+    def _ifconfig(self, backend, node, match, on_stdout):
+        on_stdout(node.ibaddr)
+        return 0
+
+    def _warm_check(self, backend, node, match, on_stdout):
+        if match.group(1):
+            on_stdout(node.ibaddr)
+            try:
+                with open(os.path.join(node.home, "nodefile"), "rb") as fh:
+                    on_stdout(hashlib.md5(fh.read()).hexdigest())
+            except OSError:
+                return 1
+        if backend.beeond_running:
+            on_stdout("mounted")
+        return 0
+
+    def _p2p_keys(self, backend, node, match, on_stdout):
+        with open(os.path.join(node.home, "masterkey"), "wt") as fh:
+            fh.write("ssh-rsa FAKEKEY root@{}\n".format(node.node_id))
+        return 0
+
+    def _broadcast(self, backend, node, match, on_stdout):
+        rounds = math.ceil(math.log2(max(len(backend.nodes), 1)))
+        gevent.sleep(rounds * self.hop_time)
+        return 0
+
+    def _pingpong(self, backend, node, match, on_stdout):
+        size = int(match.group(1))
+        n_racks = math.ceil(len(backend.nodes) / self.rack_size)
+        for other in backend.nodes:
+            if other is node:
+                continue
+            same_rack = node.index % n_racks == other.index % n_racks
+            # One-way latency (us) and bandwidth (MB/s) within and across racks
+            latency, bandwidth = (1.5, 12000.0) if same_rack else (4.0, 6000.0)
+            small = 2 * latency
+            on_stdout(
+                "{} {:.1f} {:.1f}".format(
+                    other.ibaddr, small, small + 2 * size / bandwidth
+                )
+            )
+        return 0
+
+    def _preflight(self, backend, node, match, on_stdout):
+        health = dict(self.default_health, **self.node_health.get(node.index, {}))
+        for check, value in health.items():
+            on_stdout("{} {}".format(check, "-" if value is None else value))
+        return 0
+
+    def _test_done(self, backend, node, match, on_stdout):
+        return 0 if match.group(1) in node.completed else 1
+
+    def _provision_phase(self, backend, node, match, on_stdout):
+        phase = match.group(1)
+        if phase == "check":
+            return 111 if backend.beeond_running else 0
+        if phase in node.completed and phase != "start":
+            on_stdout("Phase {} already completed. Skipping".format(phase))
+            return 112
+        duration = self.phase_times.get(phase, 0.0)
+        if phase == "build" and backend.module_cached:
+            duration = 0.0
+        gevent.sleep(duration)
+        if phase == "build":
+            backend.module_cached = True
+        if phase == "start":
+            backend.beeond_running = True
+        node.completed.add(phase)
+        return 0
+
+
+class FakeClusterBackend:
+    def __init__(
+        self,
+        root,
+        executor=None,
+        allocation_time=0.0,
+        management_latency=0.0,
+        copy_latency=0.0,
+    ):
+        """Cluster backend simulating nodes on the local machine
+
+        Commands are answered by executor, a ScriptedExecutor unless given.
+        allocation_time, management_latency and copy_latency (seconds) simulate the
+        time to allocate nodes, of a node list refresh and of a file copy.
+        """
+        self.root = root
+        self.executor = executor or ScriptedExecutor()
+        self.allocation_time = allocation_time
+        self.management_latency = management_latency
+        self.copy_latency = copy_latency
+        self.nodes = []
+        self.beeond_running = False
+        self.module_cached = False
+
+        self.shim_dir = os.path.join(root, "bin")
+        os.makedirs(self.shim_dir, exist_ok=True)
+        for name, script in [("sudo", k_sudo_shim), ("ifconfig", k_ifconfig_shim)]:
+            path = os.path.join(self.shim_dir, name)
+            with open(path, "wt") as fh:
+                fh.write(script)
+            os.chmod(path, 0o755)
+
+    def scale(self, num_nodes):
+        # Nodes that stay allocated keep their state, as on a real cluster
+        self.nodes = self.nodes[:num_nodes] + [
+            FakeNode(i, self.root) for i in range(len(self.nodes), num_nodes)
+        ]
+        if num_nodes == 0:
+            self.beeond_running = False
+
+    def create_or_update_cluster(self, name, min_nodes, max_nodes, idle_timeout_secs):
+        cluster = FakeCompute(self, name)
+        cluster.update(min_nodes=min_nodes, max_nodes=max_nodes)
+        return cluster
+
+    def scale_down_idle(self):
+        """Deallocate all nodes, as the idle timeout does"""
+        self.scale(0)
+
+    def ssh_client(self, host, port, user):
+        return FakeSSHClient(self, self.nodes[port - k_base_port])
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark BeeOND provisioning on a simulated cluster"
+    )
+    parser.add_argument("num_nodes", type=int, help="Number of simulated nodes")
+    parser.add_argument("--root", default="fakecluster", help="Node directory root")
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=0.01,
+        help="Scale factor for the simulated phase durations",
+    )
+    parser.add_argument(
+        "--rerun", action="store_true", help="Provision a second time on the same nodes"
+    )
+    parser.add_argument(
+        "--warm-pool",
+        action="store_true",
+        help="Keep BeeOND running between reruns and reuse the provisioned nodes",
+    )
+    parser.add_argument(
+        "--topology-aware",
+        action="store_true",
+        help="Order the nodes by the simulated IB topology",
+    )
+    parser.add_argument(
+        "--preflight",
+        action="store_true",
+        help="Run node health checks, aborting if any node is unhealthy",
+    )
+    parser.add_argument(
+        "--degraded",
+        type=int,
+        default=0,
+        help="Number of simulated nodes with a slow disk",
+    )
+    args = parser.parse_args()
+
+    from clusterconnector import BeeONDClusterConnector
+
+    phase_times = {
+        k: v * args.time_scale for k, v in ScriptedExecutor.default_phase_times.items()
+    }
+    node_health = {
+        i: {"disk_MBps": 100}
+        for i in range(args.num_nodes - args.degraded, args.num_nodes)
+    }
+    executor = ScriptedExecutor(
+        phase_times=phase_times, hop_time=args.time_scale, node_health=node_health
+    )
+    backend = FakeClusterBackend(args.root, executor=executor)
+    workspace = SimpleNamespace(name="fakecluster")
+
+    for attempt in range(2 if args.rerun else 1):
+        start = monotonic()
+        connector = BeeONDClusterConnector(
+            workspace, "fakecluster", "", "fake", backend=backend
+        )
+        connector.initialise(
+            args.num_nodes,
+            topology_aware=args.topology_aware,
+            preflight=args.preflight,
+            warm_pool=args.warm_pool,
+        )
+        cprint(
+            "Provisioned {} simulated nodes in {:.2f}s".format(
+                args.num_nodes, monotonic() - start
+            ),
+            "green",
+            attrs=["bold"],
+        )
+        if not args.warm_pool:
+            # Simulate the BeeOND filesystem being stopped between jobs
+            backend.beeond_running = False
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""Node health pre-flight checks
+"""
+
+import json
+import os
+import statistics
+
+from termcolor import colored, cprint
+
+# Minimum absolute values of the checks reported by preflight_checks.sh
+k_default_thresholds = {
+    "ib_state": 1,
+    "disk_free_GB": 20,
+    "mem_free_GB": 16,
+}
+
+# Minimum values of performance checks as a fraction of the cluster median
+k_default_relative_thresholds = {
+    "ib_rate_gbps": 1.0,
+    "ib_bw_MBps": 0.5,
+    "disk_MBps": 0.5,
+    "gpus": 1.0,
+}
+
+k_checks = [
+    "ib_state",
+    "ib_rate_gbps",
+    "ib_bw_MBps",
+    "disk_MBps",
+    "disk_free_GB",
+    "gpus",
+    "mem_free_GB",
+]
+
+
+class NodeHealth:
+    def __init__(self, result):
+        """Pre-flight check values of one node, parsed from its HostResult"""
+        self.host = result.host
+        self.port = result.port
+        self.values = {}
+        self.failures = []
+        if result.timed_out:
+            self.failures.append("timed out")
+        elif not result.ok:
+            self.failures.append("exit code {}".format(result.exit_code))
+        for line in result.stdout:
+            try:
+                check, value = line.split()
+                self.values[check] = None if value == "-" else float(value)
+            except ValueError:
+                continue
+
+    @property
+    def healthy(self):
+        return not self.failures
+
+
+class PreflightCheck:
+    def __init__(
+        self,
+        connector,
+        disk_path="/mnt/resource",
+        thresholds=None,
+        relative_thresholds=None,
+        disk_test_mb=256,
+        timeout=120,
+        on_output=None,
+    ):
+        """Checks the health of all cluster nodes before a job is submitted
+
+        Runs provisioning/preflight_checks.sh on all nodes in parallel: IB link
+        state and rate, a ping-pong bandwidth probe to the next node in the
+        nodefile, direct write speed and free space on disk_path (the BeeOND
+        backing storage), GPU count and free memory. A node is unhealthy if a value
+        is below its absolute threshold, below its relative threshold times the
+        cluster median, missing while other nodes report it, or if the checks
+        failed or took longer than timeout seconds.
+
+        Usage:
+        >>> check = PreflightCheck(cc)
+        >>> check.run()
+        >>> check.print_report()
+        >>> check.enforce()
+        """
+        self.connector = connector
+        self.disk_path = disk_path
+        self.thresholds = dict(k_default_thresholds, **(thresholds or {}))
+        self.relative_thresholds = dict(
+            k_default_relative_thresholds, **(relative_thresholds or {})
+        )
+        self.disk_test_mb = disk_test_mb
+        self.timeout = timeout
+        self.on_output = on_output
+        self.nodes = []
+        self.medians = {}
+
+    def run(self):
+        """Run the checks on all nodes, returning the unhealthy nodes"""
+
+        self.connector.copy_to_all_nodes(
+            "provisioning/preflight_checks.sh", "./preflight_checks.sh"
+        )
+        results = self.connector.run_on_all_nodes(
+            "sudo bash ./preflight_checks.sh {} {}".format(
+                self.disk_path, self.disk_test_mb
+            ),
+            on_output=self.on_output,
+            timeout=self.timeout,
+            check=False,
+        )
+        self.nodes = [NodeHealth(r) for r in results]
+        self._evaluate()
+        return self.unhealthy
+
+    def _evaluate(self):
+
+        for check in k_checks:
+            values = [n.values.get(check) for n in self.nodes]
+            measured = [v for v in values if v is not None]
+            if not measured:
+                continue
+            self.medians[check] = statistics.median(measured)
+
+            limit = self.thresholds.get(check)
+            if check in self.relative_thresholds:
+                relative = self.relative_thresholds[check] * self.medians[check]
+                limit = relative if limit is None else max(limit, relative)
+
+            for node, value in zip(self.nodes, values):
+                if value is None:
+                    node.failures.append("{} not measured".format(check))
+                elif limit is not None and value < limit:
+                    node.failures.append(
+                        "{} {:g} < {:g}".format(check, value, round(limit, 1))
+                    )
+
+    @property
+    def unhealthy(self):
+        return [n for n in self.nodes if not n.healthy]
+
+    def print_report(self):
+        """Print the check values of each node, marking failed checks"""
+
+        cprint("Node pre-flight checks:", "green", attrs=["bold"])
+        print(
+            "  {:<22} ".format("node")
+            + " ".join("{:>12}".format(c) for c in k_checks)
+        )
+        print(
+            "  {:<22} ".format("median")
+            + " ".join("{:>12g}".format(self.medians.get(c, 0)) for c in k_checks)
+        )
+        for node in self.nodes:
+            failed = {f.split()[0] for f in node.failures}
+            cells = []
+            for check in k_checks:
+                value = node.values.get(check)
+                cell = "{:>12}".format("-" if value is None else "{:g}".format(value))
+                cells.append(colored(cell, "red") if check in failed else cell)
+            name = "{}:{}".format(node.host, node.port)
+            print("  {:<22} ".format(name) + " ".join(cells))
+            if not node.healthy:
+                cprint("    unhealthy: {}".format(", ".join(node.failures)), "red")
+
+        n_bad = len(self.unhealthy)
+        cprint(
+            "  {} of {} nodes healthy".format(len(self.nodes) - n_bad, len(self.nodes)),
+            "red" if n_bad else "green",
+        )
+
+    def save_report(self, path):
+        """Write the per-node check values and failures as JSON"""
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wt") as fh:
+            json.dump(
+                {
+                    "medians": self.medians,
+                    "nodes": {
+                        "{}:{}".format(n.host, n.port): {
+                            "values": n.values,
+                            "failures": n.failures,
+                        }
+                        for n in self.nodes
+                    },
+                },
+                fh,
+                indent=2,
+            )
+
+    def enforce(self):
+        """Raise a RuntimeError if any node is unhealthy
+
+        Unhealthy nodes cannot be left out of the job: AzureML places the MPI ranks
+        on any allocated node of the cluster, so the submission is aborted instead.
+        """
+
+        unhealthy = self.unhealthy
+        if not unhealthy:
+            return
+
+        raise RuntimeError(
+            "Pre-flight checks failed on {} of {} nodes, first {}:{} ({})".format(
+                len(unhealthy),
+                len(self.nodes),
+                unhealthy[0].host,
+                unhealthy[0].port,
+                ", ".join(unhealthy[0].failures),
+            )
+        )
@@ -0,0 +1,30 @@
+#!/bin/bash
+
+# Measure round trip times from this node to all other nodes in the nodefile
+#
+# Usage: ib_pingpong.sh [nodefile] [count] [size]
+#
+# Runs as root (for sub-200ms ping intervals). For every other node prints
+# "<ibaddr> <small rtt> <large rtt>" with the average round trip times in
+# microseconds of 56 byte and <size> byte pings over ib0, or "-" if the node
+# did not answer. See topology.py for the latency/bandwidth estimate.
+
+nodefile=${1:-nodefile}
+count=${2:-5}
+size=${3:-32768}
+
+self=$(ifconfig ib0 | grep -oe "inet[^6][adr: ]*[0-9.]*" | cut -d" " -f2)
+
+rtt() {
+  local res
+  res=$(ping -q -c $count -i 0.01 -W 1 -s $2 $1 2> /dev/null | \
+    awk -F/ '/^rtt|^round-trip/ {printf "%.1f", $5 * 1000}')
+  echo ${res:--}
+}
+
+while read addr; do
+  if [ -z "$addr" ] || [ "$addr" == "$self" ]; then
+    continue
+  fi
+  echo "$addr $(rtt $addr 56) $(rtt $addr $size)"
+done < $nodefile
@@ -0,0 +1,75 @@
+#!/bin/bash
+
+# Node health pre-flight checks
+#
+# Usage: preflight_checks.sh <disk path> [disk test MB] [nodefile]
+#
+# Runs as root. Prints "<check> <value>" lines, with "-" for values that
+# could not be measured (see preflight.py for the thresholds):
+#   ib_state      1 if an IB port is ACTIVE and ib0 has an address, else 0
+#   ib_rate_gbps  link rate of the first active IB port
+#   ib_bw_MBps    ping-pong bandwidth estimate to the next node in the nodefile
+#   disk_MBps     direct write speed to <disk path>
+#   disk_free_GB  free space on <disk path>
+#   gpus          number of GPUs answering nvidia-smi
+#   mem_free_GB   available memory
+
+disk_path=$1
+disk_mb=${2:-256}
+nodefile=${3:-nodefile}
+probe_size=32768
+
+# InfiniBand
+self=$(ifconfig ib0 2> /dev/null | grep -oe "inet[^6][adr: ]*[0-9.]*" | cut -d" " -f2)
+port=$(grep -l ACTIVE /sys/class/infiniband/*/ports/*/state 2> /dev/null | head -1)
+if [ -n "$self" ] && [ -n "$port" ]; then
+  echo "ib_state 1"
+  echo "ib_rate_gbps $(awk '{print $1}' $(dirname $port)/rate)"
+else
+  echo "ib_state 0"
+  echo "ib_rate_gbps -"
+fi
+
+rtt() {
+  ping -q -c 10 -i 0.01 -W 1 -s $2 $1 2> /dev/null | \
+    awk -F/ '/^rtt|^round-trip/ {print $5 * 1000}'
+}
+
+peer=""
+if [ -n "$self" ] && [ -f $nodefile ]; then
+  mapfile -t nodes < $nodefile
+  for i in "${!nodes[@]}"; do
+    if [ "${nodes[$i]}" == "$self" ]; then
+      peer=${nodes[$(( (i + 1) % ${#nodes[@]} ))]}
+    fi
+  done
+fi
+small=""
+large=""
+if [ -n "$peer" ] && [ "$peer" != "$self" ]; then
+  small=$(rtt $peer 56)
+  large=$(rtt $peer $probe_size)
+fi
+if [ -n "$small" ] && [ -n "$large" ]; then
+  awk -v s=$small -v l=$large -v n=$probe_size \
+    'BEGIN {d = l - s; if (d < 0.001) d = 0.001; printf "ib_bw_MBps %.0f\n", 2 * (n + 28) / d}'
+else
+  echo "ib_bw_MBps -"
+fi
+
+# Disk
+testfile=$disk_path/.preflight.$$
+speed=$(dd if=/dev/zero of=$testfile bs=1M count=$disk_mb oflag=direct conv=fsync 2>&1 | \
+  awk '/copied/ {printf "%.0f", $1 / $(NF-3) / 1e6}')
+rm -f $testfile
+echo "disk_MBps ${speed:--}"
+free=$(df -P -B1G $disk_path 2> /dev/null | awk 'NR == 2 {print $4}')
+echo "disk_free_GB ${free:--}"
+
+# GPUs and memory
+if command -v nvidia-smi > /dev/null; then
+  echo "gpus $(nvidia-smi --query-gpu=name --format=csv,noheader 2> /dev/null | grep -c .)"
+else
+  echo "gpus -"
+fi
+echo "mem_free_GB $(awk '/MemAvailable/ {printf "%.0f", $2 / 1024 / 1024}' /proc/meminfo)"
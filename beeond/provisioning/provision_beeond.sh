@@ -1,61 +1,111 @@
 #/bin/bash
 
-if [ ! -z "$(mount | grep beegfs_ondemand)" ]; then
-  echo BeeOND already provisioned. Will not continue
-  exit 111
-fi
+# Provision BeeOND on this node, one phase at a time
+#
+# Usage: provision_beeond.sh <beeond mount> <phase> [module cache dir]
+#
+# Phases (run in this order on all nodes, see beeondprovision.py):
+#   check prereqs repo install configure build install_module start
+#
+# Completed phases are recorded in /var/lib/beeond-provision and skipped on
+# reruns. Exit codes: 111 BeeOND already running (check phase), 112 phase
+# already completed on this node, anything else is the phase status.
 
 beeond_mnt=$1
+phase=$2
+cache_dir=${3:-/home/${SUDO_USER:-$USER}/beeond-cache}
 
-echo -e "### Installing Prerequisites:\n"
-
-sudo apt-get install -yq jq zip unzip
+state_dir=/var/lib/beeond-provision
+module_cache=${cache_dir}/beegfs-client-modules-$(uname -r).tar.gz
 
-echo -e "\n\n### Collecting Cluster Metadata:\n"
-
-NODE_IP=$(ifconfig ib0 | grep -oe "inet[^6][adr: ]*[0-9.]*" | cut -d" " -f2)
-MASTER_IP=$(head -1 nodefile)
+mkdir -p $state_dir
+if [ "$phase" != "check" ] && [ "$phase" != "start" ] && [ -f $state_dir/$phase.done ]; then
+  echo "Phase $phase already completed. Skipping"
+  exit 112
+fi
 
-echo "Node IP is: $NODE_IP"
-echo "Master IP is: $MASTER_IP"
+set -e
 
-echo -e "\n\n### Configuring P2P SSH:"
+case $phase in
 
-echo "Installing master public key:"
-cat masterkey | sudo tee -a /root/.ssh/authorized_keys
+check)
+  if [ ! -z "$(mount | grep beegfs_ondemand)" ]; then
+    echo BeeOND already provisioned. Will not continue
+    exit 111
+  fi
+  ;;
 
-echo -e "\n\n### Provisioning BeeOND FS:\n"
+prereqs)
+  echo -e "### Installing Prerequisites:\n"
+  apt-get install -yq jq zip unzip
+  ;;
 
-echo "Adding BeeOND public key"
-wget -q https://www.beegfs.io/release/latest-stable/gpg/DEB-GPG-KEY-beegfs -O- | sudo apt-key add -
+repo)
+  echo "Adding BeeOND public key"
+  wget -q https://www.beegfs.io/release/latest-stable/gpg/DEB-GPG-KEY-beegfs -O- | apt-key add -
 
-echo "Adding BeeOND repo"
-wget -q https://www.beegfs.io/release/beegfs_7.2/dists/beegfs-deb9.list -O- | \
-  sudo tee /etc/apt/sources.list.d/beegfs-deb9.list &>/dev/null
+  echo "Adding BeeOND repo"
+  wget -q https://www.beegfs.io/release/beegfs_7.2/dists/beegfs-deb9.list -O- | \
+    tee /etc/apt/sources.list.d/beegfs-deb9.list &>/dev/null
 
-sudo rm  /etc/apt/sources.list.d/beegfs-deb10.list &>/dev/null
+  rm -f /etc/apt/sources.list.d/beegfs-deb10.list
 
-sudo apt-get update -q
+  apt-get update -q
+  ;;
 
-sudo apt-get install -y beeond
+install)
+  apt-get install -y beeond
+  ;;
 
-sudo mkdir -p /root/bgconf
-echo ib0 | sudo tee /root/bgconf/interfaces
-for serv in client helperd meta mgmtd storage; do
-    cat <<EOF | sudo tee /root/bgconf/beegfs-${serv}.conf
+configure)
+  mkdir -p /root/bgconf
+  echo ib0 | tee /root/bgconf/interfaces
+  for serv in client helperd meta mgmtd storage; do
+      cat <<EOC | tee /root/bgconf/beegfs-${serv}.conf
 connInterfacesFile = /root/bgconf/interfaces
-EOF
-done
-# OFED_INCLUDE_PATH=/usr/src/ofa_kernel-5.1/include
-cat <<EOF | sudo tee /etc/beegfs/beegfs-client-autobuild.conf
-buildArgs=-j20
+EOC
+  done
+  # OFED_INCLUDE_PATH=/usr/src/ofa_kernel-5.1/include
+  cat <<EOC | tee /etc/beegfs/beegfs-client-autobuild.conf
+buildArgs=-j$(nproc)
 buildEnabled=true
-EOF
-
-if [ "${MASTER_IP}" == "${NODE_IP}" ]; then
-  sleep 30s
-  echo "\n\n## Master Node running BeeOND startup:\n"
-
-  sudo beeond start -n nodefile -f /root/bgconf -d /mnt/resource/beeond -c $beeond_mnt -F
-
-fi
+EOC
+  ;;
+
+build)
+  # Build the client kernel module once and cache it for the other nodes,
+  # which all run the same kernel
+  if [ -f $module_cache ]; then
+    echo "Using cached client module $module_cache"
+  else
+    /etc/init.d/beegfs-client rebuild
+    mkdir -p $cache_dir
+    find /lib/modules/$(uname -r) -name 'beegfs*.ko' | tar czf $module_cache -T -
+    chown -R ${SUDO_USER:-$USER}: $cache_dir
+  fi
+  ;;
+
+install_module)
+  tar xzf $module_cache -C /
+  depmod -a
+  # The module is prebuilt, so the client must not rebuild it on startup
+  sed -i 's/buildEnabled=true/buildEnabled=false/' /etc/beegfs/beegfs-client-autobuild.conf
+  ;;
+
+start)
+  NODE_IP=$(ifconfig ib0 | grep -oe "inet[^6][adr: ]*[0-9.]*" | cut -d" " -f2)
+  MASTER_IP=$(head -1 nodefile)
+  if [ "${MASTER_IP}" == "${NODE_IP}" ]; then
+    echo -e "\n\n## Master Node running BeeOND startup:\n"
+    beeond start -n nodefile -f /root/bgconf -d /mnt/resource/beeond -c $beeond_mnt -F
+  fi
+  ;;
+
+*)
+  echo "Unknown provisioning phase: $phase"
+  exit 1
+  ;;
+
+esac
+
+touch $state_dir/$phase.done
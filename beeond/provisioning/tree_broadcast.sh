@@ -0,0 +1,51 @@
+#!/bin/bash
+
+# Broadcast a file from this (master) node to all nodes in the nodefile
+#
+# Usage: tree_broadcast.sh <absolute path> <owner> [nodefile]
+#
+# Runs as root and uses the P2P ssh key. In each round every node holding
+# the file sends it to one node without it, so N nodes take log2(N) rounds.
+# Hops between other nodes use agent forwarding of the master key.
+
+src=$1
+owner=$2
+nodefile=${3:-nodefile}
+
+mapfile -t nodes < $nodefile
+n=${#nodes[@]}
+destdir=$(dirname $src)
+
+SSH_OPTS="-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR"
+
+eval $(ssh-agent -s) > /dev/null
+ssh-add /root/.ssh/id_rsa 2> /dev/null
+trap 'ssh-agent -k > /dev/null' EXIT
+
+hop() {
+  local from=$1 to=$2
+  local copy="ssh $SSH_OPTS root@$to mkdir -p $destdir && \
+scp -q $SSH_OPTS $src root@$to:$src && \
+ssh $SSH_OPTS root@$to chown $owner: $src"
+  if [ $from -eq 0 ]; then
+    bash -c "$copy"
+  else
+    ssh -A $SSH_OPTS root@${nodes[$from]} "$copy"
+  fi
+}
+
+have=1
+while [ $have -lt $n ]; do
+  echo "Broadcast round: $have of $n nodes have $src"
+  pids=()
+  for ((i=0; i<have && i+have<n; i++)); do
+    hop $i ${nodes[$((i+have))]} &
+    pids+=($!)
+  done
+  for pid in "${pids[@]}"; do
+    wait $pid || { echo "Broadcast hop failed"; exit 1; }
+  done
+  have=$((have*2))
+done
+
+echo "Broadcast of $src to $n nodes complete"
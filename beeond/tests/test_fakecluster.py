@@ -0,0 +1,187 @@
+"""BeeOND provisioning against the fake cluster backend"""
+
+import json
+import os
+import threading
+
+from time import monotonic
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("gevent")
+pytest.importorskip("termcolor")
+pytest.importorskip("pssh")
+pytest.importorskip("azureml")
+
+from clusterconnector import BeeONDClusterConnector
+from fakecluster import (
+    FakeClusterBackend,
+    FakeSSHClient,
+    LocalShellExecutor,
+    ScriptedExecutor,
+)
+
+k_beeond_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Logs, state and reports are written relative to the working directory
+    os.symlink(
+        os.path.join(k_beeond_dir, "provisioning"), str(tmp_path / "provisioning")
+    )
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def make_backend(workdir, node_health=None):
+    executor = ScriptedExecutor(
+        phase_times={k: 0.0 for k in ScriptedExecutor.default_phase_times},
+        hop_time=0.0,
+        node_health=node_health,
+    )
+    return FakeClusterBackend(str(workdir / "nodes"), executor=executor)
+
+
+def make_connector(backend):
+    return BeeONDClusterConnector(
+        SimpleNamespace(name="test"), "fakecluster", "", "fake", backend=backend
+    )
+
+
+def read_json(path):
+    with open(path, "rt") as fh:
+        return json.load(fh)
+
+
+def test_phased_provisioning_skips_completed_phases(workdir):
+    backend = make_backend(workdir)
+    connector = make_connector(backend)
+    connector.initialise(4)
+
+    assert backend.beeond_running
+    assert connector.ibaddrs == [node.ibaddr for node in backend.nodes]
+    with open(str(workdir / "nodes" / "node0003" / "nodefile"), "rt") as fh:
+        assert fh.read().split() == connector.ibaddrs
+
+    # BeeOND stopped between jobs; only the start phase has to run again
+    backend.beeond_running = False
+    connector = make_connector(backend)
+    connector.initialise(4)
+
+    report = read_json(os.path.splitext(connector.logfile)[0] + "_provision.json")
+    assert all(n["skipped"] for n in report["install"]["nodes"].values())
+    assert not any(n["skipped"] for n in report["start"]["nodes"].values())
+    assert backend.beeond_running
+
+
+def test_preflight_aborts_before_beeond_on_unhealthy_node(workdir):
+    backend = make_backend(workdir, node_health={3: {"disk_MBps": 100}})
+    connector = make_connector(backend)
+
+    with pytest.raises(RuntimeError, match="1 of 4 nodes"):
+        connector.initialise(4, preflight=True)
+
+    assert not backend.beeond_running
+    report = read_json(os.path.splitext(connector.logfile)[0] + "_preflight.json")
+    failed = [k for k, v in report["nodes"].items() if v["failures"]]
+    assert failed == ["127.0.0.1:{}".format(backend.nodes[3].port)]
+
+
+@pytest.mark.parametrize("num_nodes", [1, 4])
+def test_warm_pool_restore(workdir, num_nodes):
+    backend = make_backend(workdir)
+    connector = make_connector(backend)
+    connector.initialise(num_nodes, warm_pool=True)
+    assert os.path.exists(connector.state_file)
+
+    connector = make_connector(backend)
+    connector.initialise(num_nodes, warm_pool=True)
+    assert "warm_pool" in connector.stage_times
+    assert "beeond" not in connector.stage_times
+    assert connector._hosts == [("127.0.0.1", n.port) for n in backend.nodes]
+
+    # The pool scaled down while idle, so it must be provisioned again
+    backend.scale_down_idle()
+    connector = make_connector(backend)
+    connector.initialise(num_nodes, warm_pool=True)
+    assert "beeond" in connector.stage_times
+    assert backend.beeond_running
+
+
+def test_default_executor_is_scripted(workdir):
+    backend = FakeClusterBackend(str(workdir / "nodes"))
+    assert isinstance(backend.executor, ScriptedExecutor)
+
+
+def test_local_shell_refuses_provisioning(workdir):
+    backend = FakeClusterBackend(str(workdir / "nodes"), executor=LocalShellExecutor())
+    backend.scale(1)
+    stderr = []
+    code = backend.executor.run(
+        backend,
+        backend.nodes[0],
+        "sudo bash ./provision_beeond.sh /mnt/scratch install",
+        lambda line: None,
+        stderr.append,
+    )
+    assert code == 1
+    assert stderr
+
+
+def test_remote_paths_strip_home_prefix_only(workdir):
+    backend = make_backend(workdir)
+    backend.scale(1)
+    client = FakeSSHClient(backend, backend.nodes[0])
+    home = backend.nodes[0].home
+    assert client._node_path("~/nodefile") == os.path.join(home, "nodefile")
+    assert client._node_path("./nodefile") == os.path.join(home, "./nodefile")
+    assert client._node_path("~~x") == os.path.join(home, "~~x")
+
+
+def provision(backend, monkeypatch, build, **kwargs):
+    import common
+
+    monkeypatch.setattr(common, "build_environment", build)
+    return common.provision_cluster_and_environment(
+        SimpleNamespace(name="test"),
+        "fakecluster",
+        4,
+        "",
+        "fake",
+        True,
+        "env",
+        "image",
+        use_beeond=True,
+        backend=backend,
+        **kwargs
+    )
+
+
+def test_failed_environment_build_aborts_and_tears_down_cluster(workdir, monkeypatch):
+    backend = make_backend(workdir)
+    backend.executor.phase_times["install"] = 2.0
+
+    def build(*args, **kwargs):
+        raise RuntimeError("image build failed")
+
+    start = monotonic()
+    with pytest.raises(RuntimeError, match="image build failed"):
+        provision(backend, monkeypatch, build)
+    assert monotonic() - start < 1.0
+    assert backend.nodes == []
+
+
+def test_failed_cluster_does_not_wait_for_environment(workdir, monkeypatch):
+    backend = make_backend(workdir, node_health={3: {"disk_MBps": 100}})
+    finished = threading.Event()
+
+    def build(*args, **kwargs):
+        finished.wait(5.0)
+
+    start = monotonic()
+    with pytest.raises(RuntimeError, match="Pre-flight checks failed"):
+        provision(backend, monkeypatch, build, preflight=True)
+    assert monotonic() - start < 2.0
+    finished.set()
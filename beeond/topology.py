@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+"""IB topology discovery and topology-aware node placement
+"""
+
+import json
+import math
+import os
+
+from termcolor import cprint
+
+# Payload of the ping-pong used for the bandwidth estimate (see ib_pingpong.sh)
+k_probe_size = 32768
+k_ping_header = 28
+# Message size used to weigh latency against bandwidth in the hop cost (bytes)
+k_default_message_bytes = 4 * 1024 * 1024
+
+
+class TopologyMatrix:
+    def __init__(self, ibaddrs):
+        """Pairwise one-way latency (us) and bandwidth (MB/s) between IB addresses
+
+        Unmeasured or unreachable pairs have infinite latency and zero bandwidth.
+        """
+        self.ibaddrs = list(ibaddrs)
+        n = len(self.ibaddrs)
+        self.latency = [
+            [0.0 if i == j else math.inf for j in range(n)] for i in range(n)
+        ]
+        self.bandwidth = [
+            [math.inf if i == j else 0.0 for j in range(n)] for i in range(n)
+        ]
+
+    def __len__(self):
+        return len(self.ibaddrs)
+
+    def hop_cost(self, i, j, message_bytes=k_default_message_bytes):
+        """Estimated time in us to send message_bytes from node i to node j"""
+        if self.bandwidth[i][j] <= 0.0:
+            return math.inf
+        # bytes / (MB/s) is microseconds
+        return self.latency[i][j] + message_bytes / self.bandwidth[i][j]
+
+    def record(self, src, dst, small_rtt, large_rtt, size=k_probe_size):
+        """Record the ping-pong round trip times (us) from node src to node dst"""
+        self.latency[src][dst] = small_rtt / 2
+        extra = max(large_rtt - small_rtt, 1e-3)
+        # Both directions carry the extra payload
+        self.bandwidth[src][dst] = 2 * (size + k_ping_header) / extra
+
+    def symmetrise(self):
+        """Average each pair over both directions, keeping one-sided measurements"""
+        n = len(self)
+        for i in range(n):
+            for j in range(i + 1, n):
+                lats = [
+                    v for v in (self.latency[i][j], self.latency[j][i]) if v < math.inf
+                ]
+                bws = [
+                    v for v in (self.bandwidth[i][j], self.bandwidth[j][i]) if v > 0.0
+                ]
+                lat = sum(lats) / len(lats) if lats else math.inf
+                bw = sum(bws) / len(bws) if bws else 0.0
+                self.latency[i][j] = self.latency[j][i] = lat
+                self.bandwidth[i][j] = self.bandwidth[j][i] = bw
+
+    def unreachable_pairs(self):
+        n = len(self)
+        return [
+            (self.ibaddrs[i], self.ibaddrs[j])
+            for i in range(n)
+            for j in range(i + 1, n)
+            if self.latency[i][j] == math.inf
+        ]
+
+    def save(self, path, order=None):
+        """Write the matrices (and optionally the chosen node order) as JSON"""
+
+        def finite(rows):
+            return [[v if math.isfinite(v) else None for v in row] for row in rows]
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wt") as fh:
+            json.dump(
+                {
+                    "ibaddrs": self.ibaddrs,
+                    "latency_us": finite(self.latency),
+                    "bandwidth_MBps": finite(self.bandwidth),
+                    "order": [self.ibaddrs[i] for i in order] if order else None,
+                },
+                fh,
+                indent=2,
+            )
+
+
+def measure_topology(connector, count=5, size=k_probe_size, timeout=None):
+    """Measure the pairwise IB latency and bandwidth of a cluster
+
+    Every node pings all others listed in its nodefile over ib0 concurrently (see
+    provisioning/ib_pingpong.sh, which must have been copied to the nodes). Returns a
+    symmetrised TopologyMatrix over connector.ibaddrs.
+    """
+
+    ibaddrs = connector.ibaddrs
+    index = {addr: i for i, addr in enumerate(ibaddrs)}
+    matrix = TopologyMatrix(ibaddrs)
+
+    results = connector.run_on_all_nodes(
+        "sudo bash ./ib_pingpong.sh nodefile {} {}".format(count, size),
+        timeout=timeout,
+        tail_lines=len(ibaddrs) + 1,
+    )
+    for result in results:
+        src = index[connector.ibaddr_map[(result.host, result.port)]]
+        for line in result.stdout:
+            try:
+                addr, small, large = line.split()
+                dst = index[addr]
+            except (ValueError, KeyError):
+                continue
+            if small == "-" or large == "-":
+                continue
+            matrix.record(src, dst, float(small), float(large), size)
+
+    matrix.symmetrise()
+    for a, b in matrix.unreachable_pairs():
+        cprint("Warning: no IB ping-pong between {} and {}".format(a, b), "yellow")
+    return matrix
+
+
+def ring_cost(matrix, order, message_bytes=k_default_message_bytes):
+    """Sum of the hop costs around the closed ring of nodes in order"""
+    n = len(order)
+    if n < 2:
+        return 0.0
+    return sum(
+        matrix.hop_cost(order[k], order[(k + 1) % n], message_bytes) for k in range(n)
+    )
+
+
+def tree_cost(matrix, order, message_bytes=k_default_message_bytes):
+    """Time of a binomial tree broadcast from order[0], as in tree_broadcast.sh
+
+    In each round the first `have` nodes send to the next `have` nodes; a round
+    takes as long as its slowest hop.
+    """
+    cost = 0.0
+    have = 1
+    while have < len(order):
+        cost += max(
+            matrix.hop_cost(order[i], order[i + have], message_bytes)
+            for i in range(min(have, len(order) - have))
+        )
+        have *= 2
+    return cost
+
+
+def metadata_distance(matrix, order):
+    """Total latency from the first node (BeeOND management/metadata) to the rest"""
+    return sum(matrix.latency[order[0]][j] for j in order[1:])
+
+
+def _ring_two_opt(matrix, order, message_bytes, max_passes):
+    # Reverse segments while that shortens the ring; order[0] stays in place
+    n = len(order)
+    order = list(order)
+
+    def cost(a, b):
+        return matrix.hop_cost(a, b, message_bytes)
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            for j in range(i + 1, n):
+                a, b = order[i - 1], order[i]
+                c, d = order[j], order[(j + 1) % n]
+                delta = cost(a, c) + cost(b, d) - cost(a, b) - cost(c, d)
+                if delta < -1e-9:
+                    order[i : j + 1] = reversed(order[i : j + 1])
+                    improved = True
+        if not improved:
+            break
+    return order
+
+
+def plan_placement(matrix, message_bytes=k_default_message_bytes, max_passes=10):
+    """Choose a node order (indices into matrix.ibaddrs) for the BeeOND nodefile
+
+    The first node has the lowest total latency to all others, as BeeOND places its
+    management and metadata services there. The rest follow in a ring order built
+    by nearest neighbour and improved by 2-opt to minimise the ring hop cost, so
+    neighbouring nodes are also close for the tree broadcast (tree_broadcast.sh).
+    """
+
+    n = len(matrix)
+    if n < 3:
+        return list(range(n))
+
+    first = min(range(n), key=lambda i: (sum(matrix.latency[i]), i))
+    order = [first]
+    remaining = set(range(n)) - {first}
+    while remaining:
+        last = order[-1]
+        nearest = min(
+            remaining, key=lambda j: (matrix.hop_cost(last, j, message_bytes), j)
+        )
+        order.append(nearest)
+        remaining.remove(nearest)
+
+    return _ring_two_opt(matrix, order, message_bytes, max_passes)
+
+
+def print_placement_report(
+    matrix, before, after, message_bytes=k_default_message_bytes
+):
+    """Compare the placement costs of two node orders"""
+
+    cprint("Topology-aware placement:", "green", attrs=["bold"])
+    for name, func in [("nodefile ring", ring_cost), ("tree broadcast", tree_cost)]:
+        print(
+            "  {:<18} {:12.1f}us -> {:12.1f}us".format(
+                name,
+                func(matrix, before, message_bytes),
+                func(matrix, after, message_bytes),
+            )
+        )
+    print(
+        "  {:<18} {:12.1f}us -> {:12.1f}us".format(
+            "metadata distance",
+            metadata_distance(matrix, before),
+            metadata_distance(matrix, after),
+        )
+    )
+    print("  BeeOND management/metadata node: {}".format(matrix.ibaddrs[after[0]]))
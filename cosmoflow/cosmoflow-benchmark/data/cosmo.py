@@ -75,11 +75,15 @@ def construct_dataset(file_dir, n_samples, batch_size, n_epochs,
                       sample_shape, samples_per_file=1, n_file_sets=1,
                       shard=0, n_shards=1, apply_log=False,
                       randomize_files=False, shuffle=False,
-                      shuffle_buffer_size=0, n_parallel_reads=4, prefetch=4):
+                      shuffle_buffer_size=0, n_parallel_reads=4, prefetch=4,
+                      seed=None, subset_seed=None):
     """This function takes a folder with files and builds the TF dataset.
 
     It ensures that the requested sample counts are divisible by files,
     local-disks, worker shards, and mini-batches.
+
+    With subset_seed the files are a fixed random subset of the folder,
+    the same on all ranks and in every epoch.
     """
 
     if n_samples == 0:
@@ -101,7 +105,10 @@ def construct_dataset(file_dir, n_samples, batch_size, n_epochs,
     filenames = sorted(glob.glob(os.path.join(file_dir, '*.tfrecord')))
     assert (0 <= n_files) and (n_files <= len(filenames)), (
         'Requested %i files, %i available' % (n_files, len(filenames)))
-    if randomize_files:
+    if subset_seed is not None:
+        # Seeded on the sorted list only, so the subset is reproducible
+        np.random.RandomState(subset_seed).shuffle(filenames)
+    elif randomize_files:
         np.random.shuffle(filenames)
     filenames = filenames[:n_files]
 
@@ -109,7 +116,8 @@ def construct_dataset(file_dir, n_samples, batch_size, n_epochs,
     data = tf.data.Dataset.from_tensor_slices(filenames)
     data = data.shard(num_shards=n_shards, index=shard)
     if shuffle:
-        data = data.shuffle(len(filenames), reshuffle_each_iteration=True)
+        data = data.shuffle(len(filenames), seed=seed,
+                            reshuffle_each_iteration=True)
 
     # Parse TFRecords
     parse_data = partial(_parse_data, shape=sample_shape, apply_log=apply_log)
@@ -125,7 +133,7 @@ def construct_dataset(file_dir, n_samples, batch_size, n_epochs,
     # Localized sample shuffling (note: imperfect global shuffling).
     # Use if samples_per_file is greater than 1.
     if shuffle and shuffle_buffer_size > 0:
-        data = data.shuffle(shuffle_buffer_size)
+        data = data.shuffle(shuffle_buffer_size, seed=seed)
 
     # Construct batches
     data = data.repeat(n_epochs)
@@ -134,24 +142,69 @@ def construct_dataset(file_dir, n_samples, batch_size, n_epochs,
     # Prefetch to device
     return data.prefetch(prefetch), n_steps
 
+def construct_inference_dataset(file_dir, n_samples, batch_size, sample_shape,
+                                samples_per_file=1, apply_log=False,
+                                n_parallel_reads=4, prefetch=4):
+    """Build an unshuffled, single-pass dataset for offline evaluation.
+
+    Unlike construct_dataset, samples are read in file order and the last
+    batch is kept even if it is partial, so every sample is scored once.
+    Files are read one after the other so that the sample order matches the
+    sorted file list; n_parallel_reads only applies to parsing.
+
+    Returns the dataset and the number of samples it yields.
+    """
+    filenames = sorted(glob.glob(os.path.join(file_dir, '*.tfrecord')))
+    if n_samples is not None:
+        n_files = -(-n_samples // samples_per_file)
+        assert n_files <= len(filenames), (
+            'Requested %i files, %i available' % (n_files, len(filenames)))
+        filenames = filenames[:n_files]
+    else:
+        n_samples = len(filenames) * samples_per_file
+
+    parse_data = partial(_parse_data, shape=sample_shape, apply_log=apply_log)
+    data = tf.data.TFRecordDataset(filenames)
+    data = data.take(n_samples).map(parse_data, num_parallel_calls=n_parallel_reads)
+    data = data.batch(batch_size)
+    return data.prefetch(prefetch), n_samples
+
 def get_datasets(data_dir, sample_shape, n_train, n_valid,
                  batch_size, n_epochs, dist, samples_per_file=1,
                  shuffle_train=True, shuffle_valid=False,
                  shard=True, stage_dir=None, apply_log=False,
-                 **kwargs):
+                 grad_accum_steps=1, spatial_parallel=False,
+                 n_valid_subset=None, valid_subset_seed=0, **kwargs):
     """Prepare TF datasets for training and validation.
 
     This function will perform optional staging of data chunks to local
     filesystems. It also figures out how to split files according to local
     filesystems (if pre-staging) and worker shards (if sharding).
 
+    The grad_accum_steps setting does not change the datasets but enters
+    the global batch size reported to MLPerf.
+
+    With spatial_parallel all ranks work on slabs of the same samples, so
+    the data is not sharded and all ranks shuffle with the same seed.
+
+    If n_valid_subset is set, a validation dataset of that many samples,
+    drawn once at random from the validation files, is also returned for
+    cheap per-epoch validation.
+
     Returns: A dict of the two datasets and step counts per epoch.
     """
 
+    # Number of data-parallel replicas
+    n_replicas = 1 if spatial_parallel else dist.size
+    if spatial_parallel:
+        shard = False
+        kwargs.setdefault('seed', 0)
+
     # MLPerf logging
     if dist.rank == 0:
         mllogger = mllog.get_mllogger()
-        mllogger.event(key=mllog.constants.GLOBAL_BATCH_SIZE, value=batch_size*dist.size)
+        mllogger.event(key=mllog.constants.GLOBAL_BATCH_SIZE,
+                       value=batch_size*n_replicas*grad_accum_steps)
         mllogger.event(key=mllog.constants.TRAIN_SAMPLES, value=n_train)
         mllogger.event(key=mllog.constants.EVAL_SAMPLES, value=n_valid)
     data_dir = os.path.expandvars(data_dir)
@@ -202,6 +255,17 @@ def get_datasets(data_dir, sample_shape, n_train, n_valid,
     valid_dataset, n_valid_steps = construct_dataset(
         file_dir=os.path.join(data_dir, 'validation'),
         n_samples=n_valid, shuffle=shuffle_valid, **dataset_args)
+    valid_subset_dataset, n_valid_subset_steps = None, 0
+    if n_valid_subset is not None:
+        valid_subset_dataset, n_valid_subset_steps = construct_dataset(
+            file_dir=os.path.join(data_dir, 'validation'),
+            n_samples=n_valid_subset, shuffle=shuffle_valid,
+            subset_seed=valid_subset_seed, **dataset_args)
+
+    if (n_train_steps % grad_accum_steps) != 0 and dist.rank == 0:
+        logging.warning('Training steps per epoch (%i) not divisible by '
+                        'grad_accum_steps (%i); accumulation windows will '
+                        'span epoch boundaries', n_train_steps, grad_accum_steps)
 
     if shard == 0:
         if staged_files:
@@ -215,9 +279,14 @@ def get_datasets(data_dir, sample_shape, n_train, n_valid,
     if dist.rank == 0:
         logging.info('Data setting n_train: %i', n_train)
         logging.info('Data setting n_valid: %i', n_valid)
+        if n_valid_subset is not None:
+            logging.info('Data setting n_valid_subset: %i', n_valid_subset)
         logging.info('Data setting batch_size: %i', batch_size)
+        logging.info('Data setting grad_accum_steps: %i', grad_accum_steps)
         for k, v in kwargs.items():
             logging.info('Data setting %s: %s', k, v)
 
     return dict(train_dataset=train_dataset, valid_dataset=valid_dataset,
-                n_train_steps=n_train_steps, n_valid_steps=n_valid_steps)
+                valid_subset_dataset=valid_subset_dataset,
+                n_train_steps=n_train_steps, n_valid_steps=n_valid_steps,
+                n_valid_subset_steps=n_valid_subset_steps)
@@ -44,14 +44,15 @@ def construct_dataset(sample_shape, target_shape,
     return data.repeat().batch(batch_size).prefetch(4)
 
 def get_datasets(sample_shape, target_shape, batch_size,
-                 n_train, n_valid, dist, n_epochs=None, shard=False):
+                 n_train, n_valid, dist, n_epochs=None, shard=False,
+                 grad_accum_steps=1, spatial_parallel=False):
     train_dataset = construct_dataset(sample_shape, target_shape, batch_size=batch_size)
     valid_dataset = None
     if n_valid > 0:
         valid_dataset = construct_dataset(sample_shape, target_shape, batch_size=batch_size)
     n_train_steps = n_train  // batch_size
     n_valid_steps = n_valid  // batch_size
-    if shard:
+    if shard and not spatial_parallel:
         n_train_steps = n_train_steps // dist.size
         n_valid_steps = n_valid_steps // dist.size
 
@@ -0,0 +1,184 @@
+"""Offline evaluation of trained CosmoFlow checkpoints
+
+This script scores one or more checkpoints of a training run on the
+validation TFRecords without starting a training job. The model is rebuilt
+from the run's config.pkl, the weights of each checkpoint are loaded in
+turn (either the weights-NNN.h5 epoch snapshots or legacy checkpoint-NNN.h5
+full Keras models; mid-epoch weights-stepNNNNNNNN.h5 snapshots are skipped),
+and inference runs with a large batch split across all local GPUs (or on the
+CPU cores if there are none).
+
+For every checkpoint the per-sample targets and predictions are written to
+predictions-<checkpoint>.csv, and the MAE/MSE of all checkpoints are
+collected in evaluation.csv.
+"""
+
+# System imports
+import os
+import argparse
+import logging
+import pickle
+import glob
+import re
+import time
+
+# External imports
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+# Suppress TF warnings
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+tf.compat.v1.logging.set_verbosity(logging.ERROR)
+
+# Local imports
+from data.cosmo import construct_inference_dataset
+from models import get_model
+from utils.checkpoints import load_checkpoint_weights
+from utils.device import configure_session
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser('evaluate.py')
+    add_arg = parser.add_argument
+    add_arg('run_dir', help='Output directory of the training run')
+    add_arg('-c', '--checkpoints', nargs='*',
+            help='Checkpoint files to evaluate (default: all in run_dir)')
+    add_arg('--output-dir', help='Where to write results (default: run_dir/eval)')
+    add_arg('--data-dir', help='Override the path to input files')
+    add_arg('--n-valid', type=int,
+            help='Number of validation samples (default: n_valid in config)')
+    add_arg('--batch-size', type=int, default=64,
+            help='Inference batch size, split across the local GPUs')
+    add_arg('--n-gpus', type=int,
+            help='Number of local GPUs to use (default: all)')
+    add_arg('--n-parallel-reads', type=int, default=8,
+            help='Parallel TFRecord parse calls (files are read in order)')
+    add_arg('--intra-threads', type=int, default=32,
+            help='TF intra-parallel threads')
+    add_arg('--inter-threads', type=int, default=2,
+            help='TF inter-parallel threads')
+    add_arg('-v', '--verbose', action='store_true')
+    return parser.parse_args()
+
+def config_logging(verbose):
+    log_format = '%(asctime)s %(levelname)s %(message)s'
+    log_level = logging.DEBUG if verbose else logging.INFO
+    logging.basicConfig(level=log_level, format=log_format)
+
+def load_config(run_dir):
+    with open(os.path.join(run_dir, 'config.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+def find_checkpoints(run_dir):
+    """Find the end-of-epoch checkpoint files of a run in training order"""
+    pattern = re.compile(r'(?:weights|checkpoint)-(\d+)\.h5$')
+    checkpoints = []
+    for path in glob.glob(os.path.join(run_dir, '*.h5')):
+        match = pattern.match(os.path.basename(path))
+        if match is not None:
+            checkpoints.append((int(match.group(1)), path))
+    return [path for _, path in sorted(checkpoints)]
+
+def build_inference_model(model_config, n_gpus):
+    """Build the model for inference, replicated over n_gpus if more than one.
+
+    Returns the model holding the weights and the model to run.
+    """
+    model_config = dict(model_config)
+    # Spatial decomposition only applies to training; the weights are the same
+    model_config.pop('spatial_parallel', None)
+    if n_gpus > 1:
+        # Keep the master weights on the CPU so each replica reads them
+        with tf.device('/cpu:0'):
+            model = get_model(**model_config)
+        return model, tf.keras.utils.multi_gpu_model(model, gpus=n_gpus)
+    model = get_model(**model_config)
+    return model, model
+
+def main():
+    """Main function"""
+    args = parse_args()
+    config_logging(args.verbose)
+
+    config = load_config(args.run_dir)
+    data_config = config['data']
+    output_dir = args.output_dir or os.path.join(args.run_dir, 'eval')
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoints = args.checkpoints or find_checkpoints(args.run_dir)
+    if len(checkpoints) == 0:
+        logging.error('No checkpoints found in %s', args.run_dir)
+        return
+    logging.info('Evaluating %i checkpoints', len(checkpoints))
+
+    configure_session(intra_threads=args.intra_threads,
+                      inter_threads=args.inter_threads)
+    sess = tf.keras.backend.get_session()
+    tf.keras.backend.set_learning_phase(0)
+
+    # Validation data, read once per checkpoint
+    data_dir = os.path.expandvars(args.data_dir or data_config['data_dir'])
+    n_valid = args.n_valid or data_config.get('n_valid')
+    dataset, n_valid = construct_inference_dataset(
+        os.path.join(data_dir, 'validation'), n_samples=n_valid,
+        batch_size=args.batch_size,
+        sample_shape=data_config['sample_shape'],
+        samples_per_file=data_config.get('samples_per_file', 1),
+        apply_log=data_config.get('apply_log', False),
+        n_parallel_reads=args.n_parallel_reads)
+    iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+    x, y = iterator.get_next()
+
+    # Model graph, built once; only the weights change per checkpoint
+    n_gpus = len(tf.config.experimental.list_physical_devices('GPU'))
+    if args.n_gpus is not None:
+        n_gpus = min(n_gpus, args.n_gpus)
+    logging.info('Running inference on %s',
+                 '%i GPUs' % n_gpus if n_gpus > 0 else 'CPU')
+    model, run_model = build_inference_model(config['model'], n_gpus)
+    pred = run_model(x)
+
+    results = []
+    for checkpoint in checkpoints:
+        name = os.path.splitext(os.path.basename(checkpoint))[0]
+        load_checkpoint_weights(model, checkpoint)
+
+        start_time = time.time()
+        sess.run(iterator.initializer)
+        ys, preds = [], []
+        while True:
+            try:
+                y_batch, pred_batch = sess.run([y, pred])
+            except tf.errors.OutOfRangeError:
+                break
+            ys.append(y_batch)
+            preds.append(pred_batch)
+        duration = time.time() - start_time
+        ys, preds = np.concatenate(ys), np.concatenate(preds)
+
+        # Per-sample predictions
+        n_targets = ys.shape[1]
+        table = pd.DataFrame(np.concatenate([ys, preds], axis=1),
+                             columns=(['y%i' % i for i in range(n_targets)] +
+                                      ['pred%i' % i for i in range(n_targets)]))
+        table.index.name = 'sample'
+        table.to_csv(os.path.join(output_dir, 'predictions-%s.csv' % name))
+
+        result = dict(checkpoint=name,
+                      n_samples=len(ys),
+                      mae=float(np.mean(np.abs(preds - ys))),
+                      mse=float(np.mean(np.square(preds - ys))),
+                      samples_per_sec=len(ys) / duration)
+        logging.info('%s: mae %.5f mse %.5f (%i samples, %.1f samples/s)',
+                     name, result['mae'], result['mse'], result['n_samples'],
+                     result['samples_per_sec'])
+        results.append(result)
+
+    results = pd.DataFrame(results)
+    results.to_csv(os.path.join(output_dir, 'evaluation.csv'), index=False)
+    best = results.mae.idxmin()
+    logging.info('Best checkpoint: %s (mae %.5f)',
+                 results.checkpoint[best], results.mae[best])
+    logging.info('All done!')
+
+if __name__ == '__main__':
+    main()
@@ -27,37 +27,93 @@
 
 """Configurable model specification for CosmoFlow"""
 
+from contextlib import contextmanager
+
 import tensorflow as tf
 import tensorflow.keras.layers as layers
 
 from .layers import scale_1p2
 
+@contextmanager
+def _null_scope():
+    yield
+
 def build_model(input_shape, target_size,
                 conv_size=16, kernel_size=2, n_conv_layers=5,
                 fc1_size=128, fc2_size=64,
                 hidden_activation='LeakyReLU',
                 pooling_type='MaxPool3D',
-                dropout=0):
-    """Construct the CosmoFlow 3D CNN model"""
+                dropout=0,
+                data_format='channels_last',
+                xla_fuse=False,
+                spatial_parallel=False):
+    """Construct the CosmoFlow 3D CNN model
+
+    The input_shape is always given channels-last, as produced by the data
+    pipeline. With data_format='channels_first' the input is transposed once
+    and the conv stack runs in NCDHW layout, which has faster cuDNN 3D conv
+    kernels on GPU (it is not supported on CPU).
+
+    With xla_fuse=True each conv/activation/pooling group is compiled with XLA
+    so the bias add, activation and pooling are fused with the convolution.
 
-    conv_args = dict(kernel_size=kernel_size, padding='same')
+    With spatial_parallel=True each sample volume is split along its depth
+    across all Horovod ranks (see models/spatial.py). The conv layers work on
+    per-rank slabs with halo exchange until a slab becomes too thin to pool,
+    from where on the full feature map is gathered onto every rank. This
+    mode requires channels_last and a single node, as the halo exchange and
+    gathers span all ranks and would otherwise cross the inter-node fabric
+    and give up data parallelism between nodes.
+    """
+
+    conv_args = dict(kernel_size=kernel_size, padding='same',
+                     data_format=data_format)
     hidden_activation = getattr(layers, hidden_activation)
     pooling_type = getattr(layers, pooling_type)
+    jit_scope = tf.xla.experimental.jit_scope if xla_fuse else _null_scope
 
     model = tf.keras.models.Sequential()
+    if data_format == 'channels_first':
+        model.add(layers.Permute((4, 1, 2, 3), input_shape=input_shape))
+    else:
+        model.add(layers.InputLayer(input_shape=input_shape))
 
-    # First convolutional layer
-    model.add(layers.Conv3D(conv_size, input_shape=input_shape, **conv_args))
-    model.add(hidden_activation())
-    model.add(pooling_type(pool_size=2))
-
-    # Additional conv layers
-    for i in range(1, n_conv_layers):
-        # Double conv channels at every layer
-        model.add(layers.Conv3D(conv_size*2**i, **conv_args))
-        model.add(hidden_activation())
-        model.add(pooling_type(pool_size=2))
-    model.add(layers.Flatten())
+    if spatial_parallel:
+        if data_format != 'channels_last':
+            raise ValueError('Spatial parallelism requires channels_last')
+        import horovod.tensorflow as hvd_tf
+        from .spatial import SpatialSlice, HaloPad3D, GatherSlabs
+        rank, size = hvd_tf.rank(), hvd_tf.size()
+        if hvd_tf.local_size() != size:
+            raise ValueError('Spatial parallelism requires a single node, '
+                             'got %i ranks with %i per node' %
+                             (size, hvd_tf.local_size()))
+        if input_shape[0] % size != 0:
+            raise ValueError('Volume depth %i not divisible by %i ranks' %
+                             (input_shape[0], size))
+        model.add(SpatialSlice(rank, size))
+        slab_depth = input_shape[0] // size
+        conv_args['padding'] = 'valid'
+
+    # Convolutional layers
+    for i in range(n_conv_layers):
+        if spatial_parallel and slab_depth % 2 != 0:
+            # Slabs can no longer be pooled locally; continue on full volume
+            model.add(GatherSlabs())
+            spatial_parallel = False
+            conv_args['padding'] = 'same'
+        with jit_scope():
+            if spatial_parallel:
+                model.add(HaloPad3D(kernel_size, rank, size))
+            # Double conv channels at every layer
+            model.add(layers.Conv3D(conv_size*2**i, **conv_args))
+            model.add(hidden_activation())
+            model.add(pooling_type(pool_size=2, data_format=data_format))
+        if spatial_parallel:
+            slab_depth //= 2
+    if spatial_parallel:
+        model.add(GatherSlabs())
+    model.add(layers.Flatten(data_format=data_format))
 
     # Fully-connected layers
     model.add(layers.Dense(fc1_size))
@@ -5,14 +5,108 @@ This code has been adapted from here:
 https://github.com/keras-team/keras-applications/blob/master/keras_applications/resnet_common.py
 """
 
+from contextlib import contextmanager
+
 import tensorflow as tf
 from tensorflow.keras import layers, models, backend
 import tensorflow.keras.utils as keras_utils
 
 from .layers import scale_1p2
 
+@contextmanager
+def _null_scope():
+    yield
+
+def _bn_axis(data_format):
+    """Channel axis of a 5D (batch, spatial x3, channel) tensor"""
+    return 4 if data_format == 'channels_last' else 1
+
+def _block1_layers(filters, kernel_size, stride, conv_shortcut,
+                   name, data_format):
+    """Create the layers of a residual block (see block1)"""
+    bn_axis = _bn_axis(data_format)
+    bn_args = dict(axis=bn_axis, epsilon=1.001e-5)
+    l = {}
+    if conv_shortcut is True:
+        l['0_conv'] = layers.Conv3D(4 * filters, 1, strides=stride,
+                                    data_format=data_format,
+                                    name=name + '_0_conv')
+        l['0_bn'] = layers.BatchNormalization(name=name + '_0_bn', **bn_args)
+    l['1_conv'] = layers.Conv3D(filters, 1, strides=stride,
+                                data_format=data_format, name=name + '_1_conv')
+    l['1_bn'] = layers.BatchNormalization(name=name + '_1_bn', **bn_args)
+    l['1_relu'] = layers.Activation('relu', name=name + '_1_relu')
+    l['2_conv'] = layers.Conv3D(filters, kernel_size, padding='SAME',
+                                data_format=data_format, name=name + '_2_conv')
+    l['2_bn'] = layers.BatchNormalization(name=name + '_2_bn', **bn_args)
+    l['2_relu'] = layers.Activation('relu', name=name + '_2_relu')
+    l['3_conv'] = layers.Conv3D(4 * filters, 1, data_format=data_format,
+                                name=name + '_3_conv')
+    l['3_bn'] = layers.BatchNormalization(name=name + '_3_bn', **bn_args)
+    l['add'] = layers.Add(name=name + '_add')
+    l['out'] = layers.Activation('relu', name=name + '_out')
+    return l
+
+def _apply_block1(x, l):
+    """Apply the layers created by _block1_layers to x"""
+    if '0_conv' in l:
+        shortcut = l['0_bn'](l['0_conv'](x))
+    else:
+        shortcut = x
+
+    x = l['1_relu'](l['1_bn'](l['1_conv'](x)))
+    x = l['2_relu'](l['2_bn'](l['2_conv'](x)))
+    x = l['3_bn'](l['3_conv'](x))
+
+    x = l['add']([shortcut, x])
+    return l['out'](x)
+
+class RecomputeBlock1(layers.Layer):
+    """A residual block which recomputes its activations for the backward pass.
+
+    Only the block input is kept alive between the forward and backward pass;
+    the intermediate activations are recomputed with tf.recompute_grad,
+    trading roughly one extra forward pass of the block for activation memory.
+    Note the BN moving statistics are also updated by the recomputation.
+
+    The block layers keep their usual names but become sublayers of this
+    layer, so checkpoints written with recompute on and off are not
+    interchangeable.
+    """
+
+    def __init__(self, filters, kernel_size=3, stride=1, conv_shortcut=True,
+                 data_format='channels_last', name=None, **kwargs):
+        super(RecomputeBlock1, self).__init__(name=name, **kwargs)
+        self.block_layers = _block1_layers(filters, kernel_size, stride,
+                                           conv_shortcut, name, data_format)
+
+    def build(self, input_shape):
+        # Create all variables up front; variables must not be created
+        # inside the recomputed function.
+        l = self.block_layers
+        if '0_conv' in l:
+            l['0_conv'].build(input_shape)
+            l['0_bn'].build(l['0_conv'].compute_output_shape(input_shape))
+        shape = input_shape
+        for i in ['1', '2', '3']:
+            l[i + '_conv'].build(shape)
+            shape = l[i + '_conv'].compute_output_shape(shape)
+            l[i + '_bn'].build(shape)
+        super(RecomputeBlock1, self).build(input_shape)
+
+    def call(self, x):
+        return tf.recompute_grad(lambda y: _apply_block1(y, self.block_layers))(x)
+
+    def compute_output_shape(self, input_shape):
+        l = self.block_layers
+        shape = input_shape
+        for i in ['1', '2', '3']:
+            shape = l[i + '_conv'].compute_output_shape(shape)
+        return shape
+
 def block1(x, filters, kernel_size=3, stride=1,
-           conv_shortcut=True, name=None):
+           conv_shortcut=True, name=None, data_format=None, xla_fuse=False,
+           recompute=False):
     """A residual block.
     # Arguments
         x: input tensor.
@@ -22,40 +116,26 @@ def block1(x, filters, kernel_size=3, stride=1,
         conv_shortcut: default True, use convolution shortcut if True,
             otherwise identity shortcut.
         name: string, block label.
+        data_format: 'channels_last' or 'channels_first', defaults to
+            the Keras config setting.
+        xla_fuse: compile the block with XLA to fuse conv/BN/activation.
+        recompute: recompute the block activations in the backward pass
+            instead of storing them (see RecomputeBlock1).
     # Returns
         Output tensor for the residual block.
     """
-    bn_axis = 3 if backend.image_data_format() == 'channels_last' else 1
-
-    if conv_shortcut is True:
-        shortcut = layers.Conv3D(4 * filters, 1, strides=stride,
-                                 name=name + '_0_conv')(x)
-        shortcut = layers.BatchNormalization(axis=bn_axis, epsilon=1.001e-5,
-                                             name=name + '_0_bn')(shortcut)
-    else:
-        shortcut = x
-
-    x = layers.Conv3D(filters, 1, strides=stride, name=name + '_1_conv')(x)
-    x = layers.BatchNormalization(axis=bn_axis, epsilon=1.001e-5,
-                                  name=name + '_1_bn')(x)
-    x = layers.Activation('relu', name=name + '_1_relu')(x)
-
-    x = layers.Conv3D(filters, kernel_size, padding='SAME',
-                      name=name + '_2_conv')(x)
-    x = layers.BatchNormalization(axis=bn_axis, epsilon=1.001e-5,
-                                  name=name + '_2_bn')(x)
-    x = layers.Activation('relu', name=name + '_2_relu')(x)
+    data_format = data_format or backend.image_data_format()
+    jit_scope = tf.xla.experimental.jit_scope if xla_fuse else _null_scope
+    with jit_scope():
+        if recompute:
+            return RecomputeBlock1(filters, kernel_size, stride, conv_shortcut,
+                                   data_format=data_format,
+                                   name=name)(x)
+        return _apply_block1(x, _block1_layers(filters, kernel_size, stride,
+                                               conv_shortcut, name, data_format))
 
-    x = layers.Conv3D(4 * filters, 1, name=name + '_3_conv')(x)
-    x = layers.BatchNormalization(axis=bn_axis, epsilon=1.001e-5,
-                                  name=name + '_3_bn')(x)
 
-    x = layers.Add(name=name + '_add')([shortcut, x])
-    x = layers.Activation('relu', name=name + '_out')(x)
-    return x
-
-
-def stack1(x, filters, blocks, stride1=2, name=None):
+def stack1(x, filters, blocks, stride1=2, name=None, **block_args):
     """A set of stacked residual blocks.
     # Arguments
         x: input tensor.
@@ -63,12 +143,14 @@ def stack1(x, filters, blocks, stride1=2, name=None):
         blocks: integer, blocks in the stacked blocks.
         stride1: default 2, stride of the first layer in the first block.
         name: string, stack label.
+        block_args: additional arguments passed to block1.
     # Returns
         Output tensor for the stacked blocks.
     """
-    x = block1(x, filters, stride=stride1, name=name + '_block1')
+    x = block1(x, filters, stride=stride1, name=name + '_block1', **block_args)
     for i in range(2, blocks + 1):
-        x = block1(x, filters, conv_shortcut=False, name=name + '_block' + str(i))
+        x = block1(x, filters, conv_shortcut=False,
+                   name=name + '_block' + str(i), **block_args)
     return x
 
 def ResNet(stack_fn,
@@ -80,6 +162,7 @@ def ResNet(stack_fn,
            input_shape=None,
            pooling=None,
            classes=1000,
+           data_format=None,
            **kwargs):
     """Instantiates the ResNet, ResNetV2, and ResNeXt architecture.
     Optionally loads weights pre-trained on ImageNet.
@@ -117,6 +200,9 @@ def ResNet(stack_fn,
         classes: optional number of classes to classify images
             into, only to be specified if `include_top` is True, and
             if no `weights` argument is specified.
+        data_format: 'channels_last' or 'channels_first' layout of the
+            convolutions. The input is always channels-last and is
+            transposed once if needed.
     # Returns
         A Keras model instance.
     # Raises
@@ -133,18 +219,26 @@ def ResNet(stack_fn,
         else:
             img_input = input_tensor
 
-    bn_axis = 3 if backend.image_data_format() == 'channels_last' else 1
+    data_format = data_format or backend.image_data_format()
+    bn_axis = _bn_axis(data_format)
 
-    x = layers.ZeroPadding3D(padding=3, name='conv1_pad')(img_input)
-    x = layers.Conv3D(64, 7, strides=2, use_bias=use_bias, name='conv1_conv')(x)
+    x = img_input
+    if data_format == 'channels_first':
+        x = layers.Permute((4, 1, 2, 3), name='to_channels_first')(x)
+    x = layers.ZeroPadding3D(padding=3, data_format=data_format,
+                             name='conv1_pad')(x)
+    x = layers.Conv3D(64, 7, strides=2, use_bias=use_bias,
+                      data_format=data_format, name='conv1_conv')(x)
 
     if preact is False:
         x = layers.BatchNormalization(axis=bn_axis, epsilon=1.001e-5,
                                       name='conv1_bn')(x)
         x = layers.Activation('relu', name='conv1_relu')(x)
 
-    x = layers.ZeroPadding3D(padding=1, name='pool1_pad')(x)
-    x = layers.MaxPooling3D(3, strides=2, name='pool1_pool')(x)
+    x = layers.ZeroPadding3D(padding=1, data_format=data_format,
+                             name='pool1_pad')(x)
+    x = layers.MaxPooling3D(3, strides=2, data_format=data_format,
+                            name='pool1_pool')(x)
 
     x = stack_fn(x)
 
@@ -154,13 +248,16 @@ def ResNet(stack_fn,
         x = layers.Activation('relu', name='post_relu')(x)
 
     if include_top:
-        x = layers.GlobalAveragePooling3D(name='avg_pool')(x)
+        x = layers.GlobalAveragePooling3D(data_format=data_format,
+                                          name='avg_pool')(x)
         x = layers.Dense(classes, activation='softmax', name='probs')(x)
     else:
         if pooling == 'avg':
-            x = layers.GlobalAveragePooling3D(name='avg_pool')(x)
+            x = layers.GlobalAveragePooling3D(data_format=data_format,
+                                              name='avg_pool')(x)
         elif pooling == 'max':
-            x = layers.GlobalMaxPooling3D(name='max_pool')(x)
+            x = layers.GlobalMaxPooling3D(data_format=data_format,
+                                          name='max_pool')(x)
 
     # Ensure that the model takes into account
     # any potential predecessors of `input_tensor`.
@@ -190,16 +287,29 @@ def ResNet50(input_shape=None,
 
 def CosmoResNet(input_shape=None,
                 pooling=None,
+                data_format=None,
+                xla_fuse=False,
+                recompute=False,
                 **kwargs):
+    """CosmoFlow ResNet with 4 stacks.
+
+    recompute may be a single bool or a list with one bool per stack, to
+    enable activation recomputation for the blocks of selected stacks.
+    """
+    if isinstance(recompute, bool):
+        recompute = [recompute] * 4
+    block_args = dict(data_format=data_format, xla_fuse=xla_fuse)
     def stack_fn(x):
-        x = stack1(x, 32, 2, stride1=1, name='conv2')
-        x = stack1(x, 64, 2, name='conv3')
-        x = stack1(x, 128, 2, name='conv4')
-        x = stack1(x, 256, 2, name='conv5')
+        x = stack1(x, 32, 2, stride1=1, name='conv2',
+                   recompute=recompute[0], **block_args)
+        x = stack1(x, 64, 2, name='conv3', recompute=recompute[1], **block_args)
+        x = stack1(x, 128, 2, name='conv4', recompute=recompute[2], **block_args)
+        x = stack1(x, 256, 2, name='conv5', recompute=recompute[3], **block_args)
         return x
     return ResNet(stack_fn, False, True, 'resnet',
                   include_top=False, weights=None,
                   input_shape=input_shape, pooling=pooling,
+                  data_format=data_format,
                   **kwargs)
 
 def MiniResNet(input_shape, pooling, **kwargs):
@@ -213,19 +323,22 @@ def MiniResNet(input_shape, pooling, **kwargs):
                   input_shape=input_shape, pooling=pooling,
                   **kwargs)
 
-def build_model(input_shape, target_size):
+def build_model(input_shape, target_size,
+                data_format='channels_last', xla_fuse=False, recompute=False):
     """Construct the CosmoFlow 3D CNN model"""
     
     #resnet = ResNet50(input_shape=input_shape, pooling='avg')
-    resnet = CosmoResNet(input_shape=input_shape, pooling='avg')
+    resnet = CosmoResNet(input_shape=input_shape, pooling='avg',
+                         data_format=data_format, xla_fuse=xla_fuse,
+                         recompute=recompute)
 
-    model = models.Sequential()
-    model.add(resnet)
-    model.add(layers.Flatten())
-    model.add(layers.Dense(target_size, activation='tanh'))
-    model.add(layers.Lambda(scale_1p2))
+    # Extend the functional graph rather than nesting resnet in a Sequential
+    # model, which would call it again on a new input outside the XLA scopes.
+    x = layers.Flatten()(resnet.output)
+    x = layers.Dense(target_size, activation='tanh')(x)
+    x = layers.Lambda(scale_1p2)(x)
 
-    return model
+    return models.Model(resnet.inputs, x, name='cosmoresnet')
 
 def _test():
     """Just a function for testing"""
@@ -0,0 +1,115 @@
+"""
+Keras layers for spatial (domain) decomposition of 3D volumes.
+
+In spatial-parallel mode every rank works on the same sample, but only on
+its own slab of the volume along the depth axis. Convolutions exchange halo
+planes with the neighbouring ranks, pooling is done locally on the slabs,
+and the slabs are gathered back into the full volume once they become too
+thin to split further. All communication uses Horovod allgather, whose
+gradient is an allreduce, so the backward pass is handled by TF.
+
+Since all ranks then compute the same loss, the Horovod-averaged gradients
+are the correct full-volume gradients. The collectives span all Horovod
+ranks, so spatial parallelism is limited to the GPUs of a single node.
+
+All layers work on channels-last (N, D, H, W, C) tensors.
+"""
+
+import tensorflow as tf
+import tensorflow.keras.layers as layers
+import horovod.tensorflow as hvd_tf
+
+def _gather_depth(x):
+    """Allgather a (N, D, H, W, C) tensor along the depth axis"""
+    shape = x.shape.as_list()
+    x = tf.transpose(x, [1, 0, 2, 3, 4])
+    x = hvd_tf.allgather(x)
+    x = tf.transpose(x, [1, 0, 2, 3, 4])
+    # The gathered depth is not known statically to TF
+    x.set_shape([shape[0], shape[1] * hvd_tf.size()] + shape[2:])
+    return x
+
+class SpatialSlice(layers.Layer):
+    """Take this rank's slab of the full volume along the depth axis"""
+
+    def __init__(self, rank, size, **kwargs):
+        super(SpatialSlice, self).__init__(**kwargs)
+        self.rank = rank
+        self.size = size
+
+    def call(self, x):
+        depth = tf.compat.dimension_value(x.shape[1]) // self.size
+        return x[:, self.rank*depth:(self.rank+1)*depth]
+
+    def compute_output_shape(self, input_shape):
+        input_shape = tf.TensorShape(input_shape).as_list()
+        return tf.TensorShape([input_shape[0], input_shape[1] // self.size]
+                              + input_shape[2:])
+
+    def get_config(self):
+        config = dict(rank=self.rank, size=self.size)
+        config.update(super(SpatialSlice, self).get_config())
+        return config
+
+class HaloPad3D(layers.Layer):
+    """Pad a slab for a 'valid' convolution equivalent to 'same' on the volume.
+
+    The depth axis is padded with halo planes from the neighbouring ranks
+    (zeros at the edges of the volume), the other spatial axes with zeros.
+    For a kernel of size k, TF 'same' padding puts (k-1)//2 planes before
+    and the rest after.
+    """
+
+    def __init__(self, kernel_size, rank, size, **kwargs):
+        super(HaloPad3D, self).__init__(**kwargs)
+        self.kernel_size = kernel_size
+        self.rank = rank
+        self.size = size
+        self.before = (kernel_size - 1) // 2
+        self.after = kernel_size - 1 - self.before
+
+    def _halo(self, x, n, from_next):
+        """Get n boundary planes of the previous or next rank's slab"""
+        if n == 0:
+            return None
+        source = self.rank + 1 if from_next else self.rank - 1
+        boundary = x[:, :n] if from_next else x[:, -n:]
+        # All ranks take part in the allgather, even at the volume edges.
+        # The result must depend on it there too, or graph pruning drops the
+        # collective (and its backward allreduce) on the edge ranks only.
+        gathered = _gather_depth(boundary)
+        clamped = min(max(source, 0), self.size - 1)
+        halo = gathered[:, clamped*n:(clamped+1)*n]
+        if source != clamped:
+            return halo * 0.
+        return halo
+
+    def call(self, x):
+        parts = [self._halo(x, self.before, from_next=False), x,
+                 self._halo(x, self.after, from_next=True)]
+        x = tf.concat([p for p in parts if p is not None], axis=1)
+        pad = [self.before, self.after]
+        return tf.pad(x, [[0, 0], [0, 0], pad, pad, [0, 0]])
+
+    def compute_output_shape(self, input_shape):
+        input_shape = tf.TensorShape(input_shape).as_list()
+        halo = self.before + self.after
+        return tf.TensorShape([input_shape[0]] +
+                              [d + halo for d in input_shape[1:4]] +
+                              [input_shape[4]])
+
+    def get_config(self):
+        config = dict(kernel_size=self.kernel_size, rank=self.rank, size=self.size)
+        config.update(super(HaloPad3D, self).get_config())
+        return config
+
+class GatherSlabs(layers.Layer):
+    """Gather the slabs of all ranks back into the full volume"""
+
+    def call(self, x):
+        return _gather_depth(x)
+
+    def compute_output_shape(self, input_shape):
+        input_shape = tf.TensorShape(input_shape).as_list()
+        return tf.TensorShape([input_shape[0], input_shape[1] * hvd_tf.size()]
+                              + input_shape[2:])
@@ -17,14 +17,9 @@ def parse_args():
     #        help='Number of resuming submissions for each point')
     return parser.parse_args()
 
-def main():
-    """Main function"""
-
-    # Parse command line arguments
-    args = parse_args()
-
-    # Sample the hyper-parameters
-    hyper_params = [
+def sample_hyper_params(n_evals):
+    """Randomly sample n_evals points of the HPO search space"""
+    return [
         dict(
             apply_log = np.random.choice([1, 0]),
             conv_size = np.random.choice([8, 16, 32, 64]),
@@ -34,9 +29,18 @@ def main():
             optimizer = np.random.choice(['Adam', 'Nadam']),
             lr = np.random.choice([5e-5, 1e-4, 5e-4, 1e-3, 5e-3]),
             hidden_activation = np.random.choice(['ReLU', 'LeakyReLU']),
-        ) for i in range(args.n_evals)
+        ) for i in range(n_evals)
     ]
 
+def main():
+    """Main function"""
+
+    # Parse command line arguments
+    args = parse_args()
+
+    # Sample the hyper-parameters
+    hyper_params = sample_hyper_params(args.n_evals)
+
     # Generate the evaluation commands
     cmd = ('sbatch -N {nodes} -J cosmo-hpo scripts/train_cgpu_requeue.sh'
            ' {config} --apply-log {apply_log} --conv-size {conv_size}'
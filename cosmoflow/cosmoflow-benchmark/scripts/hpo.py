@@ -0,0 +1,338 @@
+"""Run a random HPO search with successive-halving early termination
+
+Trials are sampled from the same search space as generate_hpo.py and run
+train.py with --print-fom; the figure of merit (best val_loss) is parsed
+from the 'FoM:' line of the training output.
+
+Successive halving runs all trials for --min-epochs, keeps the best
+1/--eta of them, and continues the survivors for eta times as many epochs,
+until --max-epochs is reached. With the local backend a promoted trial
+resumes from its own checkpoints, so no epochs are repeated. AzureML runs
+do not share an output directory, so promoted trials are rerun from
+scratch with the larger budget.
+
+Small trials do not need a whole node. With --pack, up to --gpus-per-node
+single-GPU trials share a node, each pinned to its own GPU: the local
+backend hands out the GPUs of this machine, and the AzureML backend
+submits groups of trials as single-node runs of scripts/run_packed.py.
+The local backend also pins concurrent trials to their own GPUs whenever
+--n-parallel is above 1, running at most --gpus-per-node at a time.
+
+Run from the cosmoflow-benchmark directory, e.g.
+
+    python scripts/hpo.py --n-trials 27 --n-parallel 4 --min-epochs 4 --max-epochs 36
+"""
+
+# System imports
+import os
+import re
+import sys
+import json
+import queue
+import shlex
+import argparse
+import logging
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# External imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from generate_hpo import sample_hyper_params
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser('hpo.py')
+    add_arg = parser.add_argument
+    add_arg('--config', default='configs/cosmo.yaml')
+    add_arg('--output-dir', default='results/hpo',
+            help='Directory for the trial outputs and the results table')
+    add_arg('--n-trials', type=int, default=16,
+            help='Number of HP points to sample')
+    add_arg('--n-parallel', type=int, default=1,
+            help='Number of trials to run concurrently')
+    add_arg('--min-epochs', type=int, default=4,
+            help='Epochs of the first successive-halving rung')
+    add_arg('--max-epochs', type=int, default=32,
+            help='Epochs of the last rung (equal to --min-epochs disables pruning)')
+    add_arg('--eta', type=int, default=2,
+            help='Keep the best 1/eta of the trials at each rung')
+    add_arg('--seed', type=int, help='Random seed for sampling the trials')
+    add_arg('--backend', choices=['local', 'azureml'], default='local')
+    add_arg('--train-args', default='',
+            help='Extra arguments passed to train.py')
+    add_arg('--pack', action='store_true',
+            help='Run single-GPU trials, packed --gpus-per-node to a node')
+
+    # Local backend settings
+    add_arg('--python', default=sys.executable,
+            help='Python interpreter for local trials')
+
+    # AzureML backend settings
+    add_arg('--cluster', help='AzureML compute target name')
+    add_arg('--environment', help='AzureML environment name')
+    add_arg('--experiment', default='Cosmoflow-HPO')
+    add_arg('--nodes', type=int, default=1, help='Number nodes per trial')
+    add_arg('--gpus-per-node', type=int, default=8)
+    add_arg('--packed-args', default='',
+            help='Extra arguments passed to run_packed.py, e.g. for staging')
+    return parser.parse_args()
+
+def parse_fom(output):
+    """Get the figure of merit from the last 'FoM:' line of a trial output"""
+    matches = re.findall(r'^FoM:\s*(\S+)', output, flags=re.MULTILINE)
+    if len(matches) == 0:
+        return None
+    try:
+        return float(matches[-1])
+    except ValueError:
+        return None
+
+def parse_trial_foms(output):
+    """Get the per-trial figures of merit printed by run_packed.py"""
+    foms = {}
+    for trial_id, value in re.findall(r'^Trial (\d+) FoM:\s*(\S+)', output,
+                                      flags=re.MULTILINE):
+        foms[int(trial_id)] = parse_fom('FoM: ' + value)
+    return foms
+
+def trial_args(hyper_params):
+    """Command line arguments of train.py for one HP point"""
+    args = []
+    for key, value in hyper_params.items():
+        args.extend(['--' + key.replace('_', '-'), str(value)])
+    return args
+
+class LocalBackend(object):
+    """Runs trials as train.py subprocesses on this machine.
+
+    If gpus is given, each trial is pinned to one of these GPUs, and a
+    trial waits until a GPU is free.
+    """
+
+    job_size = 1
+
+    def __init__(self, config, output_dir, python=sys.executable,
+                 extra_args=None, gpus=None):
+        self.config = config
+        self.output_dir = output_dir
+        self.python = python
+        self.extra_args = extra_args or []
+        self.free_gpus = None
+        if gpus is not None:
+            self.free_gpus = queue.Queue()
+            for gpu in gpus:
+                self.free_gpus.put(gpu)
+
+    def run(self, trial_id, hyper_params, n_epochs):
+        """Run (or resume) a trial up to n_epochs and return its FoM"""
+        trial_dir = os.path.join(self.output_dir, 'trial%03i' % trial_id)
+        os.makedirs(trial_dir, exist_ok=True)
+        cmd = ([self.python, 'train.py', self.config,
+                '--output-dir', trial_dir, '--n-epochs', str(n_epochs),
+                '--print-fom'] + trial_args(hyper_params) + self.extra_args)
+        if os.path.exists(os.path.join(trial_dir, 'latest')):
+            cmd.append('--resume')
+        gpu = self.free_gpus.get() if self.free_gpus is not None else None
+        if gpu is not None:
+            cmd.extend(['--gpu', str(gpu)])
+        logging.debug('Trial %i: %s', trial_id, ' '.join(cmd))
+        try:
+            with open(os.path.join(trial_dir, 'out.log'), 'a') as log_file:
+                result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                        stderr=log_file, universal_newlines=True)
+                log_file.write(result.stdout)
+        finally:
+            if gpu is not None:
+                self.free_gpus.put(gpu)
+        if result.returncode != 0:
+            logging.warning('Trial %i failed with exit code %i',
+                            trial_id, result.returncode)
+        return parse_fom(result.stdout)
+
+    def run_job(self, trial_ids, hyper_params, n_epochs):
+        return [self.run(i, hp, n_epochs)
+                for i, hp in zip(trial_ids, hyper_params)]
+
+class AzureMLBackend(object):
+    """Runs trials as AzureML runs through a ScriptRunConfig.
+
+    Without packing, each trial is one run on nodes nodes. With packing,
+    each run takes one node and trains up to gpus_per_node trials.
+    """
+
+    def __init__(self, config, cluster, environment, experiment,
+                 nodes=1, gpus_per_node=8, extra_args=None,
+                 pack=False, packed_args=None):
+        from azureml.core import (Workspace, Experiment, Environment,
+                                  ComputeTarget)
+        workspace = Workspace.from_config()
+        self.compute_target = ComputeTarget(workspace=workspace, name=cluster)
+        self.environment = Environment.get(workspace, name=environment)
+        self.experiment = Experiment(workspace=workspace, name=experiment)
+        self.config = config
+        self.nodes = nodes
+        self.gpus_per_node = gpus_per_node
+        self.extra_args = extra_args or []
+        self.pack = pack
+        self.packed_args = packed_args or []
+        self.job_size = gpus_per_node if pack else 1
+
+    def _submit(self, script, args, distributed_job_config, tags):
+        """Submit a run, wait for it and return the text of its logs"""
+        from azureml.core import ScriptRunConfig
+        script_conf = ScriptRunConfig(
+            source_directory='.',
+            script=script,
+            compute_target=self.compute_target,
+            environment=self.environment,
+            arguments=args,
+            distributed_job_config=distributed_job_config,
+        )
+        run = self.experiment.submit(config=script_conf, tags=tags)
+        run.wait_for_completion(show_output=False, raise_on_error=False)
+        output = ''
+        with tempfile.TemporaryDirectory() as log_dir:
+            for log_file in run.get_all_logs(destination=log_dir):
+                with open(log_file, errors='replace') as f:
+                    output += f.read() + '\n'
+        return run, output
+
+    def run(self, trial_id, hyper_params, n_epochs):
+        """Submit a trial with n_epochs, wait for it and return its FoM"""
+        from azureml.core.runconfig import MpiConfiguration
+        args = ([self.config, '--output-dir', './outputs',
+                 '--n-epochs', str(n_epochs), '--print-fom',
+                 '--distributed', '--rank-gpu'] +
+                trial_args(hyper_params) + self.extra_args)
+        tags = dict(trial=trial_id, epochs=n_epochs,
+                    **{k: str(v) for k, v in hyper_params.items()})
+        run, output = self._submit('train.py', args, MpiConfiguration(
+            node_count=self.nodes, process_count_per_node=self.gpus_per_node),
+            tags)
+
+        # The FoM line is printed by rank 0 into the driver logs
+        fom = parse_fom(output)
+        if fom is not None:
+            run.log('FoM', fom)
+        return fom
+
+    def run_job(self, trial_ids, hyper_params, n_epochs):
+        """Run a group of trials, packed onto one node if packing"""
+        if not self.pack:
+            return [self.run(i, hp, n_epochs)
+                    for i, hp in zip(trial_ids, hyper_params)]
+        trials = {str(i): {k: str(v) for k, v in hp.items()}
+                  for i, hp in zip(trial_ids, hyper_params)}
+        args = ([self.config, '--output-dir', './outputs',
+                 '--n-epochs', str(n_epochs), '--n-gpus', str(self.gpus_per_node),
+                 '--trials', json.dumps(trials),
+                 '--train-args=' + ' '.join(shlex.quote(a) for a in self.extra_args)]
+                + self.packed_args)
+        tags = dict(trials=','.join(trials), epochs=n_epochs)
+        run, output = self._submit('scripts/run_packed.py', args, None, tags)
+        foms = parse_trial_foms(output)
+        for i, fom in foms.items():
+            if fom is not None:
+                run.log('FoM', fom, description='trial %i' % i)
+        return [foms.get(i) for i in trial_ids]
+
+def successive_halving(backend, trials, min_epochs, max_epochs, eta, n_parallel):
+    """Run the trials with successive halving and return the results table.
+
+    trials is a list of HP dicts; the table has one row per trial with the
+    HPs and the FoM reached at each rung (NaN if the trial was pruned).
+    """
+    results = pd.DataFrame(trials)
+    results.index.name = 'trial'
+    active = list(range(len(trials)))
+    n_epochs = min_epochs
+    with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+        while True:
+            logging.info('Rung with %i epochs: running %i trials',
+                         n_epochs, len(active))
+            # Group the trials into jobs of the backend's size
+            jobs = [active[j:j+backend.job_size]
+                    for j in range(0, len(active), backend.job_size)]
+            futures = {executor.submit(backend.run_job, job,
+                                       [trials[i] for i in job], n_epochs): job
+                       for job in jobs}
+            column = 'fom_%i' % n_epochs
+            results[column] = np.nan
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    foms = future.result()
+                except Exception:
+                    logging.exception('Trials %s raised an error', job)
+                    foms = [None] * len(job)
+                for i, fom in zip(job, foms):
+                    results.loc[i, column] = np.nan if fom is None else fom
+                    logging.info('Trial %i at %i epochs: FoM %s', i, n_epochs, fom)
+
+            if n_epochs >= max_epochs or len(active) <= 1:
+                break
+
+            # Promote the best trials; failed trials sort last
+            n_keep = max(1, len(active) // eta)
+            active = list(results.loc[active, column]
+                          .sort_values(na_position='last').index[:n_keep])
+            n_epochs = min(n_epochs * eta, max_epochs)
+
+    results['fom'] = results[column]
+    return results
+
+def config_logging():
+    log_format = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_format)
+
+def main():
+    """Main function"""
+    args = parse_args()
+    config_logging()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.seed is not None:
+        np.random.seed(args.seed)
+    trials = sample_hyper_params(args.n_trials)
+
+    extra_args = shlex.split(args.train_args)
+    n_parallel = args.n_parallel
+    if args.backend == 'local':
+        gpus = None
+        if args.pack:
+            gpus = list(range(args.gpus_per_node))
+            n_parallel = args.gpus_per_node
+        elif n_parallel > 1:
+            # Concurrent trials must not share the GPUs of this machine
+            gpus = list(range(args.gpus_per_node))
+            n_parallel = min(n_parallel, args.gpus_per_node)
+        backend = LocalBackend(args.config, args.output_dir,
+                               python=args.python, extra_args=extra_args,
+                               gpus=gpus)
+    else:
+        backend = AzureMLBackend(args.config, args.cluster, args.environment,
+                                 args.experiment, nodes=args.nodes,
+                                 gpus_per_node=args.gpus_per_node,
+                                 extra_args=extra_args, pack=args.pack,
+                                 packed_args=shlex.split(args.packed_args))
+
+    results = successive_halving(backend, trials, args.min_epochs,
+                                 args.max_epochs, args.eta, n_parallel)
+    results_file = os.path.join(args.output_dir, 'hpo_results.csv')
+    results.to_csv(results_file)
+    logging.info('Wrote results to %s', results_file)
+
+    best = results.fom.idxmin() if results.fom.notna().any() else None
+    if best is None:
+        logging.warning('No trial reached the final rung successfully')
+    else:
+        logging.info('Best trial %i with FoM %g:', best, results.fom[best])
+        for key, value in trials[best].items():
+            logging.info('  %s: %s', key, value)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Train several single-GPU HPO trials side by side on one node
+
+This is the node-side script of the packed mode of scripts/hpo.py. The
+data is staged once to node-local storage (either copied from --data-dir
+to --stage-dir, or pulled from Azure blob storage), and then every trial
+runs train.py pinned to its own GPU with its own output directory, all
+reading the same staged files. Each trial's figure of merit is printed as
+a 'Trial <id> FoM: <value>' line.
+
+Run from the cosmoflow-benchmark directory.
+"""
+
+# System imports
+import os
+import sys
+import json
+import shlex
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# External imports
+import yaml
+
+# Local imports
+sys.path.insert(0, os.getcwd())
+from hpo import LocalBackend
+from utils.staging import stage_files
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser('run_packed.py')
+    add_arg = parser.add_argument
+    add_arg('config', nargs='?', default='configs/cosmo.yaml')
+    add_arg('--trials', required=True,
+            help='JSON dict of trial id to hyper-parameters')
+    add_arg('--output-dir', default='./outputs')
+    add_arg('--n-epochs', type=int, required=True)
+    add_arg('--n-gpus', type=int, default=8)
+    add_arg('--train-args', default='',
+            help='Extra arguments passed to train.py')
+
+    # Data staging, done once for all trials
+    add_arg('--data-dir', help='Override the path to input files')
+    add_arg('--stage-dir', help='Local directory to stage data to before training')
+    add_arg('--account', help='Azure Blob Account Name')
+    add_arg('--container', help='Azure Blob Account Container')
+    add_arg('--sas', help='Azure Blob Account SAS')
+    add_arg('--beeond-stage-dir', help='Pull the data from blob storage to here')
+    return parser.parse_args()
+
+def stage_data(args, data_config):
+    """Stage the data once for all trials and return the directory to read"""
+    data_dir = os.path.expandvars(args.data_dir or data_config['data_dir'])
+    if args.beeond_stage_dir is not None:
+        from beeondutils import pull_data_from_blob_sharded
+        pull_data_from_blob_sharded(args.account, args.container,
+                                    args.beeond_stage_dir, args.sas)
+        return args.beeond_stage_dir
+    if args.stage_dir is not None:
+        for split, n_files in [('train', data_config['n_train']),
+                               ('validation', data_config['n_valid'])]:
+            stage_files(os.path.join(data_dir, split),
+                        os.path.join(args.stage_dir, split), n_files=n_files)
+        return args.stage_dir
+    return data_dir
+
+def main():
+    """Main function"""
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    with open(args.config) as f:
+        data_config = yaml.load(f, Loader=yaml.FullLoader)['data']
+
+    data_dir = stage_data(args, data_config)
+    trials = {int(i): hp for i, hp in json.loads(args.trials).items()}
+    n_gpus = min(args.n_gpus, len(trials))
+    logging.info('Running %i trials on %i GPUs', len(trials), n_gpus)
+
+    extra_args = ['--data-dir', data_dir] + shlex.split(args.train_args)
+    backend = LocalBackend(args.config, args.output_dir, python=sys.executable,
+                           extra_args=extra_args, gpus=range(n_gpus))
+    with ThreadPoolExecutor(max_workers=n_gpus) as executor:
+        futures = {i: executor.submit(backend.run, i, hp, args.n_epochs)
+                   for i, hp in trials.items()}
+        for i, future in futures.items():
+            print('Trial %i FoM: %s' % (i, future.result()), flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+"""Make the benchmark modules importable when running pytest from anywhere"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,33 @@
+"""Tests for the in-graph learning rate schedule"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('horovod.tensorflow')
+pytest.importorskip('mlperf_logging')
+
+from utils.optimizers import StepLRSchedule
+
+def lr_at(schedule, step):
+    return float(tf.keras.backend.get_value(
+        schedule(tf.constant(step, tf.int64))))
+
+@pytest.mark.parametrize('decay', ['step', 'cosine'])
+def test_schedule_counts_updates_with_grad_accum(decay):
+    # 10 updates per epoch of 4 micro-batches each
+    kwargs = dict(base_lr=0.1, peak_lr=1., steps_per_epoch=10,
+                  n_warmup_epochs=1, decay=decay, decay_schedule={1: 0.5},
+                  n_decay_epochs=2)
+    accum = StepLRSchedule(grad_accum_steps=4, **kwargs)
+    plain = StepLRSchedule(**kwargs)
+    for update in [0, 5, 10, 15, 20, 29, 30]:
+        for micro_step in range(4 * update, 4 * update + 4):
+            assert lr_at(accum, micro_step) == pytest.approx(
+                lr_at(plain, update))
+
+def test_warmup_ends_after_one_epoch_of_micro_batches():
+    schedule = StepLRSchedule(base_lr=0.1, peak_lr=1., steps_per_epoch=10,
+                              n_warmup_epochs=1, grad_accum_steps=4)
+    assert lr_at(schedule, 39) < 1.
+    assert lr_at(schedule, 40) == pytest.approx(1.)
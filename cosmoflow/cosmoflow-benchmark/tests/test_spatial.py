@@ -0,0 +1,39 @@
+"""Tests for the spatial-parallel halo exchange
+
+Run on two ranks, e.g. horovodrun -np 2 python -m pytest tests/test_spatial.py
+"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+hvd = pytest.importorskip('horovod.tensorflow')
+
+from models.spatial import HaloPad3D
+
+@pytest.fixture(scope='module')
+def session():
+    hvd.init()
+    if hvd.size() != 2:
+        pytest.skip('needs exactly 2 Horovod ranks')
+    tf.compat.v1.disable_eager_execution()
+    with tf.compat.v1.Session() as sess:
+        yield sess
+
+def test_halo_forward_and_backward_on_edge_ranks(session):
+    # Both ranks are volume edges; each must still join both collectives
+    rank = hvd.rank()
+    slab = np.full([1, 2, 2, 2, 1], rank + 1., dtype=np.float32)
+    x = tf.constant(slab)
+    y = HaloPad3D(3, rank, hvd.size())(x)
+    grad = tf.gradients(tf.reduce_sum(y), x)[0]
+
+    y_val, grad_val = session.run([y, grad])
+
+    assert y_val.shape == (1, 4, 4, 4, 1)
+    depth = y_val[0, :, 1:-1, 1:-1, 0].mean(axis=(1, 2))
+    if rank == 0:
+        np.testing.assert_allclose(depth, [0., 1., 1., 2.])
+    else:
+        np.testing.assert_allclose(depth, [1., 2., 2., 0.])
+    assert np.all(np.isfinite(grad_val))
@@ -0,0 +1,21 @@
+"""Tests for the straggler outlier detection"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('tensorflow')
+pytest.importorskip('horovod.tensorflow')
+pytest.importorskip('mlperf_logging')
+
+from utils.stragglers import find_outliers
+
+def test_single_input_bound_rank_with_zero_data_wait():
+    # Most ranks never wait for data; the one that does must be flagged
+    assert find_outliers([0., 0., 0., 0.5]) == [3]
+
+def test_noise_level_deviations_not_flagged():
+    assert find_outliers([0., 0., 0.001, 0.002]) == []
+    assert find_outliers([1.0, 1.001, 0.999, 1.002]) == []
+
+def test_slow_step_time_flagged():
+    assert find_outliers([1.0, 1.01, 0.99, 1.0, 2.0]) == [4]
@@ -52,13 +52,17 @@ from data import get_datasets
 from models import get_model
 # Fix for loading Lambda layer checkpoints
 from models.layers import *
-from utils.optimizers import get_optimizer, get_lr_schedule
+from utils.optimizers import get_optimizer, get_lr_schedule, StepLRSchedule
 from utils.callbacks import (TimingCallback, MLPerfLoggingCallback,
-                             StopAtTargetCallback)
+                             StopAtTargetCallback, CheckpointCallback,
+                             StepTimingCallback, ProfilingCallback,
+                             PeakMemoryCallback, AdaptiveValidationCallback)
 from utils.device import configure_session
 from utils.argparse import ReadYaml
-from utils.checkpoints import reload_last_checkpoint
+from utils.checkpoints import (reload_last_checkpoint, restore_checkpoint,
+                               read_latest, AsyncCheckpointWriter)
 from utils.mlperf_logging import configure_mllogger, log_submission_info
+from utils.stragglers import StragglerMonitor
 
 # Stupid workaround until absl logging fix, see:
 # https://github.com/tensorflow/tensorflow/issues/26691
@@ -101,13 +105,23 @@ def parse_args():
     add_arg('--dropout', type=float, help='Override dropout')
     add_arg('--optimizer', help='Override optimizer type')
     add_arg('--lr', type=float, help='Override learning rate')
+    add_arg('--grad-accum-steps', type=int,
+            help='Override number of micro-batches per optimizer update')
 
     # Runtime / device settings
     add_arg('-d', '--distributed', action='store_true')
     add_arg('--rank-gpu', action='store_true',
             help='Use GPU based on local rank')
+    add_arg('--gpu', type=int,
+            help='Use this GPU, e.g. for trials packed onto one node')
     add_arg('--resume', action='store_true',
             help='Resume from last checkpoint')
+    add_arg('--checkpoint-steps', type=int,
+            help='Also checkpoint every this many training steps')
+    add_arg('--checkpoint-keep-last', type=int,
+            help='Only keep this many most recent checkpoints')
+    add_arg('--checkpoint-keep-best', type=int,
+            help='Also keep this many checkpoints with lowest val_loss')
     add_arg('--intra-threads', type=int, default=32,
             help='TF intra-parallel threads')
     add_arg('--inter-threads', type=int, default=2,
@@ -115,14 +129,30 @@ def parse_args():
     add_arg('--kmp-blocktime', help='Set KMP_BLOCKTIME')
     add_arg('--kmp-affinity', help='Set KMP_AFFINITY')
     add_arg('--omp-num-threads', help='Set OMP_NUM_THREADS')
+    add_arg('--xla', action='store_true',
+            help='Enable XLA JIT compilation of the model graph')
 
     # Other settings
     add_arg('--tensorboard', action='store_true',
             help='Enable TB logger')
+    add_arg('--profile-steps',
+            help='Profile training steps START:END to output_dir/profile')
+    add_arg('--profile-ranks', default='0',
+            help='Comma separated ranks to profile')
+    add_arg('--report-memory', action='store_true',
+            help='Record peak GPU memory per epoch')
     add_arg('--print-fom', action='store_true',
             help='Print parsable figure of merit')
+    add_arg('--timing-steps', type=int,
+            help='Record per-step timing, aggregated across ranks every N steps')
+    add_arg('--straggler-k', type=float,
+            help='Flag ranks beyond k*MAD of the median (needs --timing-steps)')
+    add_arg('--ibaddrs', help='Comma separated cluster IB addresses in nodefile order')
     add_arg('-v', '--verbose', action='store_true')
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.straggler_k is not None and args.timing_steps is None:
+        parser.error('--straggler-k requires --timing-steps')
+    return args
 
 def init_workers(distributed=False):
     if distributed:
@@ -182,6 +212,14 @@ def load_config(args):
         config['optimizer']['name'] = args.optimizer
     if args.lr is not None:
         config['optimizer']['lr'] = args.lr
+    if args.grad_accum_steps is not None:
+        config['train']['grad_accum_steps'] = args.grad_accum_steps
+    if args.checkpoint_steps is not None:
+        config['train']['checkpoint_steps'] = args.checkpoint_steps
+    if args.checkpoint_keep_last is not None:
+        config['train']['checkpoint_keep_last'] = args.checkpoint_keep_last
+    if args.checkpoint_keep_best is not None:
+        config['train']['checkpoint_keep_best'] = args.checkpoint_keep_best
 
     return config
 
@@ -207,6 +245,21 @@ def print_training_summary(output_dir, print_fom):
             print('FoM:', history['val_loss'].loc[best])
     logging.info('Total epoch time: %.3f', history.time.sum())
     logging.info('Mean epoch time: %.3f', history.time.mean())
+    if 'peak_memory_gb' in history.keys():
+        logging.info('Peak GPU memory: %.3f GB', history.peak_memory_gb.max())
+    if 'compile_time' in history.keys():
+        logging.info('Compile time: %.3f', history.compile_time.sum())
+        logging.info('Validation compile time: %.3f',
+                     history.val_compile_time.sum())
+        logging.info('Mean epoch time excluding compile: %.3f',
+                     history.time_excl_compile.mean())
+    if 'step_time_median' in history.keys():
+        logging.info('Mean step time (median over ranks): %.4f',
+                     history.step_time_median.mean())
+        logging.info('Mean data wait (median over ranks): %.4f',
+                     history.data_wait_median.mean())
+        logging.info('Mean throughput: %.2f samples/s',
+                     history.global_samples_per_sec.mean())
 
 def main():
     """Main function"""
@@ -244,7 +297,7 @@ def main():
         mllogger.start(key=mllog.constants.INIT_START)
 
     # Device and session configuration
-    gpu = dist.local_rank if args.rank_gpu else None
+    gpu = dist.local_rank if args.rank_gpu else args.gpu
     if gpu is not None:
         logging.info('Taking gpu %i', gpu)
     configure_session(gpu=gpu,
@@ -252,7 +305,8 @@ def main():
                       inter_threads=args.inter_threads,
                       kmp_blocktime=args.kmp_blocktime,
                       kmp_affinity=args.kmp_affinity,
-                      omp_num_threads=args.omp_num_threads)
+                      omp_num_threads=args.omp_num_threads,
+                      xla=args.xla)
 
     # Start MLPerf logging
     if dist.rank == 0:
@@ -262,31 +316,62 @@ def main():
 
     # Load the data
     data_config = config['data']
+    train_config = config['train']
+    grad_accum_steps = train_config.get('grad_accum_steps', 1)
+    spatial_parallel = config['model'].get('spatial_parallel', False)
     if dist.rank == 0:
         logging.info('Loading data')
-    datasets = get_datasets(dist=dist, **data_config)
+    datasets = get_datasets(dist=dist, grad_accum_steps=grad_accum_steps,
+                            spatial_parallel=spatial_parallel, **data_config)
     logging.debug('Datasets: %s', datasets)
 
+    # Learning rate schedule
+    lr_schedule = None
+    if 'lr_schedule' in config:
+        # Each optimizer update sees grad_accum_steps micro-batches per
+        # data-parallel replica; spatial-parallel ranks share their samples
+        n_replicas = 1 if spatial_parallel else dist.size
+        global_batch_size = (data_config['batch_size'] * n_replicas *
+                             grad_accum_steps)
+        lr_schedule = get_lr_schedule(
+            global_batch_size=global_batch_size,
+            steps_per_epoch=datasets['n_train_steps'] // grad_accum_steps,
+            grad_accum_steps=grad_accum_steps,
+            n_epochs=data_config['n_epochs'], **config['lr_schedule'])
+    opt_config = dict(config['optimizer'])
+    if isinstance(lr_schedule, StepLRSchedule):
+        opt_config.pop('lr', None)
+        opt_config['learning_rate'] = lr_schedule
+
     # Construct or reload the model
     if dist.rank == 0:
         logging.info('Building the model')
-    train_config = config['train']
     initial_epoch = 0
     checkpoint_format = os.path.join(config['output_dir'], 'checkpoint-{epoch:03d}.h5')
-    if args.resume and os.path.exists(checkpoint_format.format(epoch=1)):
-        # Reload model from last checkpoint
+    latest = read_latest(config['output_dir']) if args.resume else None
+    if latest is None and args.resume and os.path.exists(checkpoint_format.format(epoch=1)):
+        # Reload model from last full-model checkpoint
         initial_epoch, model = reload_last_checkpoint(
             checkpoint_format, data_config['n_epochs'],
-            distributed=args.distributed)
+            distributed=args.distributed,
+            grad_accum_steps=grad_accum_steps)
+        if isinstance(lr_schedule, StepLRSchedule):
+            raise ValueError('Per-step LR schedules cannot resume from '
+                             'full-model checkpoints')
     else:
         # Build a new model
         model = get_model(**config['model'])
         # Configure the optimizer
         opt = get_optimizer(distributed=args.distributed,
-                            **config['optimizer'])
+                            grad_accum_steps=grad_accum_steps,
+                            **opt_config)
         # Compile the model
         model.compile(optimizer=opt, loss=train_config['loss'],
                       metrics=train_config['metrics'])
+        # Restore weights from the latest checkpoint pointer
+        if latest is not None:
+            logging.info('Found latest checkpoint at %s', latest['checkpoint'])
+            initial_epoch, _ = restore_checkpoint(model, latest['checkpoint'])
 
     if dist.rank == 0:
         model.summary()
@@ -308,20 +393,64 @@ def main():
         # Average metrics across workers
         callbacks.append(hvd.callbacks.MetricAverageCallback())
 
-    # Learning rate decay schedule
-    if 'lr_schedule' in config:
-        global_batch_size = data_config['batch_size'] * dist.size
-        callbacks.append(tf.keras.callbacks.LearningRateScheduler(
-            get_lr_schedule(global_batch_size=global_batch_size,
-                            **config['lr_schedule'])))
+    # Validate on a fixed subset, escalating to the full set near the target
+    validation_data = datasets['valid_dataset']
+    validation_steps = datasets['n_valid_steps']
+    if datasets.get('valid_subset_dataset') is not None:
+        validation_data = datasets['valid_subset_dataset']
+        validation_steps = datasets['n_valid_subset_steps']
+        callbacks.append(AdaptiveValidationCallback(
+            datasets['valid_dataset'], datasets['n_valid_steps'],
+            target_max=train_config.get('target_mae', None),
+            margin=train_config.get('full_validation_margin', 0.1),
+            distributed=args.distributed, log_mlperf=(dist.rank == 0)))
+
+    # Learning rate decay schedule, unless evaluated in the graph
+    if lr_schedule is not None and not isinstance(lr_schedule, StepLRSchedule):
+        callbacks.append(tf.keras.callbacks.LearningRateScheduler(lr_schedule))
 
     # Timing
     timing_callback = TimingCallback()
     callbacks.append(timing_callback)
+    if args.timing_steps is not None:
+        tb_dir = (os.path.join(config['output_dir'], 'tensorboard')
+                  if (args.tensorboard and dist.rank == 0) else None)
+        straggler_monitor = None
+        if args.straggler_k is not None:
+            straggler_monitor = StragglerMonitor(
+                dist.rank, dist.local_rank, config['output_dir'],
+                k=args.straggler_k,
+                ibaddrs=args.ibaddrs.split(',') if args.ibaddrs else None)
+        step_timing_callback = StepTimingCallback(
+            data_config['batch_size'], aggregate_steps=args.timing_steps,
+            distributed=args.distributed, log_dir=tb_dir,
+            straggler_monitor=straggler_monitor)
+        datasets['train_dataset'] = step_timing_callback.wrap_dataset(
+            datasets['train_dataset'])
+        callbacks.append(step_timing_callback)
+
+    # Peak memory reporting
+    if args.report_memory:
+        callbacks.append(PeakMemoryCallback())
+
+    # Profiling of a window of steps on selected ranks
+    profile_ranks = [int(r) for r in args.profile_ranks.split(',')]
+    if args.profile_steps is not None and dist.rank in profile_ranks:
+        start_step, end_step = [int(s) for s in args.profile_steps.split(':')]
+        callbacks.append(ProfilingCallback(
+            os.path.join(config['output_dir'], 'profile', 'rank%i' % dist.rank),
+            start_step, end_step))
 
     # Checkpointing and logging from rank 0 only
     if dist.rank == 0:
-        callbacks.append(tf.keras.callbacks.ModelCheckpoint(checkpoint_format))
+        checkpoint_writer = AsyncCheckpointWriter(
+            config['output_dir'],
+            keep_last=train_config.get('checkpoint_keep_last', None),
+            keep_best=train_config.get('checkpoint_keep_best', None),
+            resume=args.resume)
+        callbacks.append(CheckpointCallback(
+            checkpoint_writer, steps_per_epoch=datasets['n_train_steps'],
+            save_steps=train_config.get('checkpoint_steps', None)))
         callbacks.append(tf.keras.callbacks.CSVLogger(
             os.path.join(config['output_dir'], 'history.csv'), append=args.resume))
         if args.tensorboard:
@@ -349,8 +478,8 @@ def main():
     model.fit(datasets['train_dataset'],
               steps_per_epoch=datasets['n_train_steps'],
               epochs=data_config['n_epochs'],
-              validation_data=datasets['valid_dataset'],
-              validation_steps=datasets['n_valid_steps'],
+              validation_data=validation_data,
+              validation_steps=validation_steps,
               callbacks=callbacks,
               initial_epoch=initial_epoch,
               verbose=fit_verbose)
@@ -30,13 +30,20 @@ This module contains some utility callbacks for Keras training.
 """
 
 # System
+import os
 from time import time
+from collections import deque
 import logging
 
 # Externals
+import numpy as np
 import tensorflow as tf
+import horovod.tensorflow as hvd_tf
 from mlperf_logging import mllog
 
+# Locals
+from utils import profiling
+
 class MLPerfLoggingCallback(tf.keras.callbacks.Callback):
     """A Keras Callback for logging MLPerf results"""
     def __init__(self, metric='val_mean_absolute_error', log_key='eval_error'):
@@ -77,15 +84,340 @@ class StopAtTargetCallback(tf.keras.callbacks.Callback):
             self.model.stop_training = True
             logging.info('Target reached; stopping training')
 
+class AdaptiveValidationCallback(tf.keras.callbacks.Callback):
+    """A Keras callback escalating subset validation to the full dataset.
+
+    Training validates on a fixed random subset of the validation data.
+    When the subset metric comes within a relative margin of the target,
+    this callback evaluates the full validation dataset and replaces the
+    val_* entries of the epoch logs, so that callbacks placed after it
+    (target stopping, early stopping, checkpointing, logging) see the full
+    result. The subset values are kept as subset_val_* and full_validation
+    records whether the full set was evaluated.
+
+    In distributed mode the full results are averaged over the workers;
+    this callback must come after the Horovod MetricAverageCallback so all
+    workers make the same escalation decision.
+    """
+
+    def __init__(self, dataset, steps, target_max, margin=0.1,
+                 metric='val_mean_absolute_error', distributed=False,
+                 log_mlperf=False):
+        self.dataset = dataset
+        self.steps = steps
+        self.target_max = target_max
+        self.margin = margin
+        self.metric = metric
+        self.distributed = distributed
+        self.mllogger = mllog.get_mllogger() if log_mlperf else None
+
+    def on_train_begin(self, logs={}):
+        if self.distributed:
+            # Build the allreduce op once to avoid growing the graph every call
+            self._results_input = tf.compat.v1.placeholder(tf.float32, [None])
+            self._results_op = hvd_tf.allreduce(self._results_input,
+                                                name='full_validation')
+
+    def on_epoch_end(self, epoch, logs={}):
+        val_keys = [k for k in logs if k.startswith('val_')]
+        for key in val_keys:
+            logs['subset_' + key] = logs[key]
+        subset_metric = logs[self.metric]
+        if self.mllogger is not None:
+            self.mllogger.event(key='eval_error_subset', value=subset_metric,
+                                metadata={'epoch_num': epoch})
+
+        full = (self.target_max is not None and
+                subset_metric <= self.target_max * (1 + self.margin))
+        logs['full_validation'] = int(full)
+        if not full:
+            return
+
+        logging.info('Subset %s %.4f within %.0f%% of target; '
+                     'running full validation', self.metric, subset_metric,
+                     100 * self.margin)
+        if self.mllogger is not None:
+            self.mllogger.start(key=mllog.constants.EVAL_START,
+                                metadata={'epoch_num': epoch, 'full': True})
+        results = np.atleast_1d(np.asarray(
+            self.model.evaluate(self.dataset, steps=self.steps, verbose=0),
+            dtype=np.float32))
+        if self.distributed:
+            results = tf.keras.backend.get_session().run(
+                self._results_op, feed_dict={self._results_input: results})
+        for name, value in zip(self.model.metrics_names, results):
+            logs['val_' + name] = float(value)
+        if self.mllogger is not None:
+            self.mllogger.end(key=mllog.constants.EVAL_STOP,
+                              metadata={'epoch_num': epoch, 'full': True})
+            self.mllogger.event(key='eval_error_full', value=logs[self.metric],
+                                metadata={'epoch_num': epoch})
+
 class TimingCallback(tf.keras.callbacks.Callback):
-    """A Keras Callback which records the time of each epoch"""
+    """A Keras Callback which records the time of each epoch.
+
+    It also estimates the one-off graph compilation cost (e.g. from XLA) as
+    the excess time of the first training step over the mean of the other
+    training steps of the first epoch, reported as compile_time. The first
+    validation step is treated the same way against the other validation
+    steps and reported as val_compile_time. The epoch time with both costs
+    removed is reported as time_excl_compile.
+    """
     def __init__(self):
         self.times = []
-    
+        self.compile_time = 0.
+        self.val_compile_time = 0.
+        self._step_times = {'train': [], 'test': []}
+
     def on_epoch_begin(self, epoch, logs={}):
         self.starttime = time()
 
+    def _begin_step(self):
+        if len(self.times) == 0:
+            self._step_start = time()
+
+    def _end_step(self, mode):
+        if len(self.times) == 0:
+            self._step_times[mode].append(time() - self._step_start)
+
+    def on_train_batch_begin(self, batch, logs={}):
+        self._begin_step()
+
+    def on_train_batch_end(self, batch, logs={}):
+        self._end_step('train')
+
+    def on_test_batch_begin(self, batch, logs={}):
+        self._begin_step()
+
+    def on_test_batch_end(self, batch, logs={}):
+        self._end_step('test')
+
+    @staticmethod
+    def _excess_first_step(step_times):
+        if len(step_times) < 2:
+            return 0.
+        mean_step = sum(step_times[1:]) / (len(step_times) - 1)
+        return max(step_times[0] - mean_step, 0.)
+
     def on_epoch_end(self, epoch, logs={}):
         epoch_time = time() - self.starttime
+        if len(self.times) == 0:
+            # Only the first trained epoch pays the compilation cost
+            self.compile_time = self._excess_first_step(self._step_times['train'])
+            self.val_compile_time = self._excess_first_step(self._step_times['test'])
+            logs['compile_time'] = self.compile_time
+            logs['val_compile_time'] = self.val_compile_time
+        else:
+            logs['compile_time'] = 0.
+            logs['val_compile_time'] = 0.
         self.times.append(epoch_time)
         logs['time'] = epoch_time
+        logs['time_excl_compile'] = (epoch_time - logs['compile_time'] -
+                                     logs['val_compile_time'])
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+    """A Keras Callback which checkpoints every N steps and every epoch.
+
+    Serialisation is delegated to an AsyncCheckpointWriter so that training
+    only pays for copying the weights out of the session.
+    """
+    def __init__(self, writer, steps_per_epoch, save_steps=None):
+        self.writer = writer
+        self.steps_per_epoch = steps_per_epoch
+        self.save_steps = save_steps
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self._epoch = epoch
+
+    def on_train_batch_end(self, batch, logs={}):
+        step = self._epoch * self.steps_per_epoch + batch + 1
+        # The last step of the epoch is covered by on_epoch_end
+        if (self.save_steps and step % self.save_steps == 0 and
+                batch + 1 < self.steps_per_epoch):
+            self.writer.save(self.model, epoch=self._epoch, step=step)
+
+    def on_epoch_end(self, epoch, logs={}):
+        self.writer.save(self.model, epoch=epoch + 1,
+                         step=(epoch + 1) * self.steps_per_epoch,
+                         end_of_epoch=True,
+                         metric=logs.get(self.writer.monitor))
+
+    def on_train_end(self, logs={}):
+        self.writer.close()
+
+class StepTimingCallback(tf.keras.callbacks.Callback):
+    """A Keras Callback which records per-step timing and throughput.
+
+    For every training step it records the step time, the time the step
+    spent blocked waiting for its input batch, and the samples/s. Every
+    aggregate_steps steps, and at the end of each epoch, the per-rank means
+    are gathered across ranks and the min/median/max over ranks reported.
+    Epoch values are added to the logs (and so to history.csv), window values
+    are written to TensorBoard under log_dir if given.
+
+    The data wait is measured from a timestamp taken when the batch leaves
+    the input pipeline, so the training dataset must be passed through
+    wrap_dataset.
+
+    If a StragglerMonitor is given, the gathered per-rank window values are
+    passed to it for outlier detection.
+    """
+    stat_names = ['step_time', 'data_wait', 'samples_per_sec']
+
+    def __init__(self, batch_size, aggregate_steps=100, distributed=False,
+                 log_dir=None, straggler_monitor=None):
+        self.batch_size = batch_size
+        self.straggler_monitor = straggler_monitor
+        self.aggregate_steps = aggregate_steps
+        self.distributed = distributed
+        self.log_dir = log_dir
+        self._ready_times = deque()
+        self._window = []
+        self._epoch_steps = []
+        self._step = 0
+        self._writer = None
+        self._gather_input = None
+        self._gather_op = None
+
+    def wrap_dataset(self, dataset):
+        """Timestamp each batch as the training step receives it"""
+        def _stamp():
+            self._ready_times.append(time())
+            return 0
+        def stamp(x, y):
+            ready = tf.py_function(_stamp, [], tf.int32)
+            with tf.control_dependencies([ready]):
+                x = tf.identity(x)
+            return x, y
+        return dataset.map(stamp)
+
+    def on_train_begin(self, logs={}):
+        if self.distributed:
+            # Build the gather op once to avoid growing the graph every call
+            self._gather_input = tf.compat.v1.placeholder(
+                tf.float32, [len(self.stat_names)])
+            self._gather_op = hvd_tf.allgather(
+                tf.expand_dims(self._gather_input, 0), name='StepTimingGather')
+        if self.log_dir is not None:
+            self._writer = tf.compat.v1.summary.FileWriter(self.log_dir)
+
+    def on_train_batch_begin(self, batch, logs={}):
+        self._batch_start = time()
+
+    def on_train_batch_end(self, batch, logs={}):
+        end = time()
+        step_time = end - self._batch_start
+        ready = self._ready_times.popleft() if self._ready_times else self._batch_start
+        data_wait = min(max(ready - self._batch_start, 0.), step_time)
+        self._window.append((step_time, data_wait))
+        self._epoch_steps.append((step_time, data_wait))
+        self._step += 1
+        if self.aggregate_steps and self._step % self.aggregate_steps == 0:
+            stats = self._aggregate(self._window, check_stragglers=True)
+            self._window = []
+            logging.debug('Step %i timing: %s', self._step, stats)
+            self._write_summary(stats, self._step)
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self._epoch_steps = []
+
+    def on_epoch_end(self, epoch, logs={}):
+        stats = self._aggregate(self._epoch_steps)
+        logs.update(stats)
+
+    def on_train_end(self, logs={}):
+        if self._writer is not None:
+            self._writer.close()
+
+    def _aggregate(self, steps, check_stragglers=False):
+        """Reduce per-rank step records to min/median/max across ranks"""
+        steps = np.asarray(steps, dtype=np.float32).reshape(-1, 2)
+        if len(steps) > 0:
+            step_time, data_wait = steps.mean(axis=0)
+        else:
+            step_time, data_wait = 0., 0.
+        samples_per_sec = self.batch_size / step_time if step_time > 0 else 0.
+        values = np.array([step_time, data_wait, samples_per_sec], dtype=np.float32)
+        if self.distributed:
+            all_values = tf.keras.backend.get_session().run(
+                self._gather_op, feed_dict={self._gather_input: values})
+        else:
+            all_values = values[None]
+        if check_stragglers and self.straggler_monitor is not None:
+            self.straggler_monitor.check(self._step, all_values, self.stat_names)
+        stats = {}
+        for i, name in enumerate(self.stat_names):
+            stats[name + '_min'] = float(all_values[:, i].min())
+            stats[name + '_median'] = float(np.median(all_values[:, i]))
+            stats[name + '_max'] = float(all_values[:, i].max())
+        stats['global_samples_per_sec'] = float(all_values[:, 2].sum())
+        return stats
+
+    def _write_summary(self, stats, step):
+        if self._writer is None:
+            return
+        summary = tf.compat.v1.Summary(value=[
+            tf.compat.v1.Summary.Value(tag='step_timing/' + k, simple_value=v)
+            for k, v in stats.items()])
+        self._writer.add_summary(summary, step)
+        self._writer.flush()
+
+class ProfilingCallback(tf.keras.callbacks.Callback):
+    """A Keras Callback which profiles a window of training steps.
+
+    Steps start_step (inclusive) to end_step (exclusive), counted from the
+    beginning of training, are traced with the TF profiler while the Python
+    stack of the training thread is sampled. The trace, the collapsed Python
+    stacks and a text summary of the top ops are written to log_dir.
+    """
+    def __init__(self, log_dir, start_step, end_step):
+        self.log_dir = log_dir
+        self.start_step = start_step
+        self.end_step = end_step
+        self._step = 0
+        self._sampler = None
+
+    def on_train_batch_begin(self, batch, logs={}):
+        if self._step == self.start_step:
+            os.makedirs(self.log_dir, exist_ok=True)
+            logging.info('Starting profile of steps %i-%i',
+                         self.start_step, self.end_step)
+            self._sampler = profiling.PythonSampler()
+            self._sampler.start()
+            profiling.start_trace()
+            self._start_time = time()
+
+    def on_train_batch_end(self, batch, logs={}):
+        self._step += 1
+        if self._step == self.end_step and self._sampler is not None:
+            self._finish()
+
+    def on_train_end(self, logs={}):
+        # Training ended inside the window
+        if self._sampler is not None:
+            self._finish()
+
+    def _finish(self):
+        wall_time = time() - self._start_time
+        n_steps = self._step - self.start_step
+        trace = profiling.stop_trace(self.log_dir)
+        self._sampler.stop()
+        self._sampler.save(os.path.join(self.log_dir, 'python_stacks.txt'))
+        self._sampler = None
+        top_ops, input_share = profiling.summarize_trace(trace, wall_time)
+        profiling.write_summary(os.path.join(self.log_dir, 'summary.txt'),
+                                top_ops, input_share, wall_time, n_steps)
+
+class PeakMemoryCallback(tf.keras.callbacks.Callback):
+    """A Keras Callback which records the peak GPU memory in use.
+
+    The peak since the start of training is added to the logs as
+    peak_memory_gb at the end of each epoch, so runs with and without
+    memory-saving options can be compared from history.csv.
+    """
+    def on_train_begin(self, logs={}):
+        self._max_bytes_op = tf.contrib.memory_stats.MaxBytesInUse()
+
+    def on_epoch_end(self, epoch, logs={}):
+        max_bytes = tf.keras.backend.get_session().run(self._max_bytes_op)
+        logs['peak_memory_gb'] = max_bytes / 2**30
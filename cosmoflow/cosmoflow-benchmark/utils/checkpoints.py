@@ -29,13 +29,16 @@
 
 # System imports
 import os
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # External imports
+import h5py
 import tensorflow as tf
 import horovod.tensorflow.keras as hvd
 
-def load_hvd_model(checkpoint):
+def load_hvd_model(checkpoint, backward_passes_per_step=1):
     """Load model with Horovod setup.
 
     This exists as a workaround for my horovod issue:
@@ -45,13 +48,16 @@ def load_hvd_model(checkpoint):
     DistributedOptimizer.
 
     I've dropped support for compression, here, which may be useful.
+    The backward_passes_per_step argument restores gradient accumulation.
 
     See:
     https://github.com/horovod/horovod/blob/master/horovod/tensorflow/keras/__init__.py
     https://github.com/horovod/horovod/blob/master/horovod/_keras/__init__.py
     """
     def wrap_optimizer(cls):
-        return lambda **kwargs: hvd.DistributedOptimizer(cls(**kwargs))
+        return lambda **kwargs: hvd.DistributedOptimizer(
+            cls(**kwargs), backward_passes_per_step=backward_passes_per_step,
+            average_aggregated_gradients=True)
     horovod_objects = {
         subclass.__name__.lower(): wrap_optimizer(subclass)
         for subclass in tf.keras.optimizers.Optimizer.__subclasses__()
@@ -60,19 +66,226 @@ def load_hvd_model(checkpoint):
     }
     return tf.keras.models.load_model(checkpoint, custom_objects=horovod_objects)
 
-def reload_last_checkpoint(checkpoint_format, n_epochs, distributed):
+def reload_last_checkpoint(checkpoint_format, n_epochs, distributed,
+                           grad_accum_steps=1):
     """Finds and loads the last checkpoint matching the provided pattern"""
     # Count down from n_epochs to 0 to find the last epoch.
     # Note that keras names checkpoint files with epoch number starting from 1.
     # So the matched number corresponds to the new initial epoch.
     for epoch in range(n_epochs, 0, -1):
         checkpoint = checkpoint_format.format(epoch=epoch)
-        if os.path.exists(checkpoint):
+        # Weight snapshots from AsyncCheckpointWriter are not full models
+        if os.path.exists(checkpoint) and is_keras_checkpoint(checkpoint):
             logging.info('Found last checkpoint at %s', checkpoint)
             # Use special reload to prepare the DistributedOptimizer
             if distributed:
-                model = load_hvd_model(checkpoint)
+                model = load_hvd_model(
+                    checkpoint, backward_passes_per_step=grad_accum_steps)
             else:
                 model = tf.keras.models.load_model(checkpoint)
             return epoch, model
     raise Exception('Unable to find a checkpoint file at %s' % checkpoint_format)
+
+def write_checkpoint(path, model_weights, optimizer_weights, epoch, step):
+    """Write a snapshot of model and optimizer weights to an HDF5 file.
+
+    The file is written under a temporary name and moved into place once
+    complete, so a partially written checkpoint is never picked up.
+    """
+    tmp_path = path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['epoch'] = epoch
+        f.attrs['step'] = step
+        for group_name, weights in [('model_weights', model_weights),
+                                    ('optimizer_weights', optimizer_weights)]:
+            group = f.create_group(group_name)
+            for i, w in enumerate(weights):
+                group.create_dataset('%05i' % i, data=w)
+    os.replace(tmp_path, path)
+
+def read_checkpoint(path):
+    """Read the weights and metadata of a checkpoint from write_checkpoint.
+
+    Returns model weights, optimizer weights, epoch and step.
+    """
+    with h5py.File(path, 'r') as f:
+        epoch, step = int(f.attrs['epoch']), int(f.attrs['step'])
+        model_weights = [f['model_weights'][k][()]
+                         for k in sorted(f['model_weights'])]
+        optimizer_weights = [f['optimizer_weights'][k][()]
+                             for k in sorted(f['optimizer_weights'])]
+    return model_weights, optimizer_weights, epoch, step
+
+def is_keras_checkpoint(path):
+    """Whether a file is a full Keras model (from ModelCheckpoint)"""
+    with h5py.File(path, 'r') as f:
+        return 'model_config' in f.attrs
+
+def load_checkpoint_weights(model, path):
+    """Load the model weights of either checkpoint format into model"""
+    if is_keras_checkpoint(path):
+        try:
+            model.load_weights(path)
+        except ValueError:
+            # Different layer nesting (e.g. older ResNet checkpoints with the
+            # model inside a Sequential); the weight order is the same
+            saved = tf.keras.models.load_model(path, compile=False)
+            model.set_weights(saved.get_weights())
+    else:
+        model.set_weights(read_checkpoint(path)[0])
+
+def restore_checkpoint(model, path):
+    """Restore weights written by write_checkpoint into a compiled model.
+
+    Returns the epoch and step recorded in the checkpoint.
+    """
+    model_weights, optimizer_weights, epoch, step = read_checkpoint(path)
+    if len(optimizer_weights) > 0:
+        # The optimizer slot variables only exist once its update ops are
+        # built. Build (but do not run) them on a stand-in loss: a training
+        # step would advance the optimizer iterations and Horovod's gradient
+        # aggregation counter, shifting the LR and accumulation steps.
+        params = model.trainable_weights
+        loss = tf.add_n([tf.reduce_sum(p) for p in params])
+        model.optimizer.get_updates(loss, params)
+        model.optimizer.set_weights(optimizer_weights)
+    model.set_weights(model_weights)
+    return epoch, step
+
+def write_latest(output_dir, checkpoint, epoch, step):
+    """Atomically update the pointer file to the most recent checkpoint"""
+    latest_file = os.path.join(output_dir, 'latest')
+    with open(latest_file + '.tmp', 'w') as f:
+        json.dump(dict(checkpoint=os.path.basename(checkpoint),
+                       epoch=epoch, step=step), f)
+    os.replace(latest_file + '.tmp', latest_file)
+
+def read_latest(output_dir):
+    """Find the most recent checkpoint, or return None if there is none.
+
+    Uses the checkpoint index if present, otherwise the latest pointer.
+    """
+    entries = read_index(output_dir)
+    if len(entries) > 0:
+        latest = dict(max(entries, key=lambda e: e['step']))
+    else:
+        latest_file = os.path.join(output_dir, 'latest')
+        if not os.path.exists(latest_file):
+            return None
+        with open(latest_file) as f:
+            latest = json.load(f)
+    latest['checkpoint'] = os.path.join(output_dir, latest['checkpoint'])
+    return latest
+
+def read_index(output_dir):
+    """Read the JSON index of existing checkpoints (empty if missing)"""
+    index_file = os.path.join(output_dir, 'checkpoints.json')
+    if not os.path.exists(index_file):
+        return []
+    with open(index_file) as f:
+        return json.load(f)
+
+def write_index(output_dir, entries):
+    """Atomically rewrite the JSON index of existing checkpoints"""
+    index_file = os.path.join(output_dir, 'checkpoints.json')
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(entries, f, indent=1)
+    os.replace(index_file + '.tmp', index_file)
+
+def select_retained(entries, keep_last=None, keep_best=None, monitor='val_loss'):
+    """Pick the index entries to keep under the retention policy.
+
+    keep_last retains the most recent N checkpoints by step and keep_best
+    the N with lowest monitor value; the union of both is kept. With
+    neither set everything is kept. The most recent checkpoint is always
+    kept so that resume remains possible.
+    """
+    if keep_last is None and keep_best is None:
+        return list(entries)
+    by_step = sorted(entries, key=lambda e: e['step'])
+    keep = set(e['checkpoint'] for e in by_step[-max(keep_last or 0, 1):])
+    if keep_best is not None:
+        scored = [e for e in entries if e.get(monitor) is not None]
+        scored = sorted(scored, key=lambda e: e[monitor])
+        keep.update(e['checkpoint'] for e in scored[:keep_best])
+    return [e for e in by_step if e['checkpoint'] in keep]
+
+class AsyncCheckpointWriter(object):
+    """Writes checkpoints from weight snapshots on a background thread.
+
+    The weights are copied out of the session on the calling thread, which
+    is cheap compared to the HDF5 serialisation. At most one write is in
+    flight; a new save waits for the previous one to finish.
+
+    Written checkpoints are recorded in output_dir/checkpoints.json and
+    pruned according to the keep_last/keep_best retention settings. They are
+    named weights-*.h5, distinct from the full-model checkpoint-NNN.h5 files
+    of earlier runs which reload_last_checkpoint falls back to.
+    """
+
+    def __init__(self, output_dir,
+                 epoch_format='weights-{epoch:03d}.h5',
+                 step_format='weights-step{step:08d}.h5',
+                 keep_last=None, keep_best=None, monitor='val_loss',
+                 resume=False):
+        self.output_dir = output_dir
+        self.epoch_format = epoch_format
+        self.step_format = step_format
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.monitor = monitor
+        self._entries = read_index(output_dir) if resume else []
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def save(self, model, epoch, step, end_of_epoch=False, metric=None):
+        """Snapshot the model and schedule the checkpoint write.
+
+        epoch is the epoch training should resume from with this checkpoint
+        and metric the monitored quantity used by keep_best, if known.
+        """
+        model_weights = model.get_weights()
+        optimizer_weights = model.optimizer.get_weights()
+        if end_of_epoch:
+            name = self.epoch_format.format(epoch=epoch)
+        else:
+            name = self.step_format.format(step=step)
+        path = os.path.join(self.output_dir, name)
+        self.wait()
+        self._pending = self._executor.submit(
+            self._write, path, model_weights, optimizer_weights,
+            epoch, step, metric)
+
+    def _write(self, path, model_weights, optimizer_weights, epoch, step, metric):
+        write_checkpoint(path, model_weights, optimizer_weights, epoch, step)
+        write_latest(self.output_dir, path, epoch, step)
+        logging.debug('Wrote checkpoint %s', path)
+
+        # Update the index and apply the retention policy
+        entry = dict(checkpoint=os.path.basename(path), epoch=epoch, step=step)
+        entry[self.monitor] = None if metric is None else float(metric)
+        entries = [e for e in self._entries if e['checkpoint'] != entry['checkpoint']]
+        entries.append(entry)
+        retained = select_retained(entries, keep_last=self.keep_last,
+                                   keep_best=self.keep_best, monitor=self.monitor)
+        write_index(self.output_dir, retained)
+        retained_names = set(e['checkpoint'] for e in retained)
+        for e in entries:
+            if e['checkpoint'] not in retained_names:
+                logging.debug('Removing checkpoint %s', e['checkpoint'])
+                try:
+                    os.remove(os.path.join(self.output_dir, e['checkpoint']))
+                except FileNotFoundError:
+                    pass
+        self._entries = retained
+
+    def wait(self):
+        """Block until the in-flight write (if any) has completed"""
+        if self._pending is not None:
+            # Re-raises any exception from the writer thread
+            self._pending.result()
+            self._pending = None
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
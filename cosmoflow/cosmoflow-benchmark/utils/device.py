@@ -41,8 +41,8 @@ import utils.distributed as dist
 
 def configure_session(intra_threads=32, inter_threads=2,
                       kmp_blocktime=None, kmp_affinity=None, omp_num_threads=None,
-                      gpu=None):
-    """Sets the thread knobs in the TF backend"""
+                      gpu=None, xla=False):
+    """Sets the thread knobs and XLA auto-clustering in the TF backend"""
     if kmp_blocktime is not None:
         os.environ['KMP_BLOCKTIME'] = str(kmp_blocktime)
     if kmp_affinity is not None:
@@ -56,6 +56,7 @@ def configure_session(intra_threads=32, inter_threads=2,
         logging.info('OMP_NUM_THREADS %s', os.environ.get('OMP_NUM_THREADS', ''))
         logging.info('INTRA_THREADS %i', intra_threads)
         logging.info('INTER_THREADS %i', inter_threads)
+        logging.info('XLA %s', xla)
 
     config = tf.ConfigProto(
         inter_op_parallelism_threads=inter_threads,
@@ -63,4 +64,8 @@ def configure_session(intra_threads=32, inter_threads=2,
     )
     if gpu is not None:
         config.gpu_options.visible_device_list = str(gpu)
+    if xla:
+        # JIT compile all compatible ops of the model graph
+        config.graph_options.optimizer_options.global_jit_level = (
+            tf.OptimizerOptions.ON_1)
     tf.keras.backend.set_session(tf.Session(config=config))
@@ -34,6 +34,8 @@ import math
 from functools import partial
 
 # Externals
+import numpy as np
+import tensorflow as tf
 from tensorflow import keras
 import horovod.tensorflow.keras as hvd
 from mlperf_logging import mllog
@@ -63,9 +65,98 @@ def _lr_schedule(epoch, base_lr, peak_lr, n_warmup_epochs, decay_schedule={}):
                 decay_epoch, decay_factor = e, d
         return peak_lr * decay_factor
 
+class StepLRSchedule(keras.optimizers.schedules.LearningRateSchedule):
+    """Learning rate schedule evaluated in the graph at every optimizer step.
+
+    The warmup and decay settings are the same as for _lr_schedule, but the
+    LR changes smoothly from step to step instead of at epoch boundaries:
+        base_lr, peak_lr, n_warmup_epochs: linear warmup from base_lr to
+            peak_lr over the first n_warmup_epochs
+        decay: 'step' for the decay_schedule factors (applied after the given
+            epoch, as in _lr_schedule), or 'cosine' or 'polynomial' decay from
+            peak_lr to end_lr_factor * peak_lr over n_decay_epochs
+        power: exponent of the polynomial decay
+    Epochs are converted to steps with steps_per_epoch, which counts
+    optimizer updates (i.e. training steps / grad_accum_steps). With
+    gradient accumulation Horovod advances the optimizer iterations on
+    every micro-batch, so the step is divided by grad_accum_steps first.
+    """
+
+    def __init__(self, base_lr, peak_lr, steps_per_epoch, n_warmup_epochs=0,
+                 decay='step', decay_schedule={}, n_decay_epochs=None,
+                 end_lr_factor=0., power=1., grad_accum_steps=1):
+        if decay not in ('step', 'cosine', 'polynomial'):
+            raise ValueError('Unsupported LR decay type: %s' % decay)
+        if decay != 'step' and not n_decay_epochs:
+            raise ValueError('%s LR decay requires n_decay_epochs' % decay)
+        self.base_lr = base_lr
+        self.peak_lr = peak_lr
+        self.steps_per_epoch = steps_per_epoch
+        self.n_warmup_epochs = n_warmup_epochs
+        self.decay = decay
+        self.decay_schedule = decay_schedule
+        self.n_decay_epochs = n_decay_epochs
+        self.end_lr_factor = end_lr_factor
+        self.power = power
+        self.grad_accum_steps = grad_accum_steps
+
+    def _decayed_lr(self, step, warmup_steps):
+        peak_lr = tf.constant(self.peak_lr, tf.float32)
+        if self.decay == 'step':
+            if len(self.decay_schedule) == 0:
+                return peak_lr
+            epochs = sorted(self.decay_schedule.keys())
+            boundaries = tf.constant([(e + 1) * self.steps_per_epoch for e in epochs],
+                                     tf.float32)
+            factors = tf.constant([1.] + [self.decay_schedule[e] for e in epochs],
+                                  tf.float32)
+            # Number of decay boundaries passed selects the factor
+            index = tf.reduce_sum(tf.cast(step >= boundaries, tf.int32))
+            return peak_lr * tf.gather(factors, index)
+
+        end_lr = peak_lr * self.end_lr_factor
+        decay_steps = float(self.n_decay_epochs * self.steps_per_epoch)
+        progress = tf.clip_by_value((step - warmup_steps) / decay_steps, 0., 1.)
+        if self.decay == 'cosine':
+            shape = 0.5 * (1. + tf.cos(np.pi * progress))
+        else:
+            shape = tf.pow(1. - progress, self.power)
+        return end_lr + (peak_lr - end_lr) * shape
+
+    def __call__(self, step):
+        with tf.name_scope('lr_schedule'):
+            step = tf.cast(step // self.grad_accum_steps, tf.float32)
+            warmup_steps = float(self.n_warmup_epochs * self.steps_per_epoch)
+            decayed_lr = self._decayed_lr(step, warmup_steps)
+            if warmup_steps == 0:
+                return decayed_lr
+            warmup_lr = (self.base_lr + (self.peak_lr - self.base_lr) *
+                         step / warmup_steps)
+            return tf.where(step < warmup_steps, warmup_lr, decayed_lr)
+
+    def get_config(self):
+        return dict(base_lr=self.base_lr, peak_lr=self.peak_lr,
+                    steps_per_epoch=self.steps_per_epoch,
+                    n_warmup_epochs=self.n_warmup_epochs, decay=self.decay,
+                    decay_schedule=self.decay_schedule,
+                    n_decay_epochs=self.n_decay_epochs,
+                    end_lr_factor=self.end_lr_factor, power=self.power,
+                    grad_accum_steps=self.grad_accum_steps)
+
 def get_lr_schedule(base_lr, global_batch_size, base_batch_size=None,
-                    scaling=None, n_warmup_epochs=0, decay_schedule={}):
-    """Get the learning rate schedule function"""
+                    scaling=None, n_warmup_epochs=0, decay_schedule={},
+                    per_step=False, steps_per_epoch=None, n_epochs=None,
+                    decay='step', n_decay_epochs=None, end_lr_factor=0.,
+                    power=1., grad_accum_steps=1):
+    """Get the learning rate schedule.
+
+    Returns the per-epoch schedule function for LearningRateScheduler, or,
+    with per_step or a cosine/polynomial decay, a StepLRSchedule to be
+    passed to the optimizer as its learning rate. The decay of those runs
+    until the end of training (n_epochs) unless n_decay_epochs is given.
+    steps_per_epoch counts optimizer updates, of grad_accum_steps
+    micro-batches each.
+    """
     if scaling == 'linear':
         scale_factor = global_batch_size / base_batch_size
     elif scaling == 'sqrt':
@@ -89,17 +180,38 @@ def get_lr_schedule(base_lr, global_batch_size, base_batch_size=None,
                        value=sorted(decay_schedule.keys()))
         mllogger.event(key=mllog.constants.OPT_LR_DECAY_FACTOR,
                        value=max(decay_schedule.values()) if len(decay_schedule)>0 else 1)
+        mllogger.event(key='opt_lr_decay_type', value=decay)
+        mllogger.event(key='opt_lr_per_step', value=per_step or decay != 'step')
+
+    if per_step or decay != 'step':
+        if n_decay_epochs is None and n_epochs is not None:
+            n_decay_epochs = n_epochs - n_warmup_epochs
+        return StepLRSchedule(base_lr=base_lr, peak_lr=peak_lr,
+                              steps_per_epoch=steps_per_epoch,
+                              n_warmup_epochs=n_warmup_epochs, decay=decay,
+                              decay_schedule=decay_schedule,
+                              n_decay_epochs=n_decay_epochs,
+                              end_lr_factor=end_lr_factor, power=power,
+                              grad_accum_steps=grad_accum_steps)
     return partial(_lr_schedule, base_lr=base_lr, peak_lr=peak_lr,
                    n_warmup_epochs=n_warmup_epochs,
                    decay_schedule=decay_schedule)
 
-def get_optimizer(name, distributed=False, **opt_args):
-    """Configure the optimizer"""
+def get_optimizer(name, distributed=False, grad_accum_steps=1, **opt_args):
+    """Configure the optimizer
+
+    With grad_accum_steps > 1 the gradients of that many micro-batches are
+    accumulated locally and only allreduced and applied on every
+    grad_accum_steps-th step, using the Horovod local aggregation support.
+    """
+    if grad_accum_steps > 1 and not distributed:
+        raise ValueError('Gradient accumulation requires distributed mode')
 
     # MLPerf logging
     if utils.distributed.rank() == 0:
         mllogger = mllog.get_mllogger()
         mllogger.event(key=mllog.constants.OPT_NAME, value=name)
+        mllogger.event(key='gradient_accumulation_steps', value=grad_accum_steps)
 
     # Construct the optimizer
     OptType = getattr(keras.optimizers, name)
@@ -107,6 +219,10 @@ def get_optimizer(name, distributed=False, **opt_args):
 
     # Distributed optimizer wrapper
     if distributed:
-        opt = hvd.DistributedOptimizer(opt)
+        # Average rather than sum the micro-batch gradients, so that
+        # grad_accum_steps micro-batches match one large batch
+        opt = hvd.DistributedOptimizer(
+            opt, backward_passes_per_step=grad_accum_steps,
+            average_aggregated_gradients=True)
 
     return opt
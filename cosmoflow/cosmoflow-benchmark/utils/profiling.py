@@ -0,0 +1,96 @@
+"""Utility code for profiling a window of training steps"""
+
+# System imports
+import os
+import sys
+import threading
+import traceback
+import logging
+from collections import Counter, defaultdict
+from time import sleep
+
+# External imports
+from tensorflow.python.eager import profiler
+from tensorflow.core.protobuf import trace_events_pb2
+
+class PythonSampler(object):
+    """Samples the Python stack of one thread at a fixed interval.
+
+    Samples are recorded as collapsed stacks (one 'frame;frame;... count'
+    line each), which is the input format of the usual flame graph tools.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = Counter()
+        self._running = False
+        self._thread = None
+
+    def _run(self):
+        while self._running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = traceback.extract_stack(frame)
+                key = ';'.join('%s (%s:%i)' % (f.name, os.path.basename(f.filename), f.lineno)
+                               for f in stack)
+                self.samples[key] += 1
+            sleep(self.interval)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('%s %i\n' % (stack, count))
+
+def summarize_trace(trace_bytes, wall_time, n_top=20):
+    """Summarize a serialized profiler trace.
+
+    Returns a list of (op name, total time in s, count) for the n_top ops with
+    most total time, and the fraction of wall time the training steps spent
+    waiting on the input pipeline (IteratorGetNext).
+    """
+    trace = trace_events_pb2.Trace()
+    trace.ParseFromString(trace_bytes)
+    op_times = defaultdict(float)
+    op_counts = Counter()
+    for event in trace.trace_events:
+        # Kernel names carry a ':OpType' suffix on some devices
+        name = event.name.split(':')[0]
+        op_times[name] += event.duration_ps * 1e-12
+        op_counts[name] += 1
+    top_ops = sorted(op_times.items(), key=lambda kv: kv[1], reverse=True)[:n_top]
+    top_ops = [(name, t, op_counts[name]) for name, t in top_ops]
+    input_time = sum(t for name, t in op_times.items()
+                     if name.startswith('IteratorGetNext'))
+    input_share = input_time / wall_time if wall_time > 0 else 0.
+    return top_ops, input_share
+
+def start_trace():
+    profiler.start()
+
+def stop_trace(log_dir):
+    """Stop the TF profiler, save the trace for TensorBoard and return it"""
+    result = profiler.stop()
+    profiler.save(log_dir, result)
+    return result
+
+def write_summary(path, top_ops, input_share, wall_time, n_steps):
+    """Write a plain text profile summary and echo it to the log"""
+    lines = ['Profiled %i steps in %.3f s (%.4f s/step)' %
+             (n_steps, wall_time, wall_time / max(n_steps, 1)),
+             'Input pipeline share of wall time: %.1f%%' % (100 * input_share),
+             'Top ops by total time:']
+    lines += ['  %-60s %10.4f s %8i calls' % op for op in top_ops]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    for line in lines:
+        logging.info(line)
@@ -0,0 +1,117 @@
+"""Utility code for detecting straggler ranks during training"""
+
+# System imports
+import os
+import json
+import socket
+import logging
+import subprocess
+
+# External imports
+import numpy as np
+import tensorflow as tf
+import horovod.tensorflow as hvd_tf
+from mlperf_logging import mllog
+
+def get_ib_address(interface='ib0'):
+    """Get the IPv4 address of the local IB interface, or None"""
+    try:
+        output = subprocess.run(['ip', '-4', '-o', 'addr', 'show', interface],
+                                capture_output=True, text=True).stdout
+        return output.split()[3].split('/')[0]
+    except (OSError, IndexError):
+        return None
+
+def find_outliers(values, k=3., min_rel_mad=0.01, min_abs_mad=0.01):
+    """Find the indices of values further than k*MAD from the median.
+
+    The MAD is floored at min_rel_mad times the median and at min_abs_mad
+    (in the units of values, seconds for timings) so that ranks are not
+    flagged for noise-level deviations when all ranks are nearly identical.
+    The absolute floor also lets a single slow rank be flagged when all
+    other ranks have the same value, e.g. zero data wait.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    median = np.median(values)
+    mad = np.median(np.abs(values - median))
+    mad = max(mad, min_rel_mad * abs(median), min_abs_mad)
+    if mad == 0:
+        return []
+    return [int(i) for i in np.nonzero(np.abs(values - median) > k * mad)[0]]
+
+def allgather_strings(strings, width=64):
+    """Gather a list of strings from every rank with a Horovod allgather.
+
+    Returns a list with the strings of each rank, in rank order. Strings are
+    truncated to width bytes.
+    """
+    local = np.zeros((1, len(strings), width), dtype=np.uint8)
+    for i, string in enumerate(strings):
+        encoded = string.encode()[:width]
+        local[0, i, :len(encoded)] = np.frombuffer(encoded, dtype=np.uint8)
+    gathered = tf.compat.v1.keras.backend.get_session().run(
+        hvd_tf.allgather(tf.constant(local), name='StragglerHostGather'))
+    return [[bytes(row).rstrip(b'\0').decode() for row in rank_rows]
+            for rank_rows in gathered]
+
+class StragglerMonitor(object):
+    """Flags ranks whose step or data-wait times are outliers.
+
+    Host information for all ranks is exchanged once at construction. The
+    check method is given the per-rank timing values gathered by
+    StepTimingCallback; on rank 0 flagged ranks are logged to the MLPerf
+    log and appended to stragglers.jsonl in the output directory.
+
+    ibaddrs is the cluster nodefile order (ClusterConnector.ibaddrs), used
+    to report the node index of a straggling rank.
+    """
+
+    def __init__(self, rank, local_rank, output_dir, k=3., ibaddrs=None):
+        self.rank = rank
+        self.k = k
+        self.output_file = os.path.join(output_dir, 'stragglers.jsonl')
+        local_info = [socket.gethostname(), get_ib_address() or '',
+                      str(local_rank)]
+        self.rank_info = [dict(host=host, ibaddr=ibaddr or None,
+                               local_rank=int(local_rank_str))
+                          for host, ibaddr, local_rank_str
+                          in allgather_strings(local_info)]
+        ibaddrs = ibaddrs or []
+        for info in self.rank_info:
+            info['node'] = (ibaddrs.index(info['ibaddr'])
+                            if info['ibaddr'] in ibaddrs else None)
+
+    def check(self, step, values, names):
+        """Check a [n_ranks, n_stats] array of timings for stragglers.
+
+        Only stats whose name is step_time or data_wait are considered, and
+        only slow outliers are flagged.
+        """
+        if self.rank != 0:
+            return []
+        flags = []
+        for i, name in enumerate(names):
+            if name not in ('step_time', 'data_wait'):
+                continue
+            column = values[:, i]
+            median = float(np.median(column))
+            for r in find_outliers(column, k=self.k):
+                if column[r] <= median:
+                    continue
+                flag = dict(step=step, rank=r, stat=name,
+                            value=float(column[r]), median=median,
+                            **self.rank_info[r])
+                flags.append(flag)
+
+        if len(flags) > 0:
+            mllogger = mllog.get_mllogger()
+            with open(self.output_file, 'a') as f:
+                for flag in flags:
+                    logging.warning('Straggler at step %i: rank %i on %s (%s) '
+                                    '%s %.4f vs median %.4f', step, flag['rank'],
+                                    flag['host'], flag['ibaddr'], flag['stat'],
+                                    flag['value'], flag['median'])
+                    mllogger.event(key='straggler', value=flag,
+                                   metadata={'step_num': step})
+                    f.write(json.dumps(flag) + '\n')
+        return flags